@@ -1,10 +1,12 @@
 import partitura as pt
 import mido
-import math
 import numpy as np
 import copy
 import pretty_midi
 import os
+import bisect
+import struct
+from collections.abc import MutableMapping
 
 #MIDI Locations for the labels so that we can decipher what's being output.
 
@@ -62,11 +64,18 @@ low_label_pitch_map = {
 
 LABEL_VELOCITY = 10
 
-label_na_fields = [('onset_sec', '<f4'), ('duration_sec', '<f4'), ('pitch', '<i4'), ('velocity', '<i4'), 
-              ('midlvl_label', '<U256'), ('lowlvl_label', '<U256')]
+CHORD_TOLERANCE = 0.030  # 30ms, notes closer than this to the previous one belong to the same score event
+FIND_WINDOW = 0.05  # 50ms before and after the mapped time in which a note to edit is searched for
+
+#one row per labelled event. the labels are codes into a LabelVocab, and the mid/low label pitches
+#are only expanded (label_note_fields, 2 rows per event) when written to midi.
+label_na_fields = [('onset_sec', '<f4'), ('duration_sec', '<f4'), ('midlvl_label', '<u2'), ('lowlvl_label', '<u2')]
+#lowlvl.adjust_annotations output: tgt time, the pass it was played in (0 = main path), which annotation array and index.
+adjusted_annot_fields = [('tgt_time', '<f8'), ('pass', '<i4'), ('annot', '<i4'), ('index', '<i4')]
+label_note_fields = [('onset_sec', '<f4'), ('duration_sec', '<f4'), ('pitch', '<i4'), ('velocity', '<i4')]
 regular_na_fields = [('onset_sec', '<f4'), ('duration_sec', '<f4'), ('onset_tick', '<i4'), ('duration_tick', '<i4'), 
                      ('pitch', '<i4'), ('velocity', '<i4'), ('track', '<i4'), ('channel', '<i4'), 
-                     ('id', '<U256')]
+                     ('id', '<i4')]  #id is a code into lowlvl.note_ids, see _intern_ids / resolve_ids
 
 #contemplate the order of applying the mistakes and if sorting is needed:
 #time based
@@ -76,6 +85,1029 @@ regular_na_fields = [('onset_sec', '<f4'), ('duration_sec', '<f4'), ('onset_tick
 #TODO: have a function that merges mid_level labels done by the same 'event'. 
 # group_mid (start, end), and would merge the notes of the same mid level event into 1.
 
+
+class Journaled:
+    """Records undo steps for the open transactions of the lowlvl it belongs to.
+
+    lowlvl sets `journal` to its list of open transactions (see lowlvl.begin). An edit
+    that changes state in place records how to put it back with _record, which does
+    nothing outside a transaction.
+    """
+    journal = None
+
+    def _record(self, undo):
+        if self.journal:
+            self.journal[-1].append(undo)
+
+
+class TimeMap:
+    """Piecewise-linear src -> tgt time map stored as breakpoints.
+
+    Every lowlvl operation only translates a region of the target (silences, rollbacks,
+    segment placement), so the map is kept as sorted src breakpoints with one constant
+    offset per piece: tgt = src + offset[i] for src in [src[i], src[i+1]). Breakpoints
+    are only added where an edit starts or ends, lookups are a binary search and the
+    resolution is exact. Unmapped pieces (segmented mode) hold NaN and look up as -1.
+    """
+    def __init__(self, start, end, offset=0.0):
+        self.src = np.array([start], dtype=np.float64)
+        self.offset = np.array([offset], dtype=np.float64)
+        self.end = float(end)
+
+    def copy(self):
+        tm = TimeMap.__new__(TimeMap)
+        tm.src = self.src.copy()
+        tm.offset = self.offset.copy()
+        tm.end = self.end
+        return tm
+
+    def state(self):
+        #the edits below replace the arrays instead of writing to them, so keeping them is enough to restore()
+        return self.src, self.offset, self.end
+
+    def restore(self, state):
+        self.src, self.offset, self.end = state
+
+    @property
+    def start(self):
+        return float(self.src[0])
+
+    @property
+    def key(self):
+        #(tgt time at the start of the src interval, tgt time at its end). used to key the repeats.
+        return (self.lookup(self.start), self.lookup(self.end))
+
+    def covers(self, src_time):
+        return self.start <= src_time <= self.end
+
+    def _locate(self, src_time):
+        idx = np.searchsorted(self.src, src_time, side='right') - 1
+        return np.clip(idx, 0, len(self.src) - 1)
+
+    def lookup(self, src_time):
+        #scalar in -> float out, array in -> array out. -1 where the map is unmapped.
+        src_time = np.asarray(src_time, dtype=np.float64)
+        tgt_time = src_time + self.offset[self._locate(src_time)]
+        tgt_time = np.where(np.isnan(tgt_time), -1.0, tgt_time)
+        if tgt_time.ndim == 0:
+            return float(tgt_time)
+        return tgt_time
+
+    def _split(self, src_time):
+        #make sure a piece starts exactly at src_time, and return the index of that piece.
+        if src_time <= self.src[0]:
+            return 0
+        if src_time >= self.end:
+            return len(self.src)
+        idx = np.searchsorted(self.src, src_time, side='left')
+        if idx < len(self.src) and self.src[idx] == src_time:
+            return idx
+        self.src = np.insert(self.src, idx, src_time)
+        self.offset = np.insert(self.offset, idx, self.offset[idx - 1])
+        return idx
+
+    def _normalize(self):
+        #drop zero-length pieces (the later one wins, as in lookup) and merge equal neighbours.
+        keep = np.append(self.src[1:] > self.src[:-1], True)
+        src, offset = self.src[keep], self.offset[keep]
+        same = (offset[1:] == offset[:-1]) | (np.isnan(offset[1:]) & np.isnan(offset[:-1]))
+        keep = np.insert(~same, 0, True)
+        self.src, self.offset = src[keep], offset[keep]
+
+    def add(self, src_start, src_end, delta):
+        #tgt += delta on [src_start, src_end)
+        if src_end <= src_start:
+            return
+        i, j = self._split(src_start), self._split(src_end)
+        self.offset = self.offset.copy()
+        self.offset[i:j] += delta
+        self._normalize()
+
+    def assign(self, src_start, src_end, offset):
+        #tgt = src + offset on [src_start, src_end). offset=np.nan unmaps the range.
+        if src_end <= src_start:
+            return
+        i, j = self._split(src_start), self._split(src_end)
+        self.offset = self.offset.copy()
+        self.offset[i:j] = offset
+        self._normalize()
+
+    def shift_after(self, tgt_time, delta):
+        #every mapped point whose tgt time is >= tgt_time moves by delta. Returns whether anything moved.
+        ends = np.append(self.src[1:], self.end)
+        tgt_start = self.src + self.offset
+        tgt_end = ends + self.offset
+        shifted = tgt_start >= tgt_time
+        straddle = np.flatnonzero((tgt_start < tgt_time) & (tgt_end > tgt_time))
+        if len(straddle):
+            cut = tgt_time - self.offset[straddle]
+            self.src = np.insert(self.src, straddle + 1, cut)
+            self.offset = np.insert(self.offset, straddle + 1, self.offset[straddle])
+            shifted = np.insert(shifted, straddle + 1, True)
+        if not np.any(shifted):
+            return False
+        self.offset = np.where(shifted, self.offset + delta, self.offset)
+        self._normalize()
+        return True
+
+    def slice(self, src_start, src_end):
+        #copy of the map restricted to [src_start, src_end]
+        src_start = max(src_start, self.start)
+        src_end = min(src_end, self.end)
+        i = int(self._locate(src_start))
+        j = np.searchsorted(self.src, src_end, side='right')
+        tm = TimeMap.__new__(TimeMap)
+        tm.src = np.concatenate(([src_start], self.src[i + 1:j]))
+        tm.offset = self.offset[i:j].copy()
+        tm.end = float(src_end)
+        return tm
+
+    def paint(self, starts, ends, offsets):
+        #assign(starts[k], ends[k], offsets[k]) for every k in order, in one pass. returns the slices the
+        #assigns overwrite: what slice(starts[k], ends[k]) was just before the k-th assign.
+        starts = np.clip(np.asarray(starts, dtype=np.float64), self.start, self.end)
+        ends = np.clip(np.asarray(ends, dtype=np.float64), self.start, self.end)
+        offsets = np.asarray(offsets, dtype=np.float64)
+        n = len(starts)
+        if n == 0:
+            return []
+
+        #elementary pieces between every breakpoint, start and end. row k of `before` is the offset of every piece
+        #before the k-th assign: the offset of the last assign so far that covered it, or the current one.
+        bounds = np.unique(np.concatenate((self.src, starts, ends)))
+        bounds = bounds[bounds < self.end]
+        lo = np.searchsorted(bounds, starts)
+        hi = np.searchsorted(bounds, ends)
+        pieces = np.arange(len(bounds))
+        covers = (pieces >= lo[:, None]) & (pieces < hi[:, None])
+        last = np.maximum.accumulate(np.where(covers, np.arange(n)[:, None], -1), axis=0)
+        painted = np.where(last >= 0, offsets[np.maximum(last, 0)], self.offset[self._locate(bounds)])
+        before = np.vstack((self.offset[self._locate(bounds)], painted[:-1]))
+
+        old = []
+        for k in range(n):
+            #the slice of the normalized map: equal neighbours merged, and the piece starting at the end point if there is one
+            row = before[k]
+            i, j = lo[k], hi[k] + (hi[k] < len(bounds))
+            offset = row[i:j]
+            keep = np.insert(~((offset[1:] == offset[:-1]) | (np.isnan(offset[1:]) & np.isnan(offset[:-1]))), 0, True)
+            tm = TimeMap.__new__(TimeMap)
+            tm.src = np.concatenate(([starts[k]], bounds[i:j][keep][1:]))
+            tm.offset = offset[keep]
+            tm.end = float(ends[k])
+            old.append(tm)
+
+        self.src, self.offset = bounds, painted[-1]
+        self._normalize()
+        return old
+
+    def knots(self):
+        #the map as a (time_from, time_to) polyline, 2 points per piece.
+        ends = np.append(self.src[1:], self.end)
+        time_from = np.column_stack((self.src, ends)).ravel()
+        time_to = np.column_stack((self.src + self.offset, ends + self.offset)).ravel()
+        return time_from, np.where(np.isnan(time_to), -1.0, time_to)
+
+
+class InverseTimeMap:
+    """tgt -> (src, pass) index over the main warping path and the repeats.
+
+    Built from (time_from, time_to) polylines, as lowlvl.get_timemap / get_repeats return them
+    or as they are saved in the timemap csv, with -1 for unmapped points. Each segment between
+    two mapped points is a piece, sorted by tgt start over all passes, so a query is a binary
+    search for the last piece starting at or before it, and the src time is interpolated inside
+    that piece. Pass 0 is the main path and pass k the k-th repeat.
+    Pieces where the src time stands still (an inserted silence, or the jump of a pass to where
+    it continues) are only used where no other piece plays, and a tgt time that no piece covers
+    (before the first note, between segments) goes to the nearest end of a piece.
+    """
+    def __init__(self, time_from, time_to, repeats=()):
+        #repeats: (time_from, time_to) per repeat, in pass order
+        pieces = []
+        for k, (frm, to) in enumerate([(time_from, time_to)] + list(repeats)):
+            frm, to = np.asarray(frm, dtype=np.float64), np.asarray(to, dtype=np.float64)
+            ok = (to[:-1] != -1) & (to[1:] != -1) & (to[1:] > to[:-1])
+            pieces.append((to[:-1][ok], to[1:][ok], frm[:-1][ok], frm[1:][ok], np.full(int(ok.sum()), k)))
+        pieces = [np.concatenate(col) for col in zip(*pieces)]
+        still = pieces[2] == pieces[3]
+        self._playing = self._index([col[~still] for col in pieces])
+        self._still = self._index([col[still] for col in pieces])
+
+    @staticmethod
+    def _index(pieces):
+        order = np.argsort(pieces[0], kind='stable')
+        tgt_lo, tgt_hi, src_lo, src_hi, passes = (col[order] for col in pieces)
+        #pieces of one kind can still overlap after a negative shift: for each piece, the one reaching
+        #furthest among those starting up to it.
+        reach = np.maximum.accumulate(tgt_hi) if len(order) else tgt_hi
+        furthest = np.maximum.accumulate(np.where(tgt_hi >= reach, np.arange(len(order)), 0))
+        return tgt_lo, tgt_hi, src_lo, src_hi, passes, furthest
+
+    @staticmethod
+    def _find(index, tgt_time):
+        #the piece of the index covering each tgt time, and whether it does
+        tgt_lo, tgt_hi, _, _, _, furthest = index
+        if len(tgt_lo) == 0:
+            return np.zeros(tgt_time.shape, dtype=np.intp), np.zeros(tgt_time.shape, dtype=bool)
+        after = np.searchsorted(tgt_lo, tgt_time, side='right')
+        piece = np.maximum(after - 1, 0)
+        piece = np.where(tgt_time <= tgt_hi[piece], piece, furthest[piece])
+        return piece, (after > 0) & (tgt_time <= tgt_hi[piece])
+
+    def lookup(self, tgt_time):
+        #scalar in -> (float, int) out, array in -> (src array, pass array) out. (-1, -1) if the map is empty.
+        tgt_time = np.asarray(tgt_time, dtype=np.float64)
+        tgt_lo, tgt_hi, src_lo, src_hi, passes, _ = self._playing
+        n = len(tgt_lo)
+        if n == 0:
+            src_time, pass_idx = np.full(tgt_time.shape, -1.0), np.full(tgt_time.shape, -1)
+        else:
+            piece, inside = self._find(self._playing, tgt_time)
+            #not played: the end of the previous piece or the start of the next, whichever is nearer
+            after = np.searchsorted(tgt_lo, tgt_time, side='right')
+            nxt = np.minimum(after, n - 1)
+            to_next = (after < n) & ((after == 0) | (~inside & (tgt_lo[nxt] - tgt_time < tgt_time - tgt_hi[piece])))
+            piece = np.where(to_next, nxt, piece)
+            at = np.clip(tgt_time, tgt_lo[piece], tgt_hi[piece])
+            src_time = src_lo[piece] + (at - tgt_lo[piece]) * (src_hi[piece] - src_lo[piece]) / (tgt_hi[piece] - tgt_lo[piece])
+            pass_idx = passes[piece]
+
+            if len(self._still[0]):
+                #in a silence
+                still, in_still = self._find(self._still, tgt_time)
+                in_still &= ~inside
+                src_time = np.where(in_still, self._still[2][still], src_time)
+                pass_idx = np.where(in_still, self._still[4][still], pass_idx)
+        if src_time.ndim == 0:
+            return float(src_time), int(pass_idx)
+        return src_time, pass_idx
+
+
+class LabelVocab(Journaled):
+    """Label name <-> code table for the midlvl_label / lowlvl_label columns of label_na.
+
+    Seeded with the known mid and low level labels, other names get the next free code
+    when they are first used.
+    """
+    def __init__(self, names=tuple(mid_label_pitch_map) + tuple(low_label_pitch_map)):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.code(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def code(self, name):
+        if name not in self.codes:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+            self._record(lambda: self.codes.pop(self.names.pop()))
+        return self.codes[name]
+
+    def get(self, name):
+        #code of name, None if it was never used
+        return self.codes.get(name)
+
+    def decode(self, codes):
+        return np.asarray(self.names)[np.asarray(codes, dtype=np.intp)]
+
+    def pitches(self, pitch_map, default):
+        #label pitch of every code
+        return np.array([pitch_map.get(name, default) for name in self.names], dtype=np.int32)
+
+
+class EventIndex:
+    """Score events (chords) of an onset-sorted note array, built once per source.
+
+    A note starts a new event when it comes more than `tolerance` after the previous note.
+    event_id gives the event of every note and start/end the [start, end) note range of
+    every event, so the previous/next event of a note is event_id -/+ 1 and any run of
+    events is one slice of the note array.
+    """
+    def __init__(self, onsets, tolerance=CHORD_TOLERANCE):
+        self.onsets = np.asarray(onsets, dtype=np.float64)
+        new_event = np.diff(self.onsets) > tolerance
+        self.event_id = np.concatenate(([0], np.cumsum(new_event)))[:len(self.onsets)]
+        self.start = np.flatnonzero(np.concatenate(([True], new_event)))[:len(self.onsets)]
+        self.end = np.append(self.start[1:], len(self.onsets))
+
+    def __len__(self):
+        return len(self.start)
+
+    def nearest(self, t):
+        #index of the note closest to t, the first one on ties (as argmin)
+        i = np.searchsorted(self.onsets, t)
+        if i == len(self.onsets) or (i > 0 and np.fabs(self.onsets[i - 1] - t) <= np.fabs(self.onsets[i] - t)):
+            i -= 1
+        return int(np.searchsorted(self.onsets, self.onsets[i], side='left'))
+
+    def events_back(self, note_idx, num_events_back):
+        #note range [start, end) from num_events_back events before note_idx's event, up to the end of that event.
+        event = self.event_id[note_idx]
+        return int(self.start[max(event - num_events_back, 0)]), int(self.end[event])
+
+    def next_event(self, t):
+        #note range of the first event starting after t, or None
+        i = np.searchsorted(self.onsets, t, side='right')
+        if i == len(self.onsets):
+            return None
+        return int(i), int(self.end[self.event_id[i]])
+
+    def previous_event(self, t):
+        #note range of the event before the one holding t (or the first one after t), or None
+        i = np.searchsorted(self.onsets, t, side='left')
+        event = self.event_id[i] if i < len(self.onsets) else len(self)
+        if event == 0:
+            return None
+        return int(self.start[event - 1]), int(self.end[event - 1])
+
+
+class RepeatTable(MutableMapping):
+    """Repeats (old passes) keyed by their (tgt start, tgt end) interval.
+
+    Behaves like the dict it replaces, iterating in key order. Next to the TimeMaps it keeps
+    one row per pass in parallel arrays: the src interval it covers, its tgt extent and an
+    offset that is still pending. A key is found by bisecting the sorted keys, the passes that
+    cover a src time by one mask over the src column (O(passes), vectorized). Shifting every
+    pass after a tgt time only adds to the pending column of the passes that lie entirely
+    after it; the offset is folded into the TimeMap when that pass is read through the table.
+    Only passes straddling the shift time are edited right away, and only the keys of the
+    shifted passes are rewritten: the rows are re-sorted only if a shift broke their order.
+    """
+    def __init__(self):
+        self._key_list = []             #sorted keys, parallel to the arrays below
+        self._maps = []
+        self._src = np.zeros((0, 2))    #src interval [start, end] of each pass
+        self._ends = np.zeros((0, 2))   #tgt time at start and end (-1 if unmapped), without the pending offset
+        self._tgt = np.zeros((0, 2))    #[min, max] tgt time the pass maps to, without the pending offset
+        self._pending = np.zeros(0)
+
+    @staticmethod
+    def _extent(tm):
+        ends = np.append(tm.src[1:], tm.end)
+        tgt_lo, tgt_hi = tm.src + tm.offset, ends + tm.offset
+        if np.all(np.isnan(tgt_lo)):
+            return [np.nan, np.nan]
+        return [np.nanmin(tgt_lo), np.nanmax(tgt_hi)]
+
+    def _row(self, key):
+        i = bisect.bisect_left(self._key_list, key)
+        if i == len(self._key_list) or self._key_list[i] != key:
+            raise KeyError(key)
+        return i
+
+    def _flush(self, i):
+        if self._pending[i] != 0:
+            tm = self._maps[i]
+            tm.offset = tm.offset + self._pending[i]
+            self._ends[i] = np.where(self._ends[i] == -1, -1, self._ends[i] + self._pending[i])
+            self._tgt[i] += self._pending[i]
+            self._pending[i] = 0
+        return self._maps[i]
+
+    def state(self):
+        #everything restore() needs to undo later edits: the rows (a few numbers per pass) and the maps' states
+        return (list(self._key_list), list(self._maps), [tm.state() for tm in self._maps],
+                self._src.copy(), self._ends.copy(), self._tgt.copy(), self._pending.copy())
+
+    def restore(self, state):
+        key_list, maps, map_states, self._src, self._ends, self._tgt, self._pending = state
+        self._key_list, self._maps = list(key_list), list(maps)
+        for tm, tm_state in zip(maps, map_states):
+            tm.restore(tm_state)
+
+    def __len__(self):
+        return len(self._key_list)
+
+    def __iter__(self):
+        return iter(list(self._key_list))
+
+    def __getitem__(self, key):
+        return self._flush(self._row(key))
+
+    def __setitem__(self, key, tm):
+        if key in self:
+            del self[key]
+        i = bisect.bisect_left(self._key_list, key)
+        self._key_list.insert(i, key)
+        self._maps.insert(i, tm)
+        self._src = np.insert(self._src, i, [tm.start, tm.end], axis=0)
+        self._ends = np.insert(self._ends, i, [tm.lookup(tm.start), tm.lookup(tm.end)], axis=0)
+        self._tgt = np.insert(self._tgt, i, self._extent(tm), axis=0)
+        self._pending = np.insert(self._pending, i, 0.0)
+
+    def __delitem__(self, key):
+        i = self._row(key)
+        self._key_list.pop(i)
+        self._maps.pop(i)
+        self._src = np.delete(self._src, i, axis=0)
+        self._ends = np.delete(self._ends, i, axis=0)
+        self._tgt = np.delete(self._tgt, i, axis=0)
+        self._pending = np.delete(self._pending, i)
+
+    def covering(self, src_time):
+        #rows (in key order) of the passes whose src interval includes src_time
+        return np.flatnonzero((self._src[:, 0] <= src_time) & (src_time <= self._src[:, 1]))
+
+    def key_at(self, row):
+        return self._key_list[row]
+
+    def lookup_all(self, src_times):
+        #every (src time, pass) pair where the pass covers the src time, for sorted src_times.
+        #returns (index into src_times, row, tgt time), the tgt time is -1 where the pass is unmapped.
+        n_rows = len(self)
+        if n_rows == 0 or len(src_times) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+        maps = [self._flush(i) for i in range(n_rows)]
+        lo = np.searchsorted(src_times, self._src[:, 0], side='left')
+        hi = np.searchsorted(src_times, self._src[:, 1], side='right')
+        counts = np.maximum(hi - lo, 0)
+        rows = np.repeat(np.arange(n_rows), counts)
+        idx = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        times = src_times[idx]
+
+        #the piece of each pair: sort the breakpoints of all passes and the pairs together by (row, time),
+        #breakpoints first on ties, and take the last breakpoint before each pair.
+        bp_rows = np.repeat(np.arange(n_rows), [len(tm.src) for tm in maps])
+        bp_src = np.concatenate([tm.src for tm in maps])
+        bp_offset = np.concatenate([tm.offset for tm in maps])
+        is_pair = np.r_[np.zeros(len(bp_src)), np.ones(len(times))]
+        order = np.lexsort((is_pair, np.r_[bp_src, times], np.r_[bp_rows, rows]))
+        last_bp = np.maximum.accumulate(np.where(order < len(bp_src), order, -1))
+        pairs = order >= len(bp_src)
+        piece = np.empty(len(times), dtype=np.intp)
+        piece[order[pairs] - len(bp_src)] = last_bp[pairs]
+
+        tgt = times + bp_offset[piece]
+        return idx, rows, np.where(np.isnan(tgt), -1.0, tgt)
+
+    def map_at(self, row):
+        return self._flush(row)
+
+    @staticmethod
+    def _agree(lo, hi):
+        #lo starts first. True if the passes touch or overlap in src and map the shared part, end points included, the same way.
+        end = min(lo.end, hi.end)
+        if hi.start > end:
+            return False
+        a, b = lo.slice(hi.start, end), hi.slice(hi.start, end)
+        return np.array_equal(a.src, b.src) and np.array_equal(a.offset, b.offset, equal_nan=True)
+
+    @staticmethod
+    def _merge(lo, hi):
+        #one pass that maps like both (they must _agree): lo before hi starts, hi, then what is left of lo after it.
+        before = lo.src < hi.start
+        src, offset = [lo.src[before], hi.src], [lo.offset[before], hi.offset]
+        if lo.end > hi.end:
+            tail = lo.slice(hi.end, lo.end)
+            src.append(tail.src)
+            offset.append(tail.offset)
+        tm = TimeMap.__new__(TimeMap)
+        tm.src, tm.offset, tm.end = np.concatenate(src), np.concatenate(offset), max(lo.end, hi.end)
+        tm._normalize()
+        return tm
+
+    def compact(self):
+        #merge passes that continue each other (one ends where the next starts, at the same tgt time) or that repeat
+        #part of another one, until no two passes can be merged. every src time is mapped to the same tgt times as before,
+        #only a point two passes shared is now in one pass. returns how many entries were removed.
+        maps = sorted((self._flush(i) for i in range(len(self))), key=lambda tm: tm.start)
+        n_before = len(maps)
+        merged = True
+        while merged:
+            merged = False
+            i = 0
+            while i < len(maps):
+                j = i + 1
+                while j < len(maps) and maps[j].start <= maps[i].end:
+                    if self._agree(maps[i], maps[j]):
+                        maps[i] = self._merge(maps[i], maps.pop(j))
+                        merged = True
+                    else:
+                        j += 1
+                i += 1
+        if len(maps) == n_before or len({tm.key for tm in maps}) < len(maps):
+            return 0
+        self._rebuild({tm.key: tm for tm in maps})
+        return n_before - len(self)
+
+    def extend(self, maps):
+        #self[tm.key] = tm for every map in order, with one sort instead of an insert per map
+        entries = {key: self._flush(i) for i, key in enumerate(self._key_list)}
+        entries.update((tm.key, tm) for tm in maps)
+        self._rebuild(entries)
+
+    def _rebuild(self, entries):
+        #the rows for a {key: TimeMap} dict, nothing pending
+        self._key_list = sorted(entries)
+        self._maps = [entries[key] for key in self._key_list]
+        self._src = np.array([[tm.start, tm.end] for tm in self._maps]).reshape(-1, 2)
+        self._ends = np.array([[tm.lookup(tm.start), tm.lookup(tm.end)] for tm in self._maps]).reshape(-1, 2)
+        self._tgt = np.array([self._extent(tm) for tm in self._maps]).reshape(-1, 2)
+        self._pending = np.zeros(len(self._maps))
+
+    def touch(self, tm):
+        #a pass was edited directly (go_back inside an old pass). refresh its row, the key stays as it was.
+        i = next(i for i, m in enumerate(self._maps) if m is tm)
+        self._ends[i] = [tm.lookup(tm.start), tm.lookup(tm.end)]
+        self._tgt[i] = self._extent(tm)
+
+    def shift_after(self, tgt_time, delta):
+        #TimeMap.shift_after on every pass. shifted passes are re-keyed since the key is their tgt interval.
+        if len(self) == 0:
+            return
+        tgt_lo = self._tgt[:, 0] + self._pending
+        tgt_hi = self._tgt[:, 1] + self._pending
+        whole = tgt_lo >= tgt_time
+        straddle = np.flatnonzero(~whole & (tgt_hi >= tgt_time))
+        moved = whole.copy()
+
+        self._pending[whole] += delta
+        for i in straddle:
+            tm = self._flush(i)
+            if tm.shift_after(tgt_time, delta):
+                self._ends[i] = [tm.lookup(tm.start), tm.lookup(tm.end)]
+                self._tgt[i] = self._extent(tm)
+                moved[i] = True
+        if not np.any(moved):
+            return
+
+        moved = np.flatnonzero(moved)
+        live = np.where(self._ends[moved] == -1, -1, self._ends[moved] + self._pending[moved, None])
+        keys = self._key_list
+        for i, key in zip(moved, live.tolist()):
+            keys[i] = tuple(key)
+        #the passes after tgt_time moved by the same delta, which keeps them in order. only a straddling pass or a
+        #negative delta can break it, so compare the rewritten keys with their neighbours before sorting.
+        if not any(keys[i - 1] > keys[i] for i in np.union1d(moved, moved + 1) if 0 < i < len(keys)):
+            return
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._key_list = [keys[i] for i in order]
+        self._maps = [self._maps[i] for i in order]
+        self._src, self._ends, self._tgt, self._pending = self._src[order], self._ends[order], self._tgt[order], self._pending[order]
+
+
+#tgt onsets are kept exactly, in float64 on a grid of ONSET_GRID seconds, and rounded to float32 once when read.
+#every float32 onset from 2 ms up is on the grid and shifts are rounded to it, so sums of onsets and shifts are exact
+#(below 2**21 s) and an onset does not depend on how its shifts were grouped, i.e. on when the target was read.
+ONSET_GRID = 2.0 ** -32
+
+
+def on_grid(t):
+    #t (seconds, scalar or array) rounded to ONSET_GRID, as float64
+    return np.round(np.asarray(t, dtype=np.float64) / ONSET_GRID) * ONSET_GRID
+
+
+class TargetNotes(Journaled):
+    """Target note array with deferred edits.
+
+    Inserted notes are buffered in `pending`, deleted notes are tombstoned in `alive` and
+    shifts are applied in place, so an edit never concatenates or sorts. The single
+    concatenate + sort happens in materialize(), which is what lowlvl.tgt_na returns, and
+    gives the same array as sorting after every edit. Notes are addressed by a handle
+    (k, i): row i of the base (k=-1) or of the k-th pending block.
+
+    Every note also has its exact onset (ONSET_GRID), in _exact for the base and in
+    _pending_exact for the pending blocks; the onset_sec field is that onset rounded to
+    float32. Rows are ordered by exact onset, which keeps them ordered by onset_sec.
+
+    Lookups by pitch go through a pitch -> base rows index (rows in onset order). Shifts
+    and tombstones keep it valid, so it is only rebuilt after a merge.
+
+    Shifts of the base are lazy: since a positive shift moves a suffix of the (sorted) base,
+    it only adds its delta to the cumulative offsets of the breakpoints at or after its first
+    row (_bp, _cum: rows _bp[j] up to _bp[j+1] are _cum[j] later than _exact says). A shift is
+    a binary search for the first shifted row, each probe one searchsorted over _bp and one
+    add, so O(log n log k) for k breakpoints, plus an O(k) vectorized update of _cum. Reads
+    (_onsets) add the offsets the same way, and the next merge folds them into the base in
+    one O(n) pass. Pending notes are few and are shifted in place.
+
+    fork() shares the base between the two copies and marks it read-only. Whichever one
+    writes to it first takes its own copy (own()), so a fork that is only added to, deleted
+    from or shifted never copies the base.
+
+    Inside a transaction every edit records its inverse (Journaled): the pending block it
+    added, the rows it tombstoned, the values it overwrote. A merge builds new arrays, so
+    it only records the ones it replaced.
+    """
+    def __init__(self, notes):
+        self.base = notes
+        self._exact = on_grid(notes['onset_sec'])
+        if not np.array_equal(self._exact.astype(np.float32), notes['onset_sec']): #only onsets below 2 ms can move
+            self.base = notes.copy()
+            self.base['onset_sec'] = self._exact
+        self.alive = None       #bool mask over base, None when nothing is deleted
+        self.pending = []       #inserted note blocks, not merged yet
+        self._pending_exact = []
+        self.monotone = True    #base onsets are non decreasing (only a negative shift breaks this)
+        self._by_pitch = None   #pitch -> base rows, built on first use
+        self._bp = np.zeros(0, dtype=np.intp) #first base row of each lazy offset, sorted
+        self._cum = np.zeros(0)               #lazy offset from that row on (until the next breakpoint)
+
+    def __len__(self):
+        n_base = len(self.base) if self.alive is None else int(self.alive.sum())
+        return n_base + sum(len(block) for block in self.pending)
+
+    def fork(self):
+        self.base.flags.writeable = False
+        self._exact.flags.writeable = False
+        twin = copy.copy(self)
+        twin.alive = None if self.alive is None else self.alive.copy()
+        twin.pending = [block.copy() for block in self.pending] #small, and shifted in place
+        twin._pending_exact = [exact.copy() for exact in self._pending_exact]
+        return twin
+
+    def own(self):
+        #copy the base if it is still shared with a fork, before writing to it
+        if not self.base.flags.writeable:
+            base, exact = self.base, self._exact
+            self.base, self._exact = self.base.copy(), self._exact.copy()
+            def undo():
+                self.base, self._exact = base, exact
+            self._record(undo)
+
+    def _write(self, column, rows, values):
+        #column[rows] = values (column is an array or a field view of one), recording the old values
+        old = column[rows]
+        column[rows] = values
+        self._record(lambda: column.__setitem__(rows, old))
+
+    def _keep(self):
+        #record the arrays and lists that a merge is about to replace
+        base, by_pitch = self.base, self._by_pitch
+        state = (self._exact, self.alive, self.pending, self._pending_exact, self.monotone, self._bp, self._cum)
+        def undo():
+            self._exact, self.alive, self.pending, self._pending_exact, self.monotone, self._bp, self._cum = state
+            if self.base is not base: #the pitch index stays valid as long as the base is the same
+                self.base, self._by_pitch = base, by_pitch
+        self._record(undo)
+
+    def _lazy(self, rows):
+        #lazy offset of base rows (an index array)
+        seg = np.searchsorted(self._bp, rows, side='right') - 1
+        return np.where(seg >= 0, self._cum[seg], 0.0)
+
+    def _onsets(self, rows):
+        #onsets of the base rows (an index array or slice), with the lazy offsets applied
+        if not len(self._bp):
+            return self.base['onset_sec'][rows]
+        index = np.arange(*rows.indices(len(self.base))) if isinstance(rows, slice) else np.asarray(rows)
+        return (self._exact[rows] + self._lazy(index)).astype(np.float32)
+
+    def _onset(self, row):
+        #_onsets of one row
+        j = np.searchsorted(self._bp, row, side='right') - 1
+        return np.float32(self._exact[row] + self._cum[j]) if j >= 0 else self.base['onset_sec'][row]
+
+    def _fold_late(self):
+        if len(self._bp):
+            self._keep()
+            counts = np.diff(np.r_[0, self._bp, len(self.base)])
+            exact = self._exact + np.repeat(np.r_[0.0, self._cum], counts)
+            if self.journal or not self.base.flags.writeable:
+                self.base = self.base.copy() #the old base is kept for an undo, or shared with a fork
+            self.base['onset_sec'] = exact
+            self._exact = exact
+            self._bp, self._cum = self._bp[:0], self._cum[:0]
+
+    def _first_at_or_after(self, t):
+        #first base row whose onset is >= t (searchsorted 'left' over the shifted onsets)
+        if not len(self._bp):
+            onsets = self.base['onset_sec'] #t compared in float32, as the scalar probes below compare it
+            return int(np.searchsorted(onsets, onsets.dtype.type(t), side='left'))
+        lo, hi = 0, len(self.base)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._onset(mid) >= t:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def materialize(self):
+        self._fold_late()
+        if self.alive is not None or len(self.pending):
+            self._keep()
+        if self.alive is not None:
+            self.base, self._exact = self.base[self.alive], self._exact[self.alive]
+            self.alive = None
+            self._by_pitch = None
+        if len(self.pending):
+            base = np.concatenate([self.base] + self.pending)
+            exact = np.concatenate([self._exact] + self._pending_exact)
+            #by exact onset, ties as sort(order='onset_sec') breaks them
+            order = np.argsort(base, order='onset_sec', kind='stable')
+            order = order[np.argsort(exact[order], kind='stable')]
+            self.base, self._exact = base[order], exact[order]
+            self.pending, self._pending_exact = [], []
+            self.monotone = True
+            self._by_pitch = None
+        return self.base
+
+    def keep(self, mask):
+        #drop the merged notes mask does not select, keeping the exact onsets of the others
+        self.materialize()
+        self._keep()
+        self.base, self._exact = self.base[mask], self._exact[mask]
+        self._by_pitch = None
+
+    def pitch_rows(self, pitch):
+        #base rows of this pitch in onset order, deleted ones included
+        if self._by_pitch is None:
+            order = np.argsort(self.base['pitch'], kind='stable')
+            pitches = self.base['pitch'][order]
+            starts = np.flatnonzero(np.diff(pitches)) + 1
+            self._by_pitch = {int(rows_pitch[0]): rows for rows_pitch, rows in
+                              zip(np.split(pitches, starts), np.split(order, starts)) if len(rows)}
+        return self._by_pitch.get(int(pitch), np.zeros(0, dtype=np.intp))
+
+    def _pitch_rows_between(self, pitch, lo, hi):
+        #alive base rows of this pitch with lo <= onset <= hi, by binary search over that pitch's onsets
+        rows = self.pitch_rows(pitch)
+        onsets = self._onsets(rows)
+        rows = rows[np.searchsorted(onsets, lo, side='left'):np.searchsorted(onsets, hi, side='right')]
+        if self.alive is not None:
+            rows = rows[self.alive[rows]]
+        return rows
+
+    def _nearest_onset(self, t, last):
+        #value of the onset closest to t over the merged notes. on a tie the earlier (or with last, the later)
+        #one wins, as argmin (or the last index of the min) over the merged array did.
+        n, options = len(self.base), []
+        i = self._first_at_or_after(t)
+        left, right = i - 1, i
+        if self.alive is not None:
+            while left >= 0 and not self.alive[left]:
+                left -= 1
+            while right < n and not self.alive[right]:
+                right += 1
+        if left >= 0:
+            options.append(self._onsets(slice(left, left + 1)))
+        if right < n:
+            options.append(self._onsets(slice(right, right + 1)))
+        options = np.concatenate(options + [block['onset_sec'] for block in self.pending] + [self.base['onset_sec'][:0]])
+        if len(options) == 0:
+            return None
+        dist = np.fabs(options - t)
+        closest = options[dist == dist.min()]
+        return closest.max() if last else closest.min()
+
+    def rows(self, handle):
+        #the array holding the note and its index in it, for in place edits
+        k, i = handle
+        return (self.base if k < 0 else self.pending[k]), i
+
+    def insert(self, notes):
+        exact = on_grid(notes['onset_sec'])
+        notes['onset_sec'] = exact
+        self.pending.append(notes)
+        self._pending_exact.append(exact)
+        def undo():
+            self.pending.pop()
+            self._pending_exact.pop()
+        self._record(undo)
+
+    def add_duration(self, handle, delta):
+        notes, i = self.rows(handle)
+        if notes is self.base:
+            self.own()
+            notes = self.base
+        self._write(notes['duration_sec'], i, notes['duration_sec'][i] + delta)
+
+    def delete(self, onset, pitch):
+        #every note with this onset and pitch, as the eager filter did
+        if self.monotone:
+            hit = self._pitch_rows_between(pitch, onset, onset)
+        else:
+            hit = np.flatnonzero((self.base['onset_sec'] == onset) & (self.base['pitch'] == pitch))
+        if len(hit):
+            if self.alive is None:
+                self.alive = np.ones(len(self.base), dtype=bool)
+                self._record(lambda: setattr(self, 'alive', None))
+            self._write(self.alive, hit, False)
+        if any(np.any((block['onset_sec'] == onset) & (block['pitch'] == pitch)) for block in self.pending):
+            self._keep()
+            kept = [~((block['onset_sec'] == onset) & (block['pitch'] == pitch)) for block in self.pending]
+            self.pending = [block[k] for block, k in zip(self.pending, kept)]
+            self._pending_exact = [exact[k] for exact, k in zip(self._pending_exact, kept)]
+
+    def shift(self, tgt_time, delta):
+        #every note starting at or after tgt_time moves by delta (rounded to ONSET_GRID).
+        delta = float(on_grid(delta))
+        if delta < 0:
+            #the shifted notes can now come before others. the eager version sorted before shifting, so merge first.
+            self.materialize()
+            if self.monotone:
+                self.monotone = False
+                self._record(lambda: setattr(self, 'monotone', True))
+        if self.monotone:
+            first = self._first_at_or_after(tgt_time)
+            if first < len(self.base):
+                bp, cum = self._bp, self._cum
+                j = int(np.searchsorted(bp, first))
+                if j == len(bp) or bp[j] != first:
+                    bp, cum = np.insert(bp, j, first), np.insert(cum, j, cum[j - 1] if j else 0.0)
+                old = (self._bp, self._cum)
+                def undo():
+                    self._bp, self._cum = old
+                self._record(undo)
+                self._bp, self._cum = bp, np.concatenate((cum[:j], cum[j:] + delta))
+            blocks = zip(self.pending, self._pending_exact)
+        else:
+            self.own()
+            blocks = zip([self.base] + self.pending, [self._exact] + self._pending_exact)
+        for block, exact in blocks:
+            rows = np.flatnonzero(block['onset_sec'] >= tgt_time)
+            self._write(exact, rows, exact[rows] + delta)
+            self._write(block['onset_sec'], rows, exact[rows])
+
+    def find(self, time_in_tgtna, window, pitch, src_time):
+        #note of this pitch within window of time_in_tgtna that is closest to src_time: (handle, onset) or (None, None).
+        #the window bounds snap to the nearest onsets, exactly as the argmin over the merged array did.
+        if not self.monotone:
+            return self._scan(time_in_tgtna, window, pitch, src_time)
+
+        if len(self.pending) > 1:
+            #one block to scan. handles are only used right after a find, so renumbering them is fine.
+            self._keep()
+            self.pending, self._pending_exact = [np.concatenate(self.pending)], [np.concatenate(self._pending_exact)]
+
+        lo = self._nearest_onset(time_in_tgtna - window, last=False)
+        hi = self._nearest_onset(time_in_tgtna + window, last=True)
+        if lo is None:
+            return None, None
+
+        in_base = self._pitch_rows_between(pitch, lo, hi)
+        handles = [(-1, idx) for idx in in_base]
+        candidates = [self.base[in_base]]
+        candidates[0]['onset_sec'] = self._onsets(in_base)
+        for k, block in enumerate(self.pending):
+            in_block = np.flatnonzero((block['onset_sec'] >= lo) & (block['onset_sec'] <= hi) & (block['pitch'] == pitch))
+            handles.extend((k, idx) for idx in in_block)
+            candidates.append(block[in_block])
+        if len(handles) == 0:
+            return None, None
+
+        #the first of the closest ones in merged order
+        candidates = np.concatenate(candidates)
+        order = np.argsort(candidates, order='onset_sec', kind='stable')
+        dist = np.fabs(candidates['onset_sec'][order] - src_time)
+        best = order[dist.argmin()]
+        return handles[best], candidates['onset_sec'][best]
+
+    def _scan(self, time_in_tgtna, window, pitch, src_time):
+        #index based search over the merged array, for when it is not ordered by onset
+        notes = self.materialize()
+        if len(notes) == 0:
+            return None, None
+        lowerbound = np.fabs(np.array(notes['onset_sec'] - (time_in_tgtna - window))).argmin()
+        dist_from_upperbound = np.fabs(np.array(notes['onset_sec'] - (time_in_tgtna + window)))
+        upperbound = np.where(dist_from_upperbound == dist_from_upperbound.min())[0][-1]
+
+        note_options = [(notes['onset_sec'][i], i) for i in range(lowerbound, upperbound + 1) if notes['pitch'][i] == pitch]
+        if len(note_options) == 0:
+            return None, None
+        note_start, note_idx = sorted(note_options, key=lambda x: np.fabs(x[0] - src_time))[0]
+        return (-1, note_idx), note_start
+
+
+class LabelBuffer(Journaled):
+    """Append-only label store.
+
+    Rows are appended to a preallocated buffer that doubles when full, and shifted in place
+    with a mask over the filled part, so a shift is eager and O(labels), unlike the lazy target
+    note shifts. The buffer is only sorted by onset when the labels are
+    read (lowlvl.label_na), and stays sorted until the next append. In a transaction an
+    append is undone by restoring the count, a shift by writing back the shifted onsets.
+    """
+    def __init__(self, dtype, capacity=64):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.count = 0
+        self.sorted = True
+
+    def __len__(self):
+        return self.count
+
+    def fork(self):
+        #shares the buffer until either copy writes to it, as TargetNotes.fork
+        self.buffer.flags.writeable = False
+        return copy.copy(self)
+
+    def _own(self):
+        if not self.buffer.flags.writeable:
+            self.buffer = self.buffer.copy()
+
+    def _keep(self):
+        #record what an edit changes besides the rows it writes: the buffer it may replace, the count and the order
+        state = (self.buffer, self.count, self.sorted)
+        def undo():
+            self.buffer, self.count, self.sorted = state
+        self._record(undo)
+
+    def append(self, rows):
+        self._keep()
+        self._own()
+        needed = self.count + len(rows)
+        if needed > len(self.buffer):
+            grown = np.zeros(max(needed, 2 * len(self.buffer)), dtype=self.buffer.dtype)
+            grown[:self.count] = self.buffer[:self.count]
+            self.buffer = grown
+        self.buffer[self.count:needed] = rows
+        self.count = needed
+        self.sorted = False
+
+    def shift(self, tgt_time, delta):
+        #every label starting at or after tgt_time moves by delta
+        self._keep()
+        self._own()
+        filled = self.buffer[:self.count]
+        rows = np.flatnonzero(filled['onset_sec'] >= tgt_time)
+        old = filled['onset_sec'][rows]
+        filled['onset_sec'][rows] += delta
+        self._record(lambda: filled['onset_sec'].__setitem__(rows, old))
+        if len(rows):
+            self.sorted = False
+
+    def view(self):
+        if not self.sorted:
+            self._keep()
+            self._own()
+        filled = self.buffer[:self.count]
+        if not self.sorted:
+            if self.journal:
+                unsorted = filled.copy()
+                self._record(lambda: filled.__setitem__(slice(None), unsorted))
+            filled.sort(order='onset_sec')
+            self.sorted = True
+        return filled
+
+#midi export. files are written the way PrettyMIDI().write wrote them (its default resolution and tempo, a 4/4
+#timing track, then one piano track per note array), but the note events are sorted and encoded with numpy.
+MIDI_RESOLUTION = 220
+MIDI_TICK_SCALE = 60.0 / (120.0 * MIDI_RESOLUTION) #seconds per tick at 120 bpm
+
+def _seconds_to_ticks(times):
+    #PrettyMIDI.time_to_tick with one tempo. times at or before 0 are tick 0, and the division is done in the
+    #precision of the times (float32 for note arrays), as it is there.
+    return np.where(times > 0, np.round(times / MIDI_TICK_SCALE), 0).astype(np.int64)
+
+def _varlen(values):
+    #midi variable length quantities of values < 2**28: a (n, 4) byte array, of which the first n_bytes are used per row
+    n_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    shifts = 7 * (n_bytes[:, None] - 1 - np.arange(4))
+    out = (values[:, None] >> np.maximum(shifts, 0)) & 0x7f
+    out |= np.where(shifts > 0, 0x80, 0)
+    return out.astype(np.uint8), n_bytes
+
+def _meta(delta, msg_type, **fields):
+    return bytes([delta]) + bytes(mido.MetaMessage(msg_type, **fields).bytes())
+
+def _timing_track():
+    tempo = int(6e7 / (60. / (MIDI_TICK_SCALE * MIDI_RESOLUTION)))
+    return (_meta(0, 'set_tempo', tempo=tempo) + _meta(0, 'time_signature', numerator=4, denominator=4)
+            + _meta(1, 'end_of_track'))
+
+def _note_track(na, channel, name=None):
+    #track data for one piano (program 0) instrument playing the notes of na
+    pitch = np.asarray(na['pitch'], dtype=np.int64)
+    velocity = np.asarray(na['velocity'], dtype=np.int64)
+    if np.any((pitch < 0) | (pitch > 127) | (velocity < 0) | (velocity > 127)):
+        raise ValueError('note pitch and velocity must be in range 0..127')
+    if np.any(na['duration_sec'] < 0):
+        raise ValueError('Note end time must be greater than start time')
+    #a note is a note on and a note on with velocity 0 (the off). events are sorted by tick, then note, then
+    #velocity (so an off comes before an on of the same note), ties kept in note order, as PrettyMIDI sorts them.
+    ticks = np.column_stack((_seconds_to_ticks(na['onset_sec']),
+                             _seconds_to_ticks(na['onset_sec'] + na['duration_sec']))).ravel()
+    notes = np.repeat(pitch, 2)
+    velocities = np.column_stack((velocity, np.zeros_like(velocity))).ravel()
+    order = np.lexsort((velocities, notes, ticks))
+    ticks, notes, velocities = ticks[order], notes[order], velocities[order]
+
+    delta, n_delta = _varlen(np.diff(ticks, prepend=0))
+    events = np.zeros((len(ticks), 7), dtype=np.uint8)
+    events[:, :4] = delta
+    events[:, 4] = 0x90 | channel
+    events[:, 5] = notes
+    events[:, 6] = velocities
+    used = np.ones(events.shape, dtype=bool)
+    used[:, :4] = np.arange(4) < n_delta[:, None]
+    used[1:, 4] = False #running status after the first note on
+
+    head = _meta(0, 'track_name', name=name) if name else b''
+    head += bytes([0, 0xc0 | channel, 0])
+    return head + events[used].tobytes() + _meta(1, 'end_of_track')
+
+def write_midi(path, tracks):
+    #tracks: (name, note array) per instrument, name can be None. channels are given out as PrettyMIDI does (skipping drums).
+    channels = [c for c in range(16) if c != 9]
+    chunks = [_timing_track()] + [_note_track(na, channels[n % len(channels)], name) for n, (name, na) in enumerate(tracks)]
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>Lhhh', 6, 1, len(chunks), MIDI_RESOLUTION))
+        for data in chunks:
+            f.write(b'MTrk' + struct.pack('>L', len(data)) + data)
+
 #Most Likely, ts_annot will not be supported in segmented practice
 class lowlvl:
     def __init__(self, src_na, mode='runthrough', ts_annot=[]):
@@ -89,131 +1121,278 @@ class lowlvl:
 
         start = src_na['onset_sec'][0]
         end = src_na['onset_sec'][-1]+ src_na['duration_sec'][-1]
-        self.time_from = np.linspace(start, end, int(math.ceil(end)-math.ceil(start))*40) #not sure of resolution..
+        #src -> tgt warping path. Breakpoints are only added where edits happen (see TimeMap).
         if self.mode == 'runthrough':
-            self.time_to = self.time_from.copy()
+            self.time_map = TimeMap(start, end)
         elif self.mode == 'segmented':
-            self.time_to = np.full_like(self.time_from, -1) 
+            self.time_map = TimeMap(start, end, offset=np.nan)
 
-        self.repeat_tracker = {} #dictionary to hold the time_from -> time_to mappings for performance regions that will be removed
-                                 #the format is: (interval for tgt time region) -> ([target time points], [src time points])
+        self.repeat_tracker = RepeatTable() #dictionary to hold the src -> tgt mappings for performance regions that will be removed
+                                 #the format is: (interval for tgt time region) -> TimeMap over the repeated src interval
         self.ts_annot = ts_annot
 
+        src_na = self._intern_ids(src_na)
         self.onsets = src_na['onset_sec']
         self.src_na = src_na
+        self.events = EventIndex(self.onsets) #chords of the source, for the 'n events back' / 'next chord' queries
+        #edits to the target are deferred and merged when tgt_na is read (see TargetNotes)
         if self.mode == 'runthrough':
-            self.tgt_na = copy.deepcopy(self.src_na)
+            self.tgt_notes = TargetNotes(copy.deepcopy(self.src_na))
         elif self.mode == 'segmented':
-            self.tgt_na = np.zeros(0, dtype=regular_na_fields)
+            self.tgt_notes = TargetNotes(np.zeros(0, dtype=self.src_na.dtype))
  
-        self.label_na = np.zeros(0, dtype=label_na_fields)
+        self.labels = LabelBuffer(label_na_fields) #read through label_na, which sorts on demand
+        self.label_vocab = LabelVocab()
+        self._journal = [] #undo steps of the open transactions, innermost last (see begin)
+        self._attach_journal()
 
         #self.time_res = 0.05 #mostly used for the time_offset calculation.. let's see.
         return
 
-    def _apply_warping_path_offsets(self, tgt_time_to_apply_offset, offset):
-        # Note that could change the keys of self.repeat, since the key was the time_to value..
+    def _attach_journal(self):
+        for part in (self.tgt_notes, self.labels, self.label_vocab):
+            part.journal = self._journal
 
+    def _record(self, undo):
+        if self._journal:
+            self._journal[-1].append(undo)
+
+    def _record_paths(self):
+        #an edit is about to move the warping paths. they are a few breakpoints per edit, so their entries are saved.
+        if not self._journal:
+            return
+        time_map, time_map_state, repeats = self.time_map, self.time_map.state(), self.repeat_tracker.state()
+        def undo():
+            self.time_map = time_map
+            time_map.restore(time_map_state)
+            self.repeat_tracker.restore(repeats)
+        self._record(undo)
+
+    def fork(self):
+        #a copy of this tracker, with the edits made so far, for making several variants of one performance.
+        #the source arrays, ids and event index are shared. the target notes and labels are shared until either
+        #side writes to them, and the warping paths (a few breakpoints per edit) are copied.
+        if self._journal:
+            raise RuntimeError('fork inside a transaction')
+        twin = copy.copy(self)
+        twin.time_map = self.time_map.copy()
+        twin.repeat_tracker = copy.deepcopy(self.repeat_tracker)
+        twin.tgt_notes = self.tgt_notes.fork()
+        twin.labels = self.labels.fork()
+        twin.label_vocab = copy.deepcopy(self.label_vocab)
+        twin._journal = []
+        twin._attach_journal()
+        return twin
+
+    def begin(self):
+        #open a transaction: the edits until the matching commit() can all be undone with rollback().
+        #transactions nest. nothing is copied here: every edit records its own inverse (the pending block it added,
+        #the rows it tombstoned, the values it overwrote, the warping path entries it moved), and rollback()
+        #replays them backwards.
+        self._journal.append([])
+
+    def commit(self):
+        #keep the edits of the innermost transaction. an enclosing one can still undo them.
+        if not self._journal:
+            raise RuntimeError('commit without begin')
+        undo = self._journal.pop()
+        if self._journal:
+            self._journal[-1].extend(undo)
+
+    def rollback(self):
+        #undo the edits of the innermost transaction
+        if not self._journal:
+            raise RuntimeError('rollback without begin')
+        for undo in reversed(self._journal.pop()):
+            undo()
+
+    def flush(self, src_time=None):
+        #streaming: hand over the part of the target that no later edit can reach, and drop it from the tracker.
+        #the caller promises that every later edit is at src_time or after it (for a rollback, its src_time_to).
+        #returns (tgt notes, labels, (time_from, time_to), repeats) for everything before src_time, the repeats in
+        #get_repeats format. with src_time=None everything is flushed. src_na is the input and is kept whole.
+        if self.mode != 'runthrough':
+            raise RuntimeError('flush is only supported in runthrough mode')
+        if self._journal:
+            raise RuntimeError('flush inside a transaction')
+        if src_time is None:
+            src_time, cut = self.time_map.end, np.inf
+        else:
+            src_time = max(src_time, self.time_map.start)
+            cut = self.time_map.lookup(src_time) - FIND_WINDOW
+
+        #a find at or after src_time snaps the low end of its window to the nearest onset, which can be the last
+        #one before the window, so that note stays.
+        notes = self.tgt_na
+        onsets = notes['onset_sec']
+        if np.isfinite(cut) and np.any(onsets < cut):
+            cut = onsets[onsets < cut].max()
+        done = onsets < cut
+        self.tgt_notes.keep(~done)
+
+        labels = self.label_na
+        labels_done = labels['onset_sec'] < cut
+        flushed_labels = labels[labels_done].copy()
+        self.label_na = labels[~labels_done]
+
+        head = self.time_map.slice(self.time_map.start, src_time)
+        self.time_map = self.time_map.slice(src_time, self.time_map.end)
+
+        repeats = {}
+        for row in np.flatnonzero(self.repeat_tracker._src[:, 1] < src_time)[::-1]:
+            key = self.repeat_tracker.key_at(row)
+            time_from, time_to = self.repeat_tracker[key].knots()
+            repeats[key] = (time_to, time_from)
+            del self.repeat_tracker[key]
+
+        return notes[done], flushed_labels, head.knots(), dict(sorted(repeats.items()))
+
+    def _intern_ids(self, na):
+        #copy of na with the unicode id column replaced by int codes into self.note_ids, so that copying and
+        #sorting notes only moves fixed width rows. note_ids is sorted, so the codes sort like the strings did.
+        #'none' (the id of inserted notes) is always in the table.
+        if 'id' not in na.dtype.names or na.dtype['id'].kind != 'U':
+            self.note_ids = np.array(['none'])
+            self.none_id = 0
+            return na
+        self.note_ids, codes = np.unique(np.append(na['id'], 'none'), return_inverse=True)
+        self.none_id = int(codes[-1])
+        interned = np.empty(len(na), dtype=[(name, '<i4' if name == 'id' else na.dtype[name]) for name in na.dtype.names])
+        for name in na.dtype.names:
+            interned[name] = codes[:-1] if name == 'id' else na[name]
+        return interned
+
+    def resolve_ids(self, na):
+        #copy of a note array (src_na, tgt_na, or a slice of them) with the original id strings, for export.
+        resolved = np.empty(len(na), dtype=[(name, self.note_ids.dtype if name == 'id' else na.dtype[name]) for name in na.dtype.names])
+        for name in na.dtype.names:
+            resolved[name] = self.note_ids[na['id']] if name == 'id' else na[name]
+        return resolved
+
+    @property
+    def tgt_na(self):
+        return self.tgt_notes.materialize()
+
+    @tgt_na.setter
+    def tgt_na(self, notes):
+        tgt_notes = self.tgt_notes
+        self._record(lambda: setattr(self, 'tgt_notes', tgt_notes))
+        self.tgt_notes = TargetNotes(notes)
+        self._attach_journal()
+
+    @property
+    def label_na(self):
+        return self.labels.view()
+
+    @label_na.setter
+    def label_na(self, labels):
+        old_labels = self.labels
+        self._record(lambda: setattr(self, 'labels', old_labels))
+        self.labels = LabelBuffer(labels.dtype, capacity=max(len(labels), 64))
+        self._attach_journal()
+        self.labels.append(labels)
+
+    @property
+    def time_from(self):
+        return self.time_map.knots()[0]
+
+    @property
+    def time_to(self):
+        return self.time_map.knots()[1]
+
+    def _apply_warping_path_offsets(self, tgt_time_to_apply_offset, offset):
         # function meant to handle all offsets applied to the time_tos, whether the main one, or those stored in repeat_tracker.
         # we need to make sure that if an offset is applied, that all time_tos covering points after also get shifted.
-        # find all the points in time_to (whether in repeat_tracker, or in self.time_to, that have
-        
-        #search self.time_to
-        self_time_to_Idxs = np.where(self.time_to >= tgt_time_to_apply_offset)[0] 
-        self.time_to[self_time_to_Idxs] += offset
-
-        #then search all self.repeat_tracker time_to
-        #might cause a problem in case the key,val iteration is by reference.. if we delete the entry in the array maybe it could crash..
-        replacement_entries = {}
-        keys_to_delete = []
-        for key, val in self.repeat_tracker.items():
-            sub_time_to_Idxs = np.where(val[0] >= tgt_time_to_apply_offset)[0]
-            if len(sub_time_to_Idxs) == 0:
-                continue
-
-            keys_to_delete.append(key)
-            val[0][sub_time_to_Idxs] += offset 
-            replacement_entries[(val[0][-1], val[0][0])] = val
-            
-        for key_to_del in keys_to_delete:
-            self.repeat_tracker.pop(key_to_del)
-        
-        for new_key, new_val in replacement_entries.items():
-            self.repeat_tracker[new_key] = new_val
-        
+        self._record_paths()
+        self.time_map.shift_after(tgt_time_to_apply_offset, offset)
+
+        #then all self.repeat_tracker maps. Shifted entries are re-keyed since the key is their tgt interval.
+        self.repeat_tracker.shift_after(tgt_time_to_apply_offset, offset)
 
     def _repeat_tracker_order(self, src_time):
         #how many repeats exist for a src_time, and what is their order.. since the calling function should pass an index along with the src_time..
+        keys_list = list(self.repeat_tracker.keys()) #the table iterates in key order
+        ordered_keys_incl_src = [self.repeat_tracker.key_at(row) for row in self.repeat_tracker.covering(src_time)]
+        return ordered_keys_incl_src, keys_list   #return sorted list of all the keys which include src, and all the sorted keys. 
+        #the sorted keys (meaning that they are sorted by tgt_na start time), would help us determine which repeat pairs need temporal adjustments
 
-        #return all the keys for which a given self.time_from[nearestIdx_src_time] exists.
-        nearestIdx_src_time = np.fabs(self.time_from - src_time).argmin()
-        start_of_timefrom_window = self.time_from[nearestIdx_src_time]
-        
-        sorted_repeat_tracker = dict(sorted(self.repeat_tracker.items()))
+    def _warping_path(self, src_time, repeat_index=0):
+        #the map that resolves src_time for the given pass: the main one for repeat_index 0, else the repeat_index-th repeat covering src_time.
+        if repeat_index == 0:
+            return self.time_map
+        rows_incl_src = self.repeat_tracker.covering(src_time)
 
-        keys_list = list(sorted_repeat_tracker.keys())
-        mapping_list = list(sorted_repeat_tracker.values())
+        #perhaps it is useful to relax the requirement of insertions made in temporal order in runthrough mode
+        if len(rows_incl_src) == 0:
+            return self.time_map
+        return self.repeat_tracker.map_at(rows_incl_src[repeat_index - 1])
 
-        idxs_to_include = [idx for idx, (timeto_sub, timefrom_sub) in enumerate(mapping_list) if start_of_timefrom_window in timefrom_sub]
-       
-        ordered_keys_incl_src = [keys_list[i] for i in idxs_to_include]
-        return ordered_keys_incl_src, keys_list   #return sorted list of all the keys which include src, and all the sorted keys. 
-        #the sorted keys (meaning that they are sorted by tgt_na start time), would help us determine which repeat pairs need temporal adjustments
+    def _tgt_time(self, src_time, repeat_index=0):
+        #-1 if src_time is unmapped in that pass
+        return self._warping_path(src_time, repeat_index).lookup(src_time)
 
     def _create_segmented_practice(self, segments, time_gap=3): 
         #time gap is the gap between inserted segments
         if self.mode != 'segmented':
             return
 
-        for start, end in segments: #these start and end times should be relevant to the src signal
-            new_notes_na = self.get_notes_between(start, end)
-            if len(new_notes_na) == 0:
-                continue
+        #all segments at once: the src note range of each (as get_notes_between), where each one lands in tgt, then
+        #one gather of the notes and one pass over the warping path. these start and end times are src times.
+        onsets = self.src_na['onset_sec'].astype(np.float64)
+        durations = self.src_na['duration_sec'].astype(np.float64)
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2)
+        first = np.searchsorted(onsets, segments[:, 0], side='left')
+        last = np.searchsorted(onsets, segments[:, 1], side='right') - 1
+        first, last = first[last >= first], last[last >= first]
+        if len(first) == 0:
+            return
 
-            #we take for granted that the tgt_na is sorted
-            if len(self.tgt_na) == 0:
-                insertion_offset = 0
-            else:
-                insertion_offset = self.tgt_na[-1]['onset_sec'] + self.tgt_na[-1]['duration_sec'] + time_gap
-            #add a copy of this segment in the target na
-
-            new_notes_start_time = new_notes_na[0]['onset_sec'] #might be slightly different than the given range.
-            new_notes_end_time = new_notes_na[-1]['onset_sec']+new_notes_na[-1]['duration_sec']
-
-            for new_note in new_notes_na: #truncate their start time
-                new_note['onset_sec'] -= new_notes_start_time
-                new_note['onset_sec'] += insertion_offset
-
-            self.tgt_na = np.concatenate((self.tgt_na, new_notes_na))
-            self.tgt_na.sort(order='onset_sec')
-
-            #what are the time_from indexes?
-            nearestIdx_new_notes_start = np.fabs(self.time_from - new_notes_start_time).argmin()
-            nearestIdx_new_notes_end = np.fabs(self.time_from - new_notes_end_time).argmin()
-
-            if not np.all(self.time_to[nearestIdx_new_notes_start:nearestIdx_new_notes_end+1] == -1):
-                #then we need to save the old repeat in the repeats structure:
-                # Use end-1 for the key because the mapping slice [start:end) is exclusive of end,
-                # so time_to[end] may be unmapped (-1). The last mapped point is at end-1.
-                last_mapped_idx = nearestIdx_new_notes_end - 1
-                self.repeat_tracker[(self.time_to[nearestIdx_new_notes_start], self.time_to[last_mapped_idx])] = (self.time_to[nearestIdx_new_notes_start:nearestIdx_new_notes_end].copy(), self.time_from[nearestIdx_new_notes_start:nearestIdx_new_notes_end].copy())
-            
-            #Offset time_to so it maps to where the notes actually land in tgt_na.
-            #Notes were shifted by (-new_notes_start_time + insertion_offset),
-            #so time_to needs the same shift applied to time_from.
-            self.time_to[nearestIdx_new_notes_start:nearestIdx_new_notes_end] = self.time_from[nearestIdx_new_notes_start:nearestIdx_new_notes_end].copy()
-            self.time_to[nearestIdx_new_notes_start:nearestIdx_new_notes_end] += (insertion_offset - new_notes_start_time)
+        start_times = onsets[first] #might be slightly different than the given range.
+        end_times = (self.src_na['onset_sec'][last] + self.src_na['duration_sec'][last]).astype(np.float64) #in the precision of the notes
+
+        #a segment starts time_gap after the end of the last tgt note before it, which is the longest note of the
+        #previous segment's last chord (tgt_na is sorted by onset, then duration), so the offsets are a cumsum.
+        last_chord = np.searchsorted(onsets, onsets[last], side='left')
+        last_duration = np.maximum.reduceat(np.append(durations, 0), np.column_stack((last_chord, last + 1)).ravel())[::2]
+        spans = onsets[last] - start_times + last_duration + time_gap
+        notes = self.tgt_na
+        if len(notes) == 0:
+            insertion_offset = 0.0
+        else:
+            insertion_offset = float(notes[-1]['onset_sec']) + float(notes[-1]['duration_sec']) + time_gap
+        insertion_offsets = insertion_offset + np.concatenate(([0.0], np.cumsum(spans[:-1])))
+
+        #add a copy of every segment in the target na, truncated to start at its insertion offset
+        counts = last - first + 1
+        idx = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        new_notes_na = self.src_na[idx]
+        new_notes_na['onset_sec'] = onsets[idx] + np.repeat(insertion_offsets - start_times, counts)
+        self.tgt_notes.insert(new_notes_na)
+
+        #offset time_to so it maps to where the notes actually land in tgt_na. the parts of earlier passes that a
+        #segment plays again are saved in the repeats structure.
+        self._record_paths()
+        old_passes = self.time_map.paint(start_times, end_times, insertion_offsets - start_times)
+        self.repeat_tracker.extend(tm for tm in old_passes if not np.all(np.isnan(tm.offset)))
+        #practicing overlapping or adjacent segments can leave passes that continue each other. they are kept as
+        #painted (the timemap export writes every one), compact_repeats() merges them on demand.
     
     def _label_note(self, start, end, lowlvl_label, midlvl_label):
-        mid_label_pitch = mid_label_pitch_map[midlvl_label] if midlvl_label in mid_label_pitch_map else DEFAULT_MID
-        low_label_pitch = low_label_pitch_map[lowlvl_label] if lowlvl_label in low_label_pitch_map else DEFAULT_LOW
-
-        #add 2 notes, one mid and one low.
-        new_label = np.array([(start, end-start, mid_label_pitch, LABEL_VELOCITY, midlvl_label, lowlvl_label), 
-                              (start, end-start, low_label_pitch, LABEL_VELOCITY, midlvl_label, lowlvl_label)], dtype=self.label_na.dtype)
-        self.label_na = np.concatenate((new_label, self.label_na))
-        self.label_na.sort(order='onset_sec')
+        #one row per event. the mid and low label notes are made from the codes on export (_expand_labels)
+        new_label = np.array([(start, end-start, self.label_vocab.code(midlvl_label), self.label_vocab.code(lowlvl_label))],
+                             dtype=self.labels.buffer.dtype)
+        self.labels.append(new_label) #sorted when read
         return 
+
+    def _expand_labels(self, labels):
+        #label rows -> label notes, one at the mid level pitch and one at the low level pitch per event.
+        notes = np.zeros(2 * len(labels), dtype=label_note_fields)
+        notes['onset_sec'] = np.repeat(labels['onset_sec'], 2)
+        notes['duration_sec'] = np.repeat(labels['duration_sec'], 2)
+        notes['pitch'][0::2] = self.label_vocab.pitches(mid_label_pitch_map, DEFAULT_MID)[labels['midlvl_label']]
+        notes['pitch'][1::2] = self.label_vocab.pitches(low_label_pitch_map, DEFAULT_LOW)[labels['lowlvl_label']]
+        notes['velocity'] = LABEL_VELOCITY
+        return notes
     
     def _shift_labels(self, src_time, offset, repeat_index=0):
         #shift all labels after time 'time' by offset s
@@ -226,25 +1405,15 @@ class lowlvl:
         #find the correct tgt time given the src_time and repeat_index:
         #then, shift the labels by modifying the time in tgt_na.
 
-        if len(self.label_na) == 0: #if no labels yet, then nothing to shift..
+        if len(self.labels) == 0: #if no labels yet, then nothing to shift..
             return
 
-        ordered_keys_incl_src, ordered_keys_list = self._repeat_tracker_order(src_time)
-
-        #perhaps it is useful to relax the requirement of insertions made in temporal order in runthrough mode
-        if repeat_index == 0 or len(ordered_keys_incl_src) == 0:
-            nearestIdx = np.fabs(self.time_from - src_time).argmin()
-            time_in_tgtna = self.time_to[nearestIdx]
-        else:
-           (time_to_subarray, time_from_subarray) =  self.repeat_tracker[ordered_keys_incl_src[repeat_index - 1]]
-           nearestIdx = np.fabs(time_from_subarray - src_time).argmin()
-           time_in_tgtna = time_to_subarray[nearestIdx]
+        time_in_tgtna = self._tgt_time(src_time, repeat_index)
 
         if time_in_tgtna == -1:
             return
 
-        mask = self.label_na['onset_sec'] >= time_in_tgtna
-        self.label_na['onset_sec'][mask] += offset
+        self.labels.shift(time_in_tgtna, offset)
 
         return
     
@@ -253,101 +1422,76 @@ class lowlvl:
         #TODO: find a calculate ticks option from partitura.. 
         #TODO: from the match file, find what id is placed for notes that are 'extra'
 
-        ordered_keys_incl_src, ordered_keys_list = self._repeat_tracker_order(src_time)
-
-        #perhaps it is useful to relax the requirement of insertions made in temporal order in runthrough mode
-        if repeat_index == 0 or len(ordered_keys_incl_src) == 0:
-            nearestIdx = np.fabs(self.time_from - src_time).argmin()
-            tgt_insertion_time = self.time_to[nearestIdx]
-        else:
-           (time_to_subarray, time_from_subarray) =  self.repeat_tracker[ordered_keys_incl_src[repeat_index - 1]]
-           nearestIdx = np.fabs(time_from_subarray - src_time).argmin()
-           tgt_insertion_time = time_to_subarray[nearestIdx]
+        tgt_insertion_time = self._tgt_time(src_time, repeat_index)
 
         if tgt_insertion_time == -1:
             print('pitch_insert: src_time {:.3f} maps to unmapped region (time_to=-1), skipping'.format(src_time))
             return
         #instead of using 0, we should convert the seconds time to tick time and initialize this properly....
-        new_note = np.array([(tgt_insertion_time, duration, 0, 0, pitch, velocity, 0, 0, 'none')], dtype=self.tgt_na.dtype)
-        self.tgt_na = np.concatenate((self.tgt_na, new_note))
+        new_note = np.array([(tgt_insertion_time, duration, 0, 0, pitch, velocity, 0, 0, self.none_id)], dtype=self.tgt_notes.base.dtype)
+        self.tgt_notes.insert(new_note)
 
-        self.tgt_na.sort(order='onset_sec')
         self._label_note(tgt_insertion_time, tgt_insertion_time+duration, 'pitch_insert', midlvl_label)
         return
     
-    def _find_note_in_tgt(self, src_time, pitch, repeat_index=0):
-
-        ordered_keys_incl_src, ordered_keys_list = self._repeat_tracker_order(src_time)
-
-        if repeat_index == 0 or len(ordered_keys_incl_src) == 0:
-            nearestIdx = np.fabs(self.time_from - src_time).argmin()
-            time_in_tgtna = self.time_to[nearestIdx]
-        else:
-           (time_to_subarray, time_from_subarray) =  self.repeat_tracker[ordered_keys_incl_src[repeat_index - 1]]
-           nearestIdx = np.fabs(time_from_subarray - src_time).argmin()
-           time_in_tgtna = time_to_subarray[nearestIdx]
+    def _locate_note_in_tgt(self, src_time, pitch, repeat_index=0):
+        #same as _find_note_in_tgt, but returns a TargetNotes handle so pending edits don't have to be merged.
+        time_in_tgtna = self._tgt_time(src_time, repeat_index)
 
         if time_in_tgtna == -1:
             print('_find_note_in_tgt: src_time {:.3f} maps to unmapped region (time_to=-1)'.format(src_time))
             return False, None, None
 
-        window = 0.05 #a window 50 ms before and after for trying to find the onset of the pitch in question.
+        window = FIND_WINDOW #a window 50 ms before and after for trying to find the onset of the pitch in question.
 
         #we could evade little time offset problems by:
         #1. setting a tol. window around the src_time (which we do) which we check for all notes of the specified
         # pitch and get the nearest one to the given time.
         #2. find all notes of that pitch in the score and just choose the nearest one within a thresh.
-        lowerbound_in_tgt_na = np.fabs(np.array(self.tgt_na['onset_sec'] - (time_in_tgtna - window))).argmin()
-
-        #upperbound isn't done by a oneliner because we need to return the last min. index, not the first:
-        tgt_onset_dist_from_upperbound_time = np.fabs(np.array(self.tgt_na['onset_sec']  - (time_in_tgtna + window)))
-        upperbound_in_tgt_na = np.where(
-            tgt_onset_dist_from_upperbound_time == tgt_onset_dist_from_upperbound_time.min())[0][-1]
-        #this indexing above should always have a value if the inputs are not empty..
-
-        found = False
-        note_options = []
-
-        #the problem with the lowerbound and upperbound logic is that, in case of chords, there can be several
-        #notes at that time, and argmin will only return the index of the first..
-
-        for i in range(lowerbound_in_tgt_na, upperbound_in_tgt_na+1):
-            #find all notes with the corresponding pitch
-            if self.tgt_na['pitch'][i] == pitch:
-                note_options.append((self.tgt_na['onset_sec'][i], i))
-                found = True
-                
-        if found==False:                   
+        #in case of chords, there can be several notes at the bounds, so all notes at the bounding onsets are considered.
+        handle, note_start = self.tgt_notes.find(time_in_tgtna, window, pitch, src_time)
+
+        if handle is None:
             print('pitch {} not found at time {}'.format(pitch, src_time)) 
             return False, None, None
-        else:
-            #find closest to the src_time from the list. should be at the top
-            note_start, note_idx = sorted(note_options, key=lambda x: np.fabs(x[0] - src_time))[0]
 
-        return found, note_idx, note_start
+        return True, handle, note_start
+
+    def _find_note_in_tgt(self, src_time, pitch, repeat_index=0):
+        #returns the index of the note in tgt_na
+        self.tgt_notes.materialize()
+        found, handle, note_start = self._locate_note_in_tgt(src_time, pitch, repeat_index)
+        if not found:
+            return False, None, None
+        return found, handle[1], note_start
 
     
     def pitch_delete(self, src_time, pitch, midlvl_label, repeat_index=0):
-        found, note_idx, note_start = self._find_note_in_tgt(src_time, pitch, repeat_index)
+        found, handle, note_start = self._locate_note_in_tgt(src_time, pitch, repeat_index)
 
         if not found:
             return
         else:
-            note_end = note_start + self.tgt_na['duration_sec'][note_idx]
-            self.tgt_na = self.tgt_na[~((self.tgt_na['onset_sec'] == self.tgt_na['onset_sec'][note_idx]) & 
-                                        (self.tgt_na['pitch'] == self.tgt_na['pitch'][note_idx]))]
+            notes, note_idx = self.tgt_notes.rows(handle)
+            note_end = note_start + notes['duration_sec'][note_idx]
+            self.tgt_notes.delete(note_start, notes['pitch'][note_idx])
 
             self._label_note(note_start, note_end, 'pitch_delete', midlvl_label)          
         return
     
     #works for shorten note and extend note
     def change_note_offset(self, src_time, pitch, offset_shift, midlvl_label, repeat_index=0):
-        found, note_idx, note_start = self._find_note_in_tgt(src_time, pitch, repeat_index)
+        found, handle, note_start = self._locate_note_in_tgt(src_time, pitch, repeat_index)
         #it should always be found.. unless the note has been deleted in prior processing. 
         if not found:
             return False
-        self.tgt_na['duration_sec'][note_idx] += offset_shift
-        note_end = note_start + self.tgt_na['duration_sec'][note_idx]
+        if handle[0] >= 0:
+            #the duration breaks ties in the sort, so a pending note is merged before it changes, as it was eagerly.
+            self.tgt_notes.materialize()
+            found, handle, note_start = self._locate_note_in_tgt(src_time, pitch, repeat_index)
+        self.tgt_notes.add_duration(handle, offset_shift)
+        notes, note_idx = self.tgt_notes.rows(handle)
+        note_end = note_start + notes['duration_sec'][note_idx]
         self._label_note(note_start, note_end, "change_offset", midlvl_label)
         return True
     
@@ -378,7 +1522,9 @@ class lowlvl:
         
     #    return self._construct_note_na(new_notes)
 
-    def get_notes_between(self, src_time_start, src_time_end):
+    def get_notes_between(self, src_time_start, src_time_end, copy=True):
+        #one contiguous copy of the src notes in [src_time_start, src_time_end], already sorted.
+        #with copy=False a read-only view is returned instead, for callers that don't modify the notes.
         src_onsets = self.src_na['onset_sec']
 
         # First note at or after src_time_start
@@ -387,46 +1533,20 @@ class lowlvl:
         # Last note at or before src_time_end
         src_ending_note_idx = np.searchsorted(src_onsets, src_time_end, side='right') - 1
 
-        if src_starting_note_idx > src_ending_note_idx or src_starting_note_idx >= len(src_onsets):
-            return self._construct_note_na([])
-
-        new_notes = [copy.deepcopy(note) for note in self.src_na[src_starting_note_idx:src_ending_note_idx+1]]
-
-        return self._construct_note_na(new_notes)
+        notes = self.src_na[src_starting_note_idx:max(src_ending_note_idx+1, src_starting_note_idx)]
+        if copy:
+            return notes.copy()
+        notes = notes.view()
+        notes.flags.writeable = False
+        return notes
 
     def get_notes(self, src_time, num_events_back):
-        CHORD_TOLERANCE = 0.030  # 30ms, tweak to taste
         #from src_time, go backwards for num_events_back (a chord is considered as one score event, for ex.)
         #if there are not enough backwards notes, stop.
-        #num events back 0 is a repeat of the current note.
-        src_onsets = self.src_na['onset_sec']
-        nearest_src_idx = np.fabs(src_onsets - src_time).argmin()
-
-        back_src_idx = nearest_src_idx
-        curr_event_time = self.src_na['onset_sec'][back_src_idx]
-        notes = [copy.deepcopy(self.src_na[back_src_idx])]
-
-        # First, collect all notes at the current event time
-        while back_src_idx > 0 and abs(self.src_na['onset_sec'][back_src_idx - 1] - curr_event_time) <= CHORD_TOLERANCE:
-            notes.append(copy.deepcopy(self.src_na[back_src_idx - 1]))
-            back_src_idx -= 1
-
-        while num_events_back:
-            if back_src_idx == 0:
-                return back_src_idx, self._construct_note_na(notes)
-
-            # Move to the previous event
-            num_events_back -= 1
-            curr_event_time = self.src_na['onset_sec'][back_src_idx - 1]
-            notes.append(copy.deepcopy(self.src_na[back_src_idx - 1]))
-            back_src_idx -= 1
-
-            # Collect remaining notes in this chord
-            while back_src_idx > 0 and abs(self.src_na['onset_sec'][back_src_idx - 1] - curr_event_time) <= CHORD_TOLERANCE:
-                notes.append(copy.deepcopy(self.src_na[back_src_idx - 1]))
-                back_src_idx -= 1
-
-        return back_src_idx, self._construct_note_na(notes)
+        #num events back 0 is a repeat of the current event.
+        nearest_src_idx = self.events.nearest(src_time)
+        back_src_idx, end_src_idx = self.events.events_back(nearest_src_idx, num_events_back)
+        return back_src_idx, self.src_na[back_src_idx:end_src_idx].copy()
 
 
     #Since the notes themselves are passed on by the caller, the only purpose of go_back
@@ -454,83 +1574,44 @@ class lowlvl:
         notes = self.get_notes_between(src_time_to, src_time_from)
 
         # Zero onsets and place at target time
-        first_onset = notes['onset_sec'][0]
-        for note in notes:
-            note['onset_sec'] -= first_onset
-
-        ordered_keys_incl_src, ordered_keys_list = self._repeat_tracker_order(src_time_from)
-
-        if repeat_index == 0 or len(ordered_keys_incl_src) == 0:
-            nearestIdx_src_time_from = np.fabs(self.time_from - src_time_from).argmin()
-            nearestIdx_src_time_to = np.fabs(self.time_from - src_time_to).argmin()
-
-            tgt_time_from = self.time_to[nearestIdx_src_time_from]
-            tgt_time_to = self.time_to[nearestIdx_src_time_to]
-            time_in_tgtna = self.time_to[nearestIdx_src_time_from]
-
-            time_to_range = self.time_to[nearestIdx_src_time_to:nearestIdx_src_time_from+1].copy()
-            time_from_range = self.time_from[nearestIdx_src_time_to:nearestIdx_src_time_from+1].copy()
-
-            #since these views are by reference.. this is the easiest way
-            view_to_update = self.time_to[nearestIdx_src_time_to:nearestIdx_src_time_from+1]
-            
-            #save the initial src indexes to recover their ground truths
-            #the key should be unique, so in theory this shouldn't crash
-            #self.repeat_tracker[(tgt_time_to, tgt_time_from)] = (self.time_to[nearestIdx_src_time_to:nearestIdx_src_time_from+1],
-            #                      self.time_from[nearestIdx_src_time_to:nearestIdx_src_time_from+1])
-
-        else:
-           (time_to_subarray, time_from_subarray) =  self.repeat_tracker[ordered_keys_incl_src[repeat_index - 1]]
-           nearestIdx_src_time_from = np.fabs(time_from_subarray - src_time_from).argmin()
-           nearestIdx_src_time_to = np.fabs(time_from_subarray - src_time_to).argmin()
-
-           tgt_time_from = time_to_subarray[nearestIdx_src_time_from] 
-           tgt_time_to = time_to_subarray[nearestIdx_src_time_to]
+        notes['onset_sec'] -= notes['onset_sec'][0]
 
-           time_in_tgtna = time_to_subarray[nearestIdx_src_time_from]
+        #the main warping path, or the repeat we are rolling back in.
+        warping_path = self._warping_path(src_time_from, repeat_index)
 
-           time_to_range = time_to_subarray[nearestIdx_src_time_to:nearestIdx_src_time_from+1].copy()
-           time_from_range = time_from_subarray[nearestIdx_src_time_to:nearestIdx_src_time_from+1].copy()
-
-           #since these views are by reference.. this is the easiest way
-           view_to_update = time_to_subarray[nearestIdx_src_time_to:nearestIdx_src_time_from+1]
-        
-           #save the initial src indexes to recover their ground truths
-           #the key should be unique, so in theory this shouldn't crash
-           #self.repeat_tracker[(tgt_time_to, tgt_time_from)] = (time_to_subarray[nearestIdx_src_time_to:nearestIdx_src_time_from+1],
-           #                       time_from_subarray[nearestIdx_src_time_to:nearestIdx_src_time_from+1])
+        tgt_time_from = warping_path.lookup(src_time_from)
+        tgt_time_to = warping_path.lookup(src_time_to)
+        time_in_tgtna = tgt_time_from
 
         if tgt_time_from == -1 or tgt_time_to == -1:
             print('go_back: src_time_to={:.3f} or src_time_from={:.3f} maps to unmapped region (time_to=-1), skipping'.format(src_time_to, src_time_from))
             return
 
+        #save the old pass to recover its ground truth. it is taken before the offset since it lies before tgt_time_from
+        old_pass = warping_path.slice(src_time_to, src_time_from)
+
         tgt_time_to_apply_offset = tgt_time_from
         self._apply_warping_path_offsets(tgt_time_to_apply_offset, src_time_from - src_time_to) #we use src because we are offsetting to place the new repeat..
-        self.repeat_tracker[(tgt_time_to, tgt_time_from)] = (time_to_range, time_from_range)
-        #change the grid so that src_time_to (where we want to return to) now points to our new
-        #starting point (which is src_time_from)
-
-        #the offset is tgt_time_from - tgt_time_to
-        #nearestIdx_src_time_to:nearestIdx_src_time_from+1
-        view_to_update[0:-1] += (tgt_time_from - tgt_time_to)
+        self._record_paths()
+        self.repeat_tracker[old_pass.key] = old_pass
+        #change the map so that src_time_to (where we want to return to) now points to our new
+        #starting point (which is src_time_from). the offset is tgt_time_from - tgt_time_to
+        warping_path.add(src_time_to, src_time_from, tgt_time_from - tgt_time_to)
+        if warping_path is not self.time_map:
+            self.repeat_tracker.touch(warping_path)
         
-        #self.time_to[nearestIdx_src_time_to:] += (tgt_time_from - tgt_time_to)
         #we apply the warping path offset at the tgt_time_to_apply_offset ( nearestIdx_src_time_to) skip the old execution, so we offset by the time difference between tgt_time_from and tgt_time_to. Previously we had the offset as src_time_to(the earlier point)  and src_time_from (the later point). This would hold if the notes array is exactly the source notes with no modifications or delays or anything. what happens to the labels in that case? they should be aligned with tgt_na they should accomodate for the same shift applied. and in theory this has already been done earlier in the function
 
-        mask = self.tgt_na['onset_sec'] >= time_in_tgtna
-        self.tgt_na['onset_sec'][mask] += (src_time_from - src_time_to)
+        self.tgt_notes.shift(time_in_tgtna, src_time_from - src_time_to)
 
         self._shift_labels(src_time_from, (src_time_from - src_time_to), repeat_index)
         self._label_note(time_in_tgtna, time_in_tgtna + (src_time_from - src_time_to), "go_back", midlvl_label)
 
           
-        #append the notes at the correct time and sort
-        for note in notes:
-            note['onset_sec'] += time_in_tgtna
-
-        self.tgt_na = np.concatenate((self.tgt_na, notes))
+        #append the notes at the correct time. they are merged in order when tgt_na is read.
+        notes['onset_sec'] += time_in_tgtna
 
-        self.tgt_na.sort(order='onset_sec') 
+        self.tgt_notes.insert(notes)
         return
         
     def go_fwd(self):
@@ -544,15 +1625,7 @@ class lowlvl:
         #input as the time where the offset literally would start..
         #this is just a shift in timeto, the times in the na of the perf, and the labels na.
 
-        ordered_keys_incl_src, ordered_keys_list = self._repeat_tracker_order(src_time)
-
-        if repeat_index == 0 or len(ordered_keys_incl_src) == 0:
-            nearestIdx = np.fabs(self.time_from - src_time).argmin()
-            tgt_insertion_time = self.time_to[nearestIdx]
-        else:
-           (time_to_subarray, time_from_subarray) =  self.repeat_tracker[ordered_keys_incl_src[repeat_index - 1]]
-           nearestIdx = np.fabs(time_from_subarray - src_time).argmin()
-           tgt_insertion_time = time_to_subarray[nearestIdx]
+        tgt_insertion_time = self._tgt_time(src_time, repeat_index)
 
         if tgt_insertion_time == -1:
             print('time_offset: src_time {:.3f} maps to unmapped region (time_to=-1), skipping'.format(src_time))
@@ -560,8 +1633,7 @@ class lowlvl:
 
         time_in_tgtna = tgt_insertion_time
         
-        mask = self.tgt_na['onset_sec'] >= time_in_tgtna
-        self.tgt_na['onset_sec'][mask] += offset_time
+        self.tgt_notes.shift(time_in_tgtna, offset_time)
         
         tgt_time_to_apply_offset = time_in_tgtna
         self._apply_warping_path_offsets(tgt_time_to_apply_offset, offset_time)
@@ -569,38 +1641,124 @@ class lowlvl:
         self._shift_labels(src_time, offset_time, repeat_index)
         self._label_note(time_in_tgtna, time_in_tgtna+offset_time, "time_shift", midlvl_label)
         return
+
+    def apply_ops(self, ops):
+        #apply a list of (op_name, kwargs) low level ops, e.g. ('pitch_insert', {...}), in call order and with
+        #the same result as calling them one by one. only a run of consecutive inserts is batched: it leaves the
+        #warping paths alone, so its target times are looked up together and its notes and labels are added as
+        #one block each. the other ops move the paths the next op reads, so they are applied one by one.
+        i = 0
+        while i < len(ops):
+            j = i
+            while j < len(ops) and ops[j][0] == 'pitch_insert':
+                j += 1
+            if j > i:
+                self._pitch_insert_run([op[1] for op in ops[i:j]])
+                i = j
+            else:
+                getattr(self, ops[i][0])(**ops[i][1])
+                i += 1
+        return
+
+    def _pitch_insert_run(self, inserts):
+        #pitch_insert for each kwargs dict in inserts
+        src_times = np.array([ins['src_time'] for ins in inserts], dtype=np.float64)
+        repeat_index = np.array([ins.get('repeat_index', 0) for ins in inserts])
+        tgt_times = np.empty(len(inserts))
+        on_main = repeat_index == 0
+        tgt_times[on_main] = self.time_map.lookup(src_times[on_main])
+        for k in np.flatnonzero(~on_main):
+            tgt_times[k] = self._tgt_time(src_times[k], repeat_index[k])
+
+        mapped = tgt_times != -1
+        for k in np.flatnonzero(~mapped):
+            print('pitch_insert: src_time {:.3f} maps to unmapped region (time_to=-1), skipping'.format(src_times[k]))
+        kept = [ins for ins, ok in zip(inserts, mapped) if ok]
+        if not kept:
+            return
+        tgt_times = tgt_times[mapped]
+        durations = np.array([ins['duration'] for ins in kept], dtype=np.float64)
+
+        new_notes = np.zeros(len(kept), dtype=self.tgt_notes.base.dtype)
+        new_notes['onset_sec'] = tgt_times
+        new_notes['duration_sec'] = durations
+        new_notes['pitch'] = [ins['pitch'] for ins in kept]
+        new_notes['velocity'] = [ins['velocity'] for ins in kept]
+        new_notes['id'] = self.none_id
+        self.tgt_notes.insert(new_notes)
+
+        new_labels = np.zeros(len(kept), dtype=self.labels.buffer.dtype)
+        new_labels['onset_sec'] = tgt_times
+        for k, ins in enumerate(kept): #codes in call order, so new names get the same codes
+            start = float(tgt_times[k])
+            new_labels['duration_sec'][k] = (start + ins['duration']) - start #as _label_note computes it
+            new_labels['midlvl_label'][k] = self.label_vocab.code(ins['midlvl_label'])
+            new_labels['lowlvl_label'][k] = self.label_vocab.code('pitch_insert')
+        self.labels.append(new_labels)
+        return
     
     def inspect_tgt(self):
         #maybe some functionality to inspect some label specific things would be helpful.
         return
     
     def get_label_miditrack(self, loc):
-        midiobj = self._na_to_miditrack(self.label_na)
-        midiobj.write(loc)
+        write_midi(loc, [(None, self._expand_labels(self.label_na))])
         return
     
-    def _filter_by_label(self, name, tier='mid'): #tier could be mid or low
+    def _filter_by_label(self, name, tier='mid'): #tier could be mid or low. name can be a label or its code.
+        code = self.label_vocab.get(name) if isinstance(name, str) else name
+        if code is None:
+            return self.label_na[:0]
         if tier == 'mid':
-            return self.label_na[self.label_na['midlvl_label'] == name]
+            return self.label_na[self.label_na['midlvl_label'] == code]
         if tier == 'low':
-            return self.label_na[self.label_na['lowlvl_label'] == name]
+            return self.label_na[self.label_na['lowlvl_label'] == code]
         return []
     
     #folder must already be created.
     def get_midlevel_label_miditracks(self, folder):
         #make sure the output folder exists, or create if it doesn't
         os.makedirs(folder, exist_ok=True)
-        for midlvl_label in np.unique(self.label_na['midlvl_label']):
+        for midlvl_code in np.unique(self.label_na['midlvl_label']):
             #filter self.label_na based on the midlevel label
             #and get the low level operations that correspond to this midlevel label
             #create an na from both.
-            self._na_to_miditrack(self._filter_by_label(name=midlvl_label, tier='mid')).write(os.path.join(folder, '{}.mid'.format(midlvl_label)))
+            midlvl_label = self.label_vocab.names[midlvl_code]
+            labels = self._filter_by_label(name=midlvl_code, tier='mid')
+            write_midi(os.path.join(folder, '{}.mid'.format(midlvl_label)), [(None, self._expand_labels(labels))])
         return 
     
+    def export(self, loc, separate=False):
+        #the target and all the label tiers, grouping label_na by mid level label once.
+        #separate=False: one midi file at loc, with the tracks 'target', 'labels' and one per mid level label (named after it).
+        #separate=True: loc is a folder, with the files get_target_miditrack, get_label_miditrack and
+        #get_midlevel_label_miditracks write: tgt.mid, labels.mid and labels_by_type/<label>.mid.
+        labels = self.label_na
+        label_notes = self._expand_labels(labels)
+        codes, group = np.unique(labels['midlvl_label'], return_inverse=True)
+        group = np.repeat(group.ravel(), 2) #2 label notes per label row
+        by_label = np.split(label_notes[np.argsort(group, kind='stable')],
+                            np.cumsum(np.bincount(group, minlength=len(codes)))[:-1])
+        by_label = [(self.label_vocab.names[code], notes) for code, notes in zip(codes, by_label)]
+
+        if not separate:
+            write_midi(loc, [('target', self.tgt_na), ('labels', label_notes)] + by_label)
+            return
+        os.makedirs(os.path.join(loc, 'labels_by_type'), exist_ok=True)
+        write_midi(os.path.join(loc, 'tgt.mid'), [(None, self.tgt_na)])
+        write_midi(os.path.join(loc, 'labels.mid'), [(None, label_notes)])
+        for name, notes in by_label:
+            write_midi(os.path.join(loc, 'labels_by_type', '{}.mid'.format(name)), [(None, notes)])
+        return
+
     def _na_to_miditrack(self, na):
+        #as a PrettyMIDI object, for inspection. the get_*_miditrack exports go through write_midi.
         midiobj = pretty_midi.PrettyMIDI()
         piano_program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
         inst = pretty_midi.Instrument(program=piano_program)
+
+        if 'lowlvl_label' in na.dtype.names: #label rows are written as their mid and low label notes
+            na = self._expand_labels(na)
  
         for na_note in na:
             note = pretty_midi.Note(velocity=na_note['velocity'], 
@@ -613,55 +1771,66 @@ class lowlvl:
         return midiobj
     
     def get_target_miditrack(self, loc):
-        midiobj = self._na_to_miditrack(self.tgt_na)
-        midiobj.write(loc)
+        write_midi(loc, [(None, self.tgt_na)])
         return
     
     def get_src_miditrack(self, loc):
-        midiobj = self._na_to_miditrack(self.src_na)
-        midiobj.write(loc)
+        write_midi(loc, [(None, self.src_na)])
         return
     
     def get_timemap(self):
         return zip(self.time_from, self.time_to)
     
+    def compact_repeats(self):
+        #merge repeat_tracker entries that continue or repeat each other (RepeatTable.compact). the annotations and
+        #the timemap come out the same, the repeat indices of later edits count the merged entries.
+        self._record_paths()
+        return self.repeat_tracker.compact()
+
     def get_repeats(self):
         #Recall that the format is: (interval for tgt time region) -> ([target time points], [src time points]), unlike time map which we make src_time -> target_time
-        return self.repeat_tracker
+        repeats = {}
+        for key, repeat in self.repeat_tracker.items():
+            time_from, time_to = repeat.knots()
+            repeats[key] = (time_to, time_from)
+        return repeats
     
-    def get_adjusted_gt(self):
-        #TODO: This needs to account for the repetitions.
-        #check the format of the gt (needs to be a 1d array with some values)
-        #we want gt to map to the tgt_na timings.
+    def adjust_annotations(self, *annots):
+        #map one or more annotation arrays (src times: beats, downbeats, note onsets..) to tgt time, one row per pass
+        #that plays them. 'pass' is 0 for the main path and k for the k-th repeat in repeat_tracker order, 'annot' is
+        #which of the arrays the row comes from and 'index' its position in it. times no pass maps (outside the
+        #segments in segmented mode) are left out. rows are sorted by tgt time.
+        annots = [np.asarray(a, dtype=np.float64).ravel() for a in annots]
+        src_times = np.concatenate(annots + [np.zeros(0)])
+        annot_id = np.repeat(np.arange(len(annots)), [len(a) for a in annots])
+        annot_idx = np.concatenate([np.arange(len(a)) for a in annots] + [np.zeros(0, dtype=int)])
+
+        order = np.argsort(src_times, kind='stable')
+        idx, rows, tgt = self.repeat_tracker.lookup_all(src_times[order])
+        idx = np.r_[np.arange(len(src_times)), order[idx]]
+        passes = np.r_[np.zeros(len(src_times), dtype=int), rows + 1]
+        tgt = np.r_[self.time_map.lookup(src_times), tgt]
+
+        #a time two passes map to the same tgt time (where one continues the other) is played once: keep the lowest pass.
+        key_order = np.lexsort((passes, idx, tgt))
+        repeated = (tgt[key_order][1:] == tgt[key_order][:-1]) & (idx[key_order][1:] == idx[key_order][:-1])
+        mapped = tgt != -1
+        mapped[key_order[1:][repeated]] = False
+        adjusted = np.zeros(int(mapped.sum()), dtype=adjusted_annot_fields)
+        adjusted['tgt_time'] = tgt[mapped]
+        adjusted['pass'] = passes[mapped]
+        adjusted['annot'] = annot_id[idx[mapped]]
+        adjusted['index'] = annot_idx[idx[mapped]]
+        return adjusted[np.argsort(adjusted['tgt_time'], kind='stable')]
+
+    def get_inverse_timemap(self):
+        #tgt -> (src, pass) index over the main path and the repeats, passes numbered as in adjust_annotations
+        repeats = [(time_from, time_to) for time_to, time_from in self.get_repeats().values()]
+        return InverseTimeMap(self.time_from, self.time_to, repeats)
 
-        #if the resolution of regular interpolation is insufficient, we could break it up by searching, for each annotation t, for the timefrom before and after it and interpolate based on that fragment only. 
-        interpol_t = np.interp(self.ts_annot, self.time_from, self.time_to)
-        
-        #then, go over the repeats to handle the discontinuities:
-        # for every tgt_time from to tgt_time to in the repeats
-        interpol_repeats = []
-        for key, val in self.repeat_tracker.items():
-            tgt_time_start, tgt_time_end = key # guess those were unused because we just got the whole array
-            tgt_time, src_time = val
-            # get the ground truth labels corresponding to the the range src_time[0], src_time[1]
-            
-            #we could be pedantic and only get the annot_indexfrom to be after the src_time[0]
-            # but I don't think having a repeated annotation would be a disaster.
-            annot_indexfrom = np.fabs(self.ts_annot - src_time[0]).argmin()
-            annot_indexto = np.fabs(self.ts_annot - src_time[-1]).argmin()
-
-            annotations = np.interp(self.ts_annot[annot_indexfrom:annot_indexto+1], 
-                                    src_time, tgt_time)
-            interpol_repeats.extend(annotations)
-            #interpolate every gt in source time to an equiv in that old tgt time
-            #append it to the same array
-        
-        #sort all the labels (because we added the repeats at the end.)
-        interpol_t = np.concatenate((interpol_t, np.array(interpol_repeats)))
-        interpol_t.sort()
-
-        #et. voila!
-        return interpol_t
+    def get_adjusted_gt(self):
+        #ts_annot in tgt time, once per pass that plays it (see adjust_annotations)
+        return self.adjust_annotations(self.ts_annot)['tgt_time']
     
         #prob. not needed: if this index is within the resolution from the original time (which probably we should save in the class params)
 
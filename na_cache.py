@@ -0,0 +1,106 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+#bump when the cached arrays change meaning, so old entries are not read back.
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+class NoteArrayCache:
+    """On-disk cache of note arrays (parsed performances, region labels), one .npy per entry.
+
+    Entries are keyed by the content of what they were computed from (the MIDI file, or
+    the note array the regions were detected on), what was computed and its parameters, so
+    changing a pedal or classifier threshold just misses. Hits are memory-mapped read-only.
+    The directory is kept under max_bytes by dropping the least recently used entries
+    (their mtime is refreshed on every hit).
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def content_hash(source):
+        #a path hashes the file, a note array its dtype and data
+        digest = hashlib.sha1()
+        if isinstance(source, np.ndarray):
+            digest.update(str(source.dtype.descr).encode())
+            digest.update(np.ascontiguousarray(source).tobytes())
+        else:
+            with open(source, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def key(self, source, kind, **params):
+        #kind names what is cached ('notes', 'regions', ..). params must be json serializable.
+        description = json.dumps({'version': CACHE_VERSION, 'kind': kind, 'params': params}, sort_keys=True)
+        return '{}_{}_{}'.format(kind, self.content_hash(source), hashlib.sha1(description.encode()).hexdigest()[:16])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        #the cached array (a read-only memmap) or None
+        path = self._path(key)
+        try:
+            na = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)
+        return na
+
+    def save(self, key, na):
+        #written to a temporary file and moved into place, so a reader never sees half an entry
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(na))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(keep=key)
+
+    def get(self, key, compute):
+        #load, or compute and save
+        na = self.load(key)
+        if na is None:
+            na = compute()
+            self.save(key, na)
+        return na
+
+    def evict(self, keep=None):
+        #drop the least recently used entries until the directory fits in max_bytes. the entry keep (the one
+        #just saved) is never dropped, even if it alone is over max_bytes. several processes can share the
+        #directory: entries another one removes meanwhile are skipped, and in-flight .tmp files are not entries.
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and name == keep + '.npy':
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        if total > self.max_bytes:
+            print('na_cache: entry {} alone is over max_bytes ({} > {}), kept anyway'.format(keep, total, self.max_bytes))
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.cache_dir, name))
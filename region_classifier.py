@@ -1,50 +1,118 @@
 import partitura as pt
 import numpy as np
 import numpy.lib.recfunctions as rfn
+import copy
+
+#thresholds of the detection helpers, see their docstrings. part of the cache key of the labels (na_cache).
+DETECTION_PARAMS = {
+    'double_note_diameter': 5,
+    'scale_diameter': 2,
+    'threshold': 0.05,
+    'chord_outlier': 12,
+}
+
+
+def region_note_array(performance, pedal_threshold=64):
+    """The note array regions are detected on: note offsets with the sustain pedal taken
+    as on above pedal_threshold, an offset_sec column and ids without the 'P00_' prefix.
+
+    Args:
+        performance: a loaded partitura Performance (its pedal threshold is left as it was)
+            or a note array
+        pedal_threshold (int, optional): Defaults to 64, the load_performance default.
+    """
+    if isinstance(performance, np.ndarray):
+        na = performance
+    else:
+        parts = performance.performedparts
+        thresholds = [part.sustain_pedal_threshold for part in parts]
+        try:
+            for part in parts:
+                if part.sustain_pedal_threshold != pedal_threshold:
+                    part.sustain_pedal_threshold = pedal_threshold
+            na = performance.note_array()
+        finally:
+            for part, threshold in zip(parts, thresholds):
+                if part.sustain_pedal_threshold != threshold:
+                    part.sustain_pedal_threshold = threshold
+
+    if 'offset_sec' not in na.dtype.names:
+        na = rfn.append_fields(na, "offset_sec", na['onset_sec'] + na['duration_sec'], usemask=False)
+
+    # Remove 'P00_' from the 'col1' column
+    modified_col = np.char.replace(na['id'], 'P00_', '')
+    na = rfn.drop_fields(na, 'id')
+    na = rfn.append_fields(na, 'id', modified_col, usemask=False)
+    return na
+
 
 class RegionClassifier():
-    def __init__(self, performance_path, burgmuller=False, save=True):
+    def __init__(self, performance, burgmuller=False, save=True, pedal_threshold=64, params=None, cache=None):
         """This is the functionality for detecting / parsing regions of interest, 
         based on the assumption that errors are usually associated with certain 
         regions / technique groups and the probability of making mistakes varies 
         depending on the musical context.
 
         Args:
-            performance_path (str): 
+            performance: path to the performance MIDI, or an already loaded partitura
+                Performance or note array (see region_note_array), so that the caller
+                doesn't parse the file twice. A passed in performance is not modified.
+            save (bool): write the performance with the regions painted as velocities
+                next to the MIDI file. Needs the path.
+            pedal_threshold (int): sustain pedal threshold for the note offsets.
+            params (dict): overrides for DETECTION_PARAMS.
+            cache (na_cache.NoteArrayCache): labels computed for the same notes and
+                params before are read from it instead of detected again.
         """
-
-        self.performance = pt.load_performance(performance_path)
+        self.params = dict(DETECTION_PARAMS, **(params or {}))
+        performance_path = performance if isinstance(performance, str) else None
+        if save and performance_path is None:
+            raise ValueError('save needs the path of the performance')
+
+        if performance_path is not None:
+            self.performance = pt.load_performance(performance_path, pedal_threshold=pedal_threshold)
+        elif isinstance(performance, np.ndarray):
+            self.performance = None
+        else:
+            self.performance = copy.copy(performance)
 
         # remove all the pitch = 0,1 notes for burgmuller
-        if burgmuller:
+        if burgmuller and self.performance is not None:
             self.performance.performedparts = self.performance.performedparts[:1]
         
 
         # self.na will be noted according to the regions and the performance will be modified according to the na
-        self.na = self.performance.note_array()
-        self.na = rfn.append_fields(self.na, "offset_sec", self.na['onset_sec'] + self.na['duration_sec'], usemask=False)
+        self.na = region_note_array(performance if self.performance is None else self.performance, pedal_threshold)
+
+        if cache is None:
+            self.detect_regions()
+        else:
+            def detect():
+                self.detect_regions()
+                return self.na
+            self.na = cache.get(cache.key(self.na, 'regions', **self.params), detect)
+
+        #the velocities only show in the saved file. a performance that was passed in is the caller's, so it is left alone.
+        if performance_path is not None:
+            self.paint_velocity({
+                "is_double_note": 64,
+                "is_scale_note": 92,
+                "is_block_chords_note": 127,
+            })
+
+        if save:
+            pt.save_performance_midi(self.performance, performance_path[:-4] + "_rc.mid")
 
-        # Remove 'P00_' from the 'col1' column
-        modified_col = np.char.replace(self.na['id'], 'P00_', '')
-        self.na = rfn.drop_fields(self.na, 'id')
-        self.na = rfn.append_fields(self.na, 'id', modified_col, usemask=False)
 
+    def detect_regions(self):
+        """label self.na with the region columns: is_double_note, is_scale_note, is_block_chords_note and others"""
         self.double_note_detection()
         self.scale_note_detection()
         self.block_chords_note_detection()
 
         self.na = rfn.append_fields(self.na, 'others', [
             int(not (self.na[i]['is_double_note'] or self.na[i]['is_scale_note'] or self.na[i]['is_block_chords_note'])) for i in range(len(self.na))], usemask=False)
-
-        self.paint_velocity({
-            "is_double_note": 64,
-            "is_scale_note": 92,
-            "is_block_chords_note": 127,
-        })
-
-        if save:
-            pt.save_performance_midi(self.performance, performance_path[:-4] + "_rc.mid")
-
+        return
 
     def paint_velocity(self, velocity_map):
         """paint the velocity of the notes in piece, according to the dict that maps 
@@ -80,7 +148,7 @@ class RegionClassifier():
 
         """
 
-        neighbors_len = np.array([self.onset_neighbor_num(row) for row in self.na])
+        neighbors_len = np.array([self.onset_neighbor_num(row, self.params['double_note_diameter'], self.params['threshold']) for row in self.na])
         double_notes = self.na[neighbors_len > 0]
 
         self.na = rfn.append_fields(self.na, 'is_double_note', [int(l == 1) for l in neighbors_len], usemask=False)
@@ -97,7 +165,7 @@ class RegionClassifier():
             the beginning or the end of scales, but we just need a rough estimate.
         """
 
-        neighbors_len = np.array([self.consecutive_neighbor_num(row) for row in self.na])
+        neighbors_len = np.array([self.consecutive_neighbor_num(row, self.params['scale_diameter'], self.params['threshold']) for row in self.na])
 
         self.na = rfn.append_fields(self.na, 'is_scale_note', [min(min(1, p), min(1, n)) for p, n in neighbors_len], usemask=False)
 
@@ -109,7 +177,7 @@ class RegionClassifier():
         Parallel neighbors approach: If there are at least 2 other notes with simultaneous onset 
             and offset (within threshold), then it's likely to be a block chord
         """
-        neighbors_len = np.array([self.onset_offset_neighbor_num(row, remove_chord_outlier=True) for row in self.na])
+        neighbors_len = np.array([self.onset_offset_neighbor_num(row, self.params['threshold'], remove_chord_outlier=True) for row in self.na])
 
         self.na = rfn.append_fields(self.na, 'is_block_chords_note', [int(l >= 2) for l in neighbors_len], usemask=False)
 
@@ -150,7 +218,7 @@ class RegionClassifier():
 
         # if detecting chords, exlude the outlier that's too distant from the other notes - neighbors = 0
         if len(neighbors) and remove_chord_outlier:
-            if np.abs(neighbors['pitch'] - note['pitch']).min() >= 12:
+            if np.abs(neighbors['pitch'] - note['pitch']).min() >= self.params['chord_outlier']:
                 return 0
         
         return len(neighbors)
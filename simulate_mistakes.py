@@ -6,7 +6,14 @@ import pandas as pd
 import numpy.lib.recfunctions as rfn
 import copy
 import lowlvl 
+import na_cache
 import csv
+import os
+import sys
+import io
+import time
+import contextlib
+import concurrent.futures
 
 #Parametrizations:
 MAX_DUR4DRAG = 0.5
@@ -29,6 +36,20 @@ def sort_payload(payload):
     payload = sorted(payload, key=lambda x: (x[0], precedence(x[1])))
     return payload
 
+def seed_sequence(seed=None):
+    """SeedSequence for seed (None, an int or a SeedSequence). None draws the entropy from
+    np.random, so np.random.seed still makes runs reproducible."""
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if seed is None:
+        seed = int(np.random.randint(2**63, dtype=np.int64))
+    return np.random.SeedSequence(seed)
+
+def spawn_seeds(seed, n):
+    #n independent child seeds, e.g. one per file of a corpus. Child i only depends on seed and i,
+    #not on which worker runs it or when.
+    return seed_sequence(seed).spawn(n)
+
 def print_payload_item(p):
     print('{} - {}'.format(p[0], p[1]))
 def print_payload_list(payload):
@@ -39,7 +60,7 @@ def print_payload_list(payload):
 class Mistaker():
     def __init__(self, performance_path, time_series_annotation=None, mode='runthrough',
                  segments=None, time_gap=3.0, use_region_classifier=True,
-                 sampling_prob_path="sampling_prob.csv"):
+                 sampling_prob_path="sampling_prob.csv", cache=None, seed=None):
         """Overlay synthetic mistakes onto a MIDI piano performance.
 
         Args:
@@ -52,14 +73,25 @@ class Mistaker():
                 detection.  Set to False for config-based mistake specification
                 without texture analysis.
             sampling_prob_path (str): path to sampling probability CSV
+            cache (str or na_cache.NoteArrayCache): cache directory for the parsed notes
+                and region labels. With a cache hit the MIDI file is not parsed at all
+                (self.performance is then only parsed if a drag needs it).
+            seed (int, np.random.SeedSequence or np.random.Generator): seeds self.rng, which
+                all sampling goes through. Forks get their own child stream (fork).
         """
         self.performance_path = performance_path
-        self.performance = pt.load_performance(performance_path, pedal_threshold=127)
+        self._performance = None
+        self.cache = na_cache.NoteArrayCache(cache) if isinstance(cache, str) else cache
         self.time_series_annotation = time_series_annotation
         self.mode = mode
+        if isinstance(seed, np.random.Generator):
+            self.rng = seed
+            self.seed_sequence = getattr(seed.bit_generator, 'seed_seq', None) or seed_sequence(int(seed.integers(2**63)))
+        else:
+            self.seed_sequence = seed_sequence(seed)
+            self.rng = np.random.default_rng(self.seed_sequence)
 
-        na = self.performance.note_array()
-        na.sort(order='onset_sec')
+        na = self._cached('notes', self._sorted_note_array, pedal_threshold=127)
 
         self.change_tracker = lowlvl.lowlvl(
             na, mode=mode,
@@ -71,17 +103,22 @@ class Mistaker():
         else:
             self.segments = None
 
+        # self.notes are the notes mistakes are placed on, self.na the same notes with their region labels.
+        # The performance is parsed once and shared with the RegionClassifier, and the regions are only
+        # classified when self.na is first used (mistake_scheduler), so config-based payloads skip it.
+        self.use_region_classifier = use_region_classifier
+        self._na = None
+        self.failed = [] #(payload item, exception) of the items the last apply_payload could not apply
         if use_region_classifier:
-            from region_classifier import RegionClassifier
-            rc = RegionClassifier(performance_path, save=False)
-            self.na = rc.na
+            from region_classifier import region_note_array
+            self.notes = self._cached('region_notes', lambda: region_note_array(self.performance), pedal_threshold=64)
         else:
             # Add offset_sec if missing (RegionClassifier normally provides it).
             if 'offset_sec' not in na.dtype.names:
                 import numpy.lib.recfunctions as rfn
                 offset_sec = na['onset_sec'] + na['duration_sec']
                 na = rfn.append_fields(na, 'offset_sec', offset_sec, dtypes='<f4')
-            self.na = na
+            self.notes = na
 
         self.white_keys, self.black_keys = self.black_white_keys()
 
@@ -92,6 +129,48 @@ class Mistaker():
             except FileNotFoundError:
                 pass
 
+    @property
+    def performance(self):
+        if self._performance is None:
+            self._performance = pt.load_performance(self.performance_path, pedal_threshold=127)
+        return self._performance
+
+    def _sorted_note_array(self):
+        na = self.performance.note_array()
+        na.sort(order='onset_sec')
+        return na
+
+    def _cached(self, kind, compute, **params):
+        #compute(), or the array cached for this file and params
+        if self.cache is None:
+            return compute()
+        return self.cache.get(self.cache.key(self.performance_path, kind, **params), compute)
+
+    @property
+    def na(self):
+        if self._na is None:
+            if self.use_region_classifier:
+                from region_classifier import RegionClassifier
+                self._na = RegionClassifier(self.notes, save=False, cache=self.cache).na
+            else:
+                self._na = self.notes
+        return self._na
+
+    def fork(self):
+        """Another Mistaker on the same performance, without parsing or classifying it again.
+
+        The performance, region labels and source notes are shared, and the change tracker is
+        forked (lowlvl.fork), so each variant only copies the target notes it edits.
+        The regions are classified here if they were not yet, so the forks share them.
+        Each fork samples from a child stream spawned from self.seed_sequence.
+        """
+        self.na
+        twin = copy.copy(self)
+        twin.change_tracker = self.change_tracker.fork()
+        twin.seed_sequence = self.seed_sequence.spawn(1)[0]
+        twin.rng = np.random.default_rng(twin.seed_sequence)
+        return twin
+
     def schedule_mistakes(self):
         self.mistake_scheduler()
 
@@ -147,7 +226,7 @@ class Mistaker():
             list: sorted payload ready for apply_payload
         """
         payload = []
-        na = self.na
+        na = self.notes
 
         for item in config_list:
             src_time = item['src_time']
@@ -169,7 +248,7 @@ class Mistaker():
             note = na[nearest_idx]
 
             if mistake_type == 'forward_backward_insertion':
-                forward = item.get('forward', np.random.random() > 0.5)
+                forward = item.get('forward', self.rng.random() > 0.5)
                 payload.append((note['onset_sec'], 'forward_backward_insertion', 
                                {'note': note, 'forward': forward}))
 
@@ -203,7 +282,7 @@ class Mistaker():
     def create_payload(self, parsed_list):
         """Creates payload from the interactive parsed list of note locations."""
         payload = []
-        rollback_dice = np.random.random()
+        rollback_dice = self.rng.random()
 
         for mistake_item in parsed_list:
             start_time = mistake_item['start_time']
@@ -211,17 +290,17 @@ class Mistaker():
             pitch = mistake_item['pitch']
             mistake_type = mistake_item['mistake_type']
 
-            notes_in_range = [note for note in self.na if note['onset_sec'] >= start_time and note['onset_sec'] < end_time]
+            notes_in_range = [note for note in self.notes if note['onset_sec'] >= start_time and note['onset_sec'] < end_time]
             note_match = None
             for note in notes_in_range:
                 if note['pitch'] == pitch:
                     note_match = note
             if note_match is None: 
-                note_match = notes_in_range[np.random.choice(len(notes_in_range), 1, replace=True)]
+                note_match = notes_in_range[self.rng.integers(len(notes_in_range))]
 
             note = note_match
             if mistake_type == 'forward_backward_insertion':
-                payload.append((note['onset_sec'], 'forward_backward_insertion', {'note': note, 'forward': np.random.random() > 0.5}))
+                payload.append((note['onset_sec'], 'forward_backward_insertion', {'note': note, 'forward': self.rng.random() > 0.5}))
             if mistake_type == 'mistouch':
                 payload.append((note['onset_sec'], 'mistouch', {'note': note,}))
             if mistake_type == 'pitch_change':
@@ -278,7 +357,7 @@ class Mistaker():
                         print("Start time must be less than or equal to end time.")
                         continue
                     notes_in_range = [
-                        note for note in self.na 
+                        note for note in self.notes 
                         if note['onset_sec'] >= start_time and note['onset_sec'] <= end_time
                     ]
                     if notes_in_range:
@@ -328,34 +407,57 @@ class Mistaker():
         return types_and_locs
     
     ########### Function for scheduling mistakes #################
+    def _schedule_tables(self):
+        """texture row (into sampling_prob) of every note in self.na, and the cumulative normalized
+        mistake probabilities of every texture. Built once, get_texture_group / get_mistake_probability
+        for all notes at once."""
+        if getattr(self, '_schedule_cache', None) is None:
+            textures = ['is_block_chords_note', 'is_scale_note', 'is_double_note', 'others'] #get_texture_group precedence
+            flags = np.column_stack([self.na[t] == 1 for t in textures])
+            if not flags.any(axis=1).all():
+                #get_texture_group returns None for these and get_mistake_probability has no row for it
+                raise ValueError("{} notes have no texture flag set (one of {})".format(
+                    int((~flags.any(axis=1)).sum()), ', '.join(textures)))
+            rows = self.sampling_prob.index.get_indexer(textures)[flags.argmax(axis=1)]
+            probabilities = self.sampling_prob.to_numpy(dtype=np.float64)
+            cumulative = np.cumsum(probabilities / probabilities.sum(axis=1, keepdims=True), axis=1)
+            self._schedule_cache = (rows, cumulative, list(self.sampling_prob.columns))
+        return self._schedule_cache
+
     def mistake_scheduler(self, n_mistakes=80):
-        """Generate mistakes by sampling notes based on texture probabilities."""
+        """Generate mistakes by sampling notes based on texture probabilities.
+
+        The notes, mistake types, rollback dice and insertion directions are drawn in one
+        call each from self.rng.
+        """
         if self.sampling_prob is None:
             raise RuntimeError("mistake_scheduler requires sampling probabilities "
                                "(use_region_classifier=True and valid sampling_prob.csv)")
-        payload = []
-        sampled_notes = [self.sample_note(self.na) for _ in range(n_mistakes)]
+        rng = self.rng
+        rows, cumulative, mistake_types = self._schedule_tables()
 
-        for note in sampled_notes:
-            texture_group = self.get_texture_group(note)
-            mistake_probabilities = self.get_mistake_probability(texture_group)
-            mistake_types, probabilities = zip(*mistake_probabilities.items())
-            probabilities = np.array(probabilities) / np.sum(probabilities)
-            mistake_type = np.random.choice(mistake_types, p=probabilities)
+        sampled = rng.integers(0, len(self.na), n_mistakes)
+        cumulative = cumulative[rows[sampled]]
+        type_idx = np.minimum((rng.random(n_mistakes)[:, None] >= cumulative).sum(axis=1), len(mistake_types) - 1)
+        rollback_dice = rng.random(n_mistakes)
+        forward = rng.random(n_mistakes) > 0.5
 
-            rollback_dice = np.random.random()   
+        payload = []
+        for k, note_idx in enumerate(sampled):
+            note = self.na[note_idx]
+            mistake_type = mistake_types[type_idx[k]]
 
             if mistake_type == 'forward_backward_insertion':
-                payload.append((note['onset_sec'], 'forward_backward_insertion', {'note': note, 'forward': np.random.random() > 0.5}))
+                payload.append((note['onset_sec'], 'forward_backward_insertion', {'note': note, 'forward': bool(forward[k])}))
             if mistake_type == 'mistouch':
                 payload.append((note['onset_sec'], 'mistouch', {'note': note,}))
             if mistake_type == 'pitch_change':
                 payload.append((note['onset_sec'], 'pitch_change', {'note': note,}))
-                if rollback_dice < rollback_association_prob['pitch_change']:
+                if rollback_dice[k] < rollback_association_prob['pitch_change']:
                     payload.append((note['onset_sec'], 'rollback', {'note': note, 'events_back_range': (0,5)}))
             if mistake_type == 'drag': 
                 payload.append((note['onset_sec'], 'drag', {'note': note,}))
-                if rollback_dice < rollback_association_prob['drag']:
+                if rollback_dice[k] < rollback_association_prob['drag']:
                     payload.append((note['onset_sec'], 'rollback', {'note': note, 'events_back_range': (0,10)}))
             # FIX: handle standalone rollback from sampling (was silently dropped before)
             if mistake_type == 'rollback':
@@ -364,16 +466,42 @@ class Mistaker():
         payload = sort_payload(payload)
         return payload
 
-    def apply_payload(self, payload):
+    def apply_payload(self, payload, sink=None, window=30.0):
+        """Apply a sorted payload to the change tracker.
+
+        With a sink, the target is streamed instead of kept whole: every `window` seconds
+        of source, what the remaining payload can no longer edit is flushed
+        (lowlvl.flush) and passed to sink(notes, labels, timemap, repeats), and the rest
+        at the end. The carry-over reaches back as many events as the largest
+        events_back_range in the payload. Only in runthrough mode.
+
+        Each mistake function returns its low level ops, which are applied together with
+        lowlvl.apply_ops. Items that raise are skipped, and kept with their exception in self.failed.
+        """
+        if sink is not None and self.mode != 'runthrough':
+            raise ValueError('streaming is only supported in runthrough mode')
+        max_events_back = max([p[2]['events_back_range'][1] for p in payload if 'events_back_range' in p[2]] + [0])
+        next_flush = float(np.ravel(payload[0][0])[0]) + window if len(payload) else 0.0
+
+        self.failed = []
         for i, p in enumerate(payload):
+            t = float(np.ravel(p[0])[0])
+            if sink is not None and t >= next_flush:
+                events = self.change_tracker.events
+                keep_from = events.events_back(events.nearest(t), max_events_back)[0]
+                sink(*self.change_tracker.flush(self.change_tracker.onsets[keep_from]))
+                next_flush = t + window
             try:
-                self.__getattribute__(p[1])(**p[2])
+                self.change_tracker.apply_ops(self.__getattribute__(p[1])(**p[2]))
             except Exception as e:
+                    self.failed.append((p, e))
                     print(e)
+        if sink is not None:
+            sink(*self.change_tracker.flush())
         return payload
 
     def sample_note(self, data):
-        return data[np.random.choice(len(data))]
+        return data[self.rng.integers(len(data))]
 
     def sample_group(self, data, group):
         mask = data[group] == 1
@@ -381,32 +509,34 @@ class Mistaker():
         if len(group_data) == 0:
             print(f"no data in group {group}.")
             return group_data
-        return group_data[np.random.choice(len(group_data))]
+        return group_data[self.rng.integers(len(group_data))]
 
     ########### Mid Level Mistake Functions ############
+    #each returns the (op_name, kwargs) low level ops that make the mistake, for lowlvl.apply_ops
     def rollback(self, note, events_back_range):
-        num_events_back = np.random.randint(events_back_range[0], events_back_range[1])
+        num_events_back = self.rng.integers(events_back_range[0], events_back_range[1])
         idx, notes_to_repeat = self.change_tracker.get_notes(note['onset_sec'], num_events_back)
 
         onset_shift = notes_to_repeat['onset_sec'][0]
         # NOTE: go_back always re-fetches notes from src_na internally (lowlvl.go_back line 452),
         # so we no longer zero out notes_to_repeat here — that was dead code.
 
-        hesitation = np.random.uniform(0.2, 0.8)
-        self.change_tracker.time_offset(note['onset_sec'] + note['duration_sec'], hesitation, 'rollback')
-        self.change_tracker.go_back(onset_shift, note['onset_sec'] + note['duration_sec'])
-        return
+        hesitation = self.rng.uniform(0.2, 0.8)
+        end = note['onset_sec'] + note['duration_sec']
+        return [('time_offset', dict(src_time=end, offset_time=hesitation, midlvl_label='rollback')),
+                ('go_back', dict(src_time_to=onset_shift, src_time_from=end))]
 
     def forward_backward_insertion(self, note, forward=True, ascending=True):
         """Insert notes that belong to the previous / later onset."""
+        events = self.change_tracker.events
         if forward:
-            insert_pitches = self.na[self.na['onset_sec'] > note['offset_sec']]
-            min_onset = insert_pitches['onset_sec'].min()
-            insert_pitches = insert_pitches[np.isclose(insert_pitches['onset_sec'], min_onset, atol=0.05)]
+            event = events.next_event(note['offset_sec'])
         else:
-            insert_pitches = self.na[self.na['offset_sec'] < note['onset_sec']]
-            max_onset = insert_pitches['onset_sec'].max()
-            insert_pitches = insert_pitches[np.isclose(insert_pitches['onset_sec'], max_onset, atol=0.05)]
+            event = events.previous_event(note['onset_sec'])
+        if event is None:
+            print(f"no {'next' if forward else 'previous'} event for note {note['id']}.")
+            return []
+        insert_pitches = self.change_tracker.src_na[event[0]:event[1]]
 
         if (ascending and forward) or ((not ascending) and (not forward)):
             insert_pitches_ = insert_pitches[insert_pitches['pitch'] > note['pitch']]
@@ -415,45 +545,47 @@ class Mistaker():
 
         if not len(insert_pitches_):
             insert_pitches_ = insert_pitches
-        insert_pitch = np.random.choice(insert_pitches_)
+        insert_pitch = self.rng.choice(insert_pitches_)
         
-        onset = note['onset_sec'][0] + np.random.uniform(low=0.0, high=0.5) * 0.05
-        duration = note['duration_sec'][0] + np.random.uniform(low=0.0, high=0.5) * 0.05 
-        velocity = int(((np.random.random() * 0.5) + 0.5) * note['velocity'])
+        onset = float(np.ravel(note['onset_sec'])[0]) + self.rng.uniform(low=0.0, high=0.5) * 0.05
+        duration = float(np.ravel(note['duration_sec'])[0]) + self.rng.uniform(low=0.0, high=0.5) * 0.05 
+        velocity = int(((self.rng.random() * 0.5) + 0.5) * note['velocity'])
 
-        self.change_tracker.pitch_insert(onset, insert_pitch['pitch'], duration, velocity, "fwdbackwd") 
         print(f"added forward={forward} insertion at note {note['id']} with pitch {insert_pitch['pitch']}.")
+        return [('pitch_insert', dict(src_time=onset, pitch=insert_pitch['pitch'], duration=duration,
+                                      velocity=velocity, midlvl_label="fwdbackwd"))]
 
     def mistouch(self, note):
         """Add mistouched inserted note for the given note."""
         if note['pitch'] in self.white_keys: 
-            insert_pitch = self.white_keys[self.white_keys.index(note['pitch']) + (np.random.choice([1, -1]))]
+            insert_pitch = self.white_keys[self.white_keys.index(note['pitch']) + (self.rng.choice([1, -1]))]
             assert(insert_pitch != note['pitch'])
         else:
-            insert_pitch = note['pitch'] + (np.random.choice([1, -1]))
+            insert_pitch = note['pitch'] + (self.rng.choice([1, -1]))
 
         duration = 0.2
-        velocity = np.random.randint(30, 70)
+        velocity = self.rng.integers(30, 70)
 
-        self.change_tracker.pitch_insert(note['onset_sec'], insert_pitch, duration, velocity, "mistouch")
         print(f"added mistouch insertion at note {note['id']} with pitch {insert_pitch}.")
+        return [('pitch_insert', dict(src_time=note['onset_sec'], pitch=insert_pitch, duration=duration,
+                                      velocity=velocity, midlvl_label="mistouch"))]
 
     def pitch_change(self, note, rollback=False, change_chordblock=False):
         """Change the pitch of the given note."""
         changed_pitch = note['pitch']
-        if np.random.random() > 0.5:
-            neighbor_pitches = self.na[self.na['offset_sec'] < note['onset_sec']]
-            if len(neighbor_pitches):
-                max_onset = neighbor_pitches['onset_sec'].max()
-                neighbor_pitches = neighbor_pitches[np.isclose(neighbor_pitches['onset_sec'], max_onset, atol=0.05)]
+        if self.rng.random() > 0.5:
+            event = self.change_tracker.events.previous_event(note['onset_sec'])
+            if event is not None:
+                neighbor_pitches = self.change_tracker.src_na[event[0]:event[1]]
                 near_neighbor = neighbor_pitches[np.abs(neighbor_pitches['pitch'] - note['pitch']).argmin()]
                 changed_pitch = near_neighbor['pitch']
             else:
-                changed_pitch = note['pitch'] + np.random.choice([-2, -1, 1, 2])
+                changed_pitch = note['pitch'] + self.rng.choice([-2, -1, 1, 2])
         
-        self.change_tracker.pitch_insert(note['onset_sec'], changed_pitch, note['duration_sec'], note['velocity'], "wrong_pred")
-        self.change_tracker.pitch_delete(note['onset_sec'], note['pitch'], "wrong_pred")
         print(f"added pitch change at note {note['id']} with pitch {changed_pitch}.")
+        return [('pitch_insert', dict(src_time=note['onset_sec'], pitch=changed_pitch, duration=note['duration_sec'],
+                                      velocity=note['velocity'], midlvl_label="wrong_pred")),
+                ('pitch_delete', dict(src_time=note['onset_sec'], pitch=note['pitch'], midlvl_label="wrong_pred"))]
 
     def drag(self, note, drag_window=5):
         """A drag / hesitation on the note position."""
@@ -466,20 +598,133 @@ class Mistaker():
                 notes_shortly_after_dict[n['note_on']] = []
             notes_shortly_after_dict[n['note_on']].append(n)
             
-        drag_time = np.random.uniform(0.2, 0.8) * min(note['duration_sec'][0], MAX_DUR4DRAG)
+        drag_time = self.rng.uniform(0.2, 0.8) * min(note['duration_sec'], MAX_DUR4DRAG)
+        #applied right away, the ripple only follows if the note is found
         if not self.change_tracker.change_note_offset(note['onset_sec'], note['pitch'], drag_time, 'drag'):
             print('exit drag function for initial pitch not found')
-            return
+            return []
 
+        ops = []
         drag_time_accum = drag_time
         for key, n_list in notes_shortly_after_dict.items():
-            ripple_drag_time_n = drag_time * np.random.random()
+            ripple_drag_time_n = drag_time * self.rng.random()
             n = n_list[0]
             start_time = n['note_on']
-            self.change_tracker.time_offset(start_time, ripple_drag_time_n, 'drag') 
+            ops.append(('time_offset', dict(src_time=start_time, offset_time=ripple_drag_time_n, midlvl_label='drag')))
             for n in n_list:
-                self.change_tracker.change_note_offset(n['note_on'], n['pitch'], 
-                                                   ripple_drag_time_n * np.random.uniform(0.8, 1.2), 'drag')
+                ops.append(('change_note_offset', dict(src_time=n['note_on'], pitch=n['pitch'],
+                                                       offset_shift=ripple_drag_time_n * self.rng.uniform(0.8, 1.2),
+                                                       midlvl_label='drag')))
             drag_time_accum += ripple_drag_time_n
 
         print(f"added rhythm drag from note {note['id']}.")
+        return ops
+
+
+########### Batch generation ############
+def find_midi_files(folder):
+    #all the .mid / .midi files under folder, sorted so that seeds follow the same files on every run
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(('.mid', '.midi')))
+    return sorted(paths)
+
+def load_ts_annot(midi_path):
+    #<name>_annotations.txt next to the midi file (ASAP format: time, time, label), as (times, labels), or None
+    path = os.path.splitext(midi_path)[0] + '_annotations.txt'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        rows = [line.rstrip('\n').replace(' ', '\t').split('\t') for line in f if line.strip()]
+    return np.array([float(row[0]) for row in rows]), ['\t'.join(row[2:]) for row in rows]
+
+def process_file(midi_path, output_prefix, seed, n_mistakes=80, ts_annot=True, cache=None,
+                 sampling_prob_path="sampling_prob.csv", verbose=False):
+    """Schedule, apply and export the mistakes of one file. Runs in the batch workers.
+
+    Writes the files utils.load_filenames expects for output_prefix (-src.mid, -tgt.mid, -mistake-label.mid,
+    -label.csv, -mistake_timemap.csv) and, with an annotation file, <output_prefix>-tgt_annotations.txt in
+    the ASAP format. Returns (number of source notes, applied payload items, failed payload items)."""
+    from utils import payload_to_csv, timemap_to_csv
+    annot = load_ts_annot(midi_path) if ts_annot else None
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        mistaker = Mistaker(midi_path, time_series_annotation=None if annot is None else annot[0], cache=cache,
+                            sampling_prob_path=sampling_prob_path, seed=seed)
+        payload = mistaker.apply_payload(mistaker.mistake_scheduler(n_mistakes))
+    for p, e in mistaker.failed:
+        print('{}: {} at {:.3f}s failed: {}'.format(midi_path, p[1], float(np.ravel(p[0])[0]), e))
+
+    tracker = mistaker.change_tracker
+    os.makedirs(os.path.dirname(output_prefix) or '.', exist_ok=True)
+    tracker.get_src_miditrack(output_prefix + '-src.mid')
+    tracker.get_target_miditrack(output_prefix + '-tgt.mid')
+    tracker.get_label_miditrack(output_prefix + '-mistake-label.mid')
+    payload_to_csv(payload, output_prefix + '-label.csv')
+    timemap_to_csv(tracker.get_timemap(), tracker.get_repeats(), output_prefix + '-mistake_timemap.csv')
+    if annot is not None:
+        #every row of the source annotations once per pass that plays it, with its tgt time
+        adjusted = tracker.adjust_annotations(annot[0])
+        with open(output_prefix + '-tgt_annotations.txt', 'w') as f:
+            for tgt_time, index in zip(adjusted['tgt_time'], adjusted['index']):
+                f.write('{0:.6f}\t{0:.6f}\t{1}\n'.format(tgt_time, annot[1][index]))
+    return len(tracker.src_na), len(payload) - len(mistaker.failed), len(mistaker.failed)
+
+def run_batch(input_folder, output_folder, run_id, workers=None, seed=None, **kwargs):
+    """process_file on every midi file under input_folder, writing to <run_id>/<output_folder>
+    with the input folder structure: <name>.mid gives <name>-tgt.mid and the other process_file outputs.
+
+    Every file gets its own child seed (spawn_seeds, in sorted path order), so the outputs are the
+    same whatever the number of workers. The largest files are submitted first so that a long file
+    does not start last. Returns a dict of {input path: error} for the files that failed.
+    """
+    paths = find_midi_files(input_folder)
+    out_root = os.path.join(run_id, output_folder)
+    jobs = [(path, os.path.join(out_root, os.path.splitext(os.path.relpath(path, input_folder))[0]), file_seed)
+            for path, file_seed in zip(paths, spawn_seeds(seed, len(paths)))]
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+
+    failed = {}
+    n_notes = n_applied = n_failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_file, *job, **kwargs): job[0] for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                notes, applied, failed_items = future.result()
+            except Exception as e:
+                failed[path] = e
+                print('failed {}: {}'.format(path, e))
+                continue
+            n_notes += notes
+            n_applied += applied
+            n_failed += failed_items
+            print('done {}'.format(path))
+    elapsed = time.perf_counter() - start
+
+    done = len(jobs) - len(failed)
+    print('{} files ({} failed), {} notes, {} mistakes applied ({} failed) in {:.1f}s: {:.2f} files/s, {:.0f} notes/s'.format(
+        done, len(failed), n_notes, n_applied, n_failed, elapsed, done / max(elapsed, 1e-9), n_notes / max(elapsed, 1e-9)))
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Apply synthetic mistakes to all the midi performances in a folder.')
+    parser.add_argument('input_midi_folder')
+    parser.add_argument('output_midi_folder')
+    parser.add_argument('run_id', help='outputs are written to <run_id>/<output_midi_folder>')
+    parser.add_argument('--no_ts_annot', action='store_true', help='ignore <name>_annotations.txt files')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: cpu count)')
+    parser.add_argument('--seed', type=int, default=None, help='root seed, for reproducible runs')
+    parser.add_argument('--n_mistakes', type=int, default=80, help='mistakes scheduled per file')
+    parser.add_argument('--cache', default=None, help='cache directory for parsed notes and regions (na_cache)')
+    parser.add_argument('--sampling_prob', default='sampling_prob.csv')
+    parser.add_argument('--verbose', action='store_true', help='print every mistake as it is applied')
+    args = parser.parse_args()
+
+    failed = run_batch(args.input_midi_folder, args.output_midi_folder, args.run_id,
+                       workers=args.workers, seed=args.seed, n_mistakes=args.n_mistakes,
+                       ts_annot=not args.no_ts_annot, cache=args.cache,
+                       sampling_prob_path=os.path.abspath(args.sampling_prob), verbose=args.verbose)
+    sys.exit(1 if failed else 0)
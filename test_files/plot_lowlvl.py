@@ -157,7 +157,7 @@ def plot_lowlvl_state(ll_inst, title="", time_interval=None, save_path=None, fig
         tgt_t_start, tgt_t_end = src_t_start, src_t_end
 
     # Extend tgt range with repeat_tracker
-    for key, (rt_tt, rt_tf) in ll_inst.repeat_tracker.items():
+    for key, (rt_tt, rt_tf) in ll_inst.get_repeats().items():
         rt_mask = (rt_tf >= src_t_start) & (rt_tf <= src_t_end)
         if np.any(rt_mask):
             tgt_t_start = min(tgt_t_start, float(rt_tt[rt_mask].min()))
@@ -199,7 +199,7 @@ def plot_lowlvl_state(ll_inst, title="", time_interval=None, save_path=None, fig
 
     # Repeat tracker paths
     rt_colors = ['#e74c3c', '#8e44ad', '#f39c12', '#1abc9c', '#d35400']
-    for idx, (key, (rt_tt, rt_tf)) in enumerate(ll_inst.repeat_tracker.items()):
+    for idx, (key, (rt_tt, rt_tf)) in enumerate(ll_inst.get_repeats().items()):
         c = rt_colors[idx % len(rt_colors)]
         rt_mask = (rt_tf >= src_t_start) & (rt_tf <= src_t_end)
         if np.any(rt_mask):
@@ -217,7 +217,7 @@ def plot_lowlvl_state(ll_inst, title="", time_interval=None, save_path=None, fig
     }
     shown = set()
     for lbl in ll_inst.label_na:
-        low = str(lbl['lowlvl_label'])
+        low = ll_inst.label_vocab.names[lbl['lowlvl_label']]
         onset = float(lbl['onset_sec'])
         dur = float(lbl['duration_sec'])
         if onset > tgt_t_end or onset + dur < tgt_t_start:
@@ -13,7 +13,7 @@ import pytest
 import partitura as pt
 import os
 
-from piano_synmist.lowlvl import lowlvl, regular_na_fields, label_na_fields, DEFAULT_MID
+from piano_synmist.lowlvl import lowlvl, TimeMap, InverseTimeMap, write_midi, regular_na_fields, label_na_fields, DEFAULT_MID, MID_MISTOUCH, LOW_INSERT, on_grid
 
 # ---------------------------------------------------------------------------
 # Fixture: load MIDI once via partitura, provide fresh lowlvl per test
@@ -50,6 +50,11 @@ def _pick_note(ll_inst, index=50):
     return float(n["onset_sec"]), int(n["pitch"]), float(n["duration_sec"])
 
 
+def _tgt_at(ll_inst, src_time):
+    """Target time of src_time on the main warping path."""
+    return ll_inst.time_map.lookup(src_time)
+
+
 def _pick_two_times(ll_inst, idx_a=100, idx_b=200):
     """Return two onset times where idx_a < idx_b (earlier, later)."""
     return float(ll_inst.src_na[idx_a]["onset_sec"]), float(ll_inst.src_na[idx_b]["onset_sec"])
@@ -79,6 +84,17 @@ class TestInit:
         onsets = ll.src_na["onset_sec"]
         assert np.all(onsets[:-1] <= onsets[1:])
 
+    def test_ids_are_interned(self, ll, src_na):
+        assert ll.src_na.dtype["id"].kind == "i"
+        np.testing.assert_array_equal(ll.resolve_ids(ll.src_na)["id"], src_na["id"])
+
+    def test_inserted_note_resolves_to_none(self, ll):
+        onset, _, _ = _pick_note(ll)
+        ll.pitch_insert(src_time=onset, pitch=100, duration=0.3,
+                        velocity=80, midlvl_label="mistouch")
+        inserted = ll.tgt_na[ll.tgt_na["pitch"] == 100]
+        assert list(ll.resolve_ids(inserted)["id"]) == ["none"]
+
 
 # ===================================================================
 # 2. pitch_insert
@@ -102,13 +118,13 @@ class TestPitchInsert:
         onset, _, _ = _pick_note(ll)
         ll.pitch_insert(src_time=onset, pitch=100, duration=0.3,
                         velocity=80, midlvl_label="mistouch")
-        assert len(ll.label_na) == 2  # mid + low
+        assert len(ll.label_na) == 1  # one row per event
 
     def test_label_has_correct_lowlvl(self, ll):
         onset, _, _ = _pick_note(ll)
         ll.pitch_insert(src_time=onset, pitch=100, duration=0.3,
                         velocity=80, midlvl_label="mistouch")
-        assert any(ll.label_na["lowlvl_label"] == "pitch_insert")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_insert")
 
     def test_tgt_remains_sorted_after_insert(self, ll):
         onset, _, _ = _pick_note(ll)
@@ -164,7 +180,7 @@ class TestPitchDelete:
     def test_delete_creates_label(self, ll):
         onset, pitch, _ = _pick_note(ll, index=80)
         ll.pitch_delete(src_time=onset, pitch=pitch, midlvl_label="mistouch")
-        assert any(ll.label_na["lowlvl_label"] == "pitch_delete")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_delete")
 
     def test_delete_nonexistent_pitch_is_noop(self, ll):
         onset, _, _ = _pick_note(ll)
@@ -203,15 +219,15 @@ class TestTimeOffset:
 
     def test_offset_shifts_time_to(self, ll):
         t, _, _ = _pick_note(ll, index=100)
-        idx_later = np.fabs(ll.time_from - float(ll.src_na["onset_sec"][200])).argmin()
-        old_val = float(ll.time_to[idx_later])
+        t_later = float(ll.src_na["onset_sec"][200])
+        old_val = _tgt_at(ll, t_later)
         ll.time_offset(src_time=t, offset_time=1.0, midlvl_label="drag")
-        assert ll.time_to[idx_later] == pytest.approx(old_val + 1.0, abs=0.15)
+        assert _tgt_at(ll, t_later) == pytest.approx(old_val + 1.0, abs=1e-6)
 
     def test_offset_creates_label(self, ll):
         t, _, _ = _pick_note(ll, index=100)
         ll.time_offset(src_time=t, offset_time=0.5, midlvl_label="drag")
-        assert any(ll.label_na["lowlvl_label"] == "time_shift")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "time_shift")
 
     def test_negative_offset(self, ll):
         t, _, _ = _pick_note(ll, index=200)
@@ -260,7 +276,7 @@ class TestChangeNoteOffset:
         onset, pitch, _ = _pick_note(ll, index=80)
         ll.change_note_offset(src_time=onset, pitch=pitch,
                               offset_shift=0.1, midlvl_label="drag")
-        assert any(ll.label_na["lowlvl_label"] == "change_offset")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "change_offset")
 
 
 # ===================================================================
@@ -292,22 +308,22 @@ class TestGoBack:
         key = list(ll.repeat_tracker.keys())[0]
         assert isinstance(key, tuple) and len(key) == 2
 
-    def test_repeat_tracker_value_has_two_arrays(self, ll):
-        self._do_goback(ll)
+    def test_repeat_tracker_value_is_time_map(self, ll):
+        t_to, t_from = self._do_goback(ll)
         val = list(ll.repeat_tracker.values())[0]
-        assert len(val) == 2
-        assert isinstance(val[0], np.ndarray)
-        assert isinstance(val[1], np.ndarray)
+        assert isinstance(val, TimeMap)
+        assert val.start == pytest.approx(t_to)
+        assert val.end == pytest.approx(t_from)
 
     def test_go_back_shifts_time_to_forward(self, ll):
-        later_idx = np.fabs(ll.time_from - float(ll.src_na["onset_sec"][300])).argmin()
-        old_time_to = float(ll.time_to[later_idx])
+        t_later = float(ll.src_na["onset_sec"][300])
+        old_time_to = _tgt_at(ll, t_later)
         self._do_goback(ll, idx_to=100, idx_from=200)
-        assert ll.time_to[later_idx] > old_time_to
+        assert _tgt_at(ll, t_later) > old_time_to
 
     def test_go_back_creates_time_shift_label(self, ll):
         self._do_goback(ll)
-        assert any(ll.label_na["lowlvl_label"] == "time_shift")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "time_shift")
 
     def test_tgt_sorted_after_goback(self, ll):
         self._do_goback(ll)
@@ -322,34 +338,265 @@ class TestGoBack:
 class TestApplyWarpingPathOffsets:
     def test_offsets_time_to_after_threshold(self, ll):
         mid_time = float(ll.src_na["onset_sec"][len(ll.src_na) // 2])
-        idx_later = np.fabs(ll.time_from - mid_time - 5.0).argmin()
-        old = float(ll.time_to[idx_later])
+        old = _tgt_at(ll, mid_time + 5.0)
         ll._apply_warping_path_offsets(mid_time, 0.5)
-        assert ll.time_to[idx_later] == pytest.approx(old + 0.5, abs=0.05)
+        assert _tgt_at(ll, mid_time + 5.0) == pytest.approx(old + 0.5, abs=1e-6)
 
     def test_does_not_offset_before_threshold(self, ll):
         mid_time = float(ll.src_na["onset_sec"][len(ll.src_na) // 2])
-        idx_before = np.fabs(ll.time_from - 2.0).argmin()
-        old = float(ll.time_to[idx_before])
+        old = _tgt_at(ll, 2.0)
         ll._apply_warping_path_offsets(mid_time, 0.5)
-        assert ll.time_to[idx_before] == pytest.approx(old, abs=0.01)
+        assert _tgt_at(ll, 2.0) == pytest.approx(old, abs=1e-6)
 
     def test_with_repeat_tracker_shifts_values(self, ll):
         """After fixing the typos, repeat_tracker entries should also shift."""
         mid_time = float(ll.src_na["onset_sec"][len(ll.src_na) // 2])
-        idx1 = np.fabs(ll.time_from - (mid_time + 1.0)).argmin()
-        idx2 = np.fabs(ll.time_from - (mid_time + 3.0)).argmin()
-        time_to_sub = ll.time_to[idx1:idx2 + 1].copy()
-        time_from_sub = ll.time_from[idx1:idx2 + 1].copy()
-        key = (float(time_to_sub[-1]), float(time_to_sub[0]))
-        ll.repeat_tracker[key] = [time_to_sub, time_from_sub]
-
-        old_first = float(time_to_sub[0])
+        repeat = ll.time_map.slice(mid_time + 1.0, mid_time + 3.0)
+        key = repeat.key
+        ll.repeat_tracker[key] = repeat
+
+        old_first = repeat.lookup(repeat.start)
         ll._apply_warping_path_offsets(mid_time, 2.0)
 
         assert key not in ll.repeat_tracker
         new_val = list(ll.repeat_tracker.values())[0]
-        assert float(new_val[0][0]) == pytest.approx(old_first + 2.0, abs=0.05)
+        assert new_val.lookup(new_val.start) == pytest.approx(old_first + 2.0, abs=1e-6)
+
+
+# ===================================================================
+# 7b. TimeMap (breakpoint warping path)
+# ===================================================================
+
+class TestTimeMap:
+    def test_identity_has_single_piece(self, ll):
+        assert len(ll.time_map.src) == 1
+        t = float(ll.src_na["onset_sec"][123])
+        assert _tgt_at(ll, t) == pytest.approx(t, abs=1e-9)
+
+    def test_offset_is_exact_at_boundary(self, ll):
+        t = float(ll.src_na["onset_sec"][100])
+        ll.time_offset(src_time=t, offset_time=0.5, midlvl_label="drag")
+        assert _tgt_at(ll, t) == pytest.approx(t + 0.5, abs=1e-9)
+        assert _tgt_at(ll, t - 1e-4) == pytest.approx(t - 1e-4, abs=1e-9)
+
+    def test_breakpoints_grow_with_edits_not_length(self, ll):
+        for idx in (100, 200, 300):
+            ll.time_offset(src_time=float(ll.src_na["onset_sec"][idx]),
+                           offset_time=0.2, midlvl_label="drag")
+        assert len(ll.time_map.src) == 4
+
+    def test_vectorized_lookup(self, ll):
+        ts = ll.src_na["onset_sec"][:10].astype(np.float64)
+        np.testing.assert_allclose(ll.time_map.lookup(ts), ts)
+
+    def test_slice_keeps_offsets(self, ll):
+        t = float(ll.src_na["onset_sec"][100])
+        ll.time_offset(src_time=t, offset_time=0.5, midlvl_label="drag")
+        part = ll.time_map.slice(t - 1.0, t + 1.0)
+        assert part.start == pytest.approx(t - 1.0)
+        assert part.lookup(t + 0.5) == pytest.approx(_tgt_at(ll, t + 0.5))
+
+    def test_paint_matches_slice_then_assign(self):
+        rng = np.random.default_rng(0)
+        bounds = np.sort(rng.uniform(0.0, 100.0, (40, 2)), axis=1)
+        bounds[::5, 1] = bounds[::5, 0] #empty ranges too
+        offsets = rng.uniform(-10.0, 50.0, 40)
+        one_by_one, painted = TimeMap(0.0, 100.0, offset=np.nan), TimeMap(0.0, 100.0, offset=np.nan)
+        expected = []
+        for (start, end), offset in zip(bounds, offsets):
+            expected.append(one_by_one.slice(start, end))
+            one_by_one.assign(start, end, offset)
+        old = painted.paint(bounds[:, 0], bounds[:, 1], offsets)
+        np.testing.assert_array_equal(painted.src, one_by_one.src)
+        np.testing.assert_array_equal(painted.offset, one_by_one.offset)
+        for a, b in zip(old, expected):
+            np.testing.assert_array_equal(a.src, b.src)
+            np.testing.assert_array_equal(a.offset, b.offset)
+            assert a.end == b.end
+
+
+# ===================================================================
+# 7c. Deferred tgt_na edits (TargetNotes)
+# ===================================================================
+
+def _apply_mixed_edits(ll_inst, read_each):
+    """Run a mix of edits, optionally reading tgt_na after each one (eager)."""
+    src = ll_inst.src_na
+    edits = [
+        lambda: ll_inst.pitch_insert(float(src["onset_sec"][40]), 100, 0.3, 80, "mistouch"),
+        lambda: ll_inst.time_offset(float(src["onset_sec"][60]), 0.4, "drag"),
+        lambda: ll_inst.pitch_delete(float(src["onset_sec"][80]), int(src["pitch"][80]), "mistouch"),
+        lambda: ll_inst.go_back(float(src["onset_sec"][100]), float(src["onset_sec"][130]), midlvl_label="rollback"),
+        lambda: ll_inst.pitch_insert(float(src["onset_sec"][140]), 101, 0.2, 70, "wrong_pred"),
+        lambda: ll_inst.change_note_offset(float(src["onset_sec"][140]), 101, -0.1, "drag"),
+        lambda: ll_inst.pitch_delete(float(src["onset_sec"][40]), 100, "mistouch"),
+        lambda: ll_inst.time_offset(float(src["onset_sec"][160]), -0.05, "drag"),
+        lambda: ll_inst.pitch_insert(float(src["onset_sec"][170]), 102, 0.2, 70, "mistouch"),
+    ]
+    for edit in edits:
+        edit()
+        if read_each:
+            ll_inst.tgt_na
+    return ll_inst.tgt_na
+
+
+class TestDeferredEdits:
+    def test_edits_are_pending_until_read(self, ll):
+        ll.pitch_insert(float(ll.src_na["onset_sec"][40]), 100, 0.3, 80, "mistouch")
+        assert len(ll.tgt_notes.pending) == 1
+        assert len(ll.tgt_na) == len(ll.src_na) + 1
+        assert len(ll.tgt_notes.pending) == 0
+
+    def test_deferred_matches_eager(self, src_na):
+        eager = _apply_mixed_edits(lowlvl(copy.deepcopy(src_na), mode="runthrough"), read_each=True)
+        deferred = _apply_mixed_edits(lowlvl(copy.deepcopy(src_na), mode="runthrough"), read_each=False)
+        assert np.array_equal(eager, deferred)
+
+    def test_reads_between_ops_do_not_change_output(self, src_na):
+        #a pitch change inserts and deletes at the same onset after several lazy shifts. the delete matches
+        #onsets exactly, so the shifted onsets must be the same whether or not the target was read in between.
+        t = lambda i: float(src_na["onset_sec"][i])
+        ops = [("time_offset", dict(src_time=t(i), offset_time=d, midlvl_label="drag"))
+               for i, d in ((30, 0.1), (35, 0.7), (50, 0.3), (55, 0.0137), (70, 0.41))]
+        ops += [("pitch_insert", dict(src_time=t(90), pitch=int(src_na["pitch"][90]) + 1, duration=0.2,
+                                      velocity=60, midlvl_label="wrong_pred")),
+                ("pitch_delete", dict(src_time=t(90), pitch=int(src_na["pitch"][90]), midlvl_label="wrong_pred"))]
+        outputs = []
+        for read_each in (True, False):
+            ll_inst = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+            for name, kwargs in ops + _mixed_ops(src_na)[5:]:
+                getattr(ll_inst, name)(**kwargs)
+                if read_each:
+                    ll_inst.tgt_na
+            outputs.append((ll_inst.tgt_na.copy(), ll_inst.label_na.copy()))
+        assert np.array_equal(outputs[0][0], outputs[1][0])
+        assert np.array_equal(outputs[0][1], outputs[1][1])
+
+    def test_shift_is_lazy_until_read(self, ll):
+        before = ll.tgt_na["onset_sec"].copy()
+        t1, t2 = float(before[100]), float(before[200]) - 1e-3
+        ll.tgt_notes.shift(t1, 0.25)
+        ll.tgt_notes.shift(t2, 0.1)
+        assert len(ll.tgt_notes._bp) == 2
+        assert np.array_equal(ll.tgt_notes.base["onset_sec"], before)
+        after = ll.tgt_na["onset_sec"]
+        assert len(ll.tgt_notes._bp) == 0
+        #exact onsets (on the grid) plus the shifts, rounded to float32 once
+        expected = before.astype(np.float64)
+        expected[before >= t1] += 0.25
+        expected[expected.astype(np.float32) >= t2] += on_grid(0.1)
+        assert np.array_equal(after, expected.astype(np.float32))
+
+    def test_shift_grouping_does_not_round(self, ll):
+        #many small shifts give the same onsets as their sum, whenever the target is read
+        deltas = np.random.default_rng(0).uniform(0.0, 0.01, 50)
+        t = float(ll.src_na["onset_sec"][300])
+        for k, delta in enumerate(deltas):
+            ll.tgt_notes.shift(t, delta)
+            if k % 7 == 0:
+                ll.tgt_na
+        expected = ll.src_na["onset_sec"].astype(np.float64)
+        expected[ll.src_na["onset_sec"] >= t] += on_grid(deltas).sum()
+        assert np.array_equal(ll.tgt_na["onset_sec"], expected.astype(np.float32))
+
+    def test_find_sees_lazy_shift(self, ll):
+        onset, pitch, _ = _pick_note(ll, index=150)
+        ll.time_offset(float(ll.src_na["onset_sec"][120]), 0.3, "drag")
+        found, _, start = ll._locate_note_in_tgt(onset, pitch)
+        eager_found, _, eager_start = ll._find_note_in_tgt(onset, pitch)
+        assert found == eager_found
+        assert start == pytest.approx(eager_start)
+
+    def test_find_sees_pending_notes(self, ll):
+        onset = float(ll.src_na["onset_sec"][40])
+        ll.pitch_insert(onset, 100, 0.3, 80, "mistouch")
+        found, handle, _ = ll._locate_note_in_tgt(onset, 100)
+        assert found and handle[0] == 0
+
+    def test_pitch_rows_are_in_onset_order(self, ll):
+        pitch = int(ll.src_na["pitch"][50])
+        rows = ll.tgt_notes.pitch_rows(pitch)
+        assert np.all(ll.tgt_na["pitch"][rows] == pitch)
+        assert len(rows) == np.sum(ll.tgt_na["pitch"] == pitch)
+        assert np.all(np.diff(ll.tgt_na["onset_sec"][rows]) >= 0)
+
+    def test_find_skips_deleted_notes(self, ll):
+        onset, pitch, _ = _pick_note(ll, index=80)
+        ll.pitch_delete(src_time=onset, pitch=pitch, midlvl_label="mistouch")
+        assert ll.tgt_notes.alive is not None
+        found, _, _ = ll._locate_note_in_tgt(onset, pitch)
+        eager_found, _, _ = ll._find_note_in_tgt(onset, pitch)
+        assert found == eager_found
+
+
+# ===================================================================
+# 7d. RepeatTable (repeat_tracker)
+# ===================================================================
+
+class TestRepeatTable:
+    def _add_repeats(self, ll_inst, ranges=((100, 150), (300, 350))):
+        for start_idx, end_idx in ranges:
+            repeat = ll_inst.time_map.slice(float(ll_inst.src_na["onset_sec"][start_idx]),
+                                            float(ll_inst.src_na["onset_sec"][end_idx]))
+            ll_inst.repeat_tracker[repeat.key] = repeat
+
+    def test_covering_rows(self, ll):
+        self._add_repeats(ll)
+        rows = ll.repeat_tracker.covering(float(ll.src_na["onset_sec"][320]))
+        assert len(rows) == 1
+        assert ll.repeat_tracker.map_at(rows[0]).covers(float(ll.src_na["onset_sec"][320]))
+
+    def test_shift_rekeys_in_place(self, ll):
+        self._add_repeats(ll, ranges=((100, 150), (200, 250), (300, 350), (400, 450)))
+        table = ll.repeat_tracker
+        keys = table._key_list
+        table.shift_after(float(ll.src_na["onset_sec"][220]), 1.0) #straddles the second pass
+        assert table._key_list is keys #the order held, nothing was re-sorted
+        assert list(table) == sorted(table)
+        assert [table[key].key for key in table] == list(table)
+
+        table.shift_after(float(ll.src_na["onset_sec"][320]), -40.0) #moves the last pass before the others
+        assert list(table) == sorted(table)
+        assert [table[key].key for key in table] == list(table)
+        assert table[list(table)[0]].start == float(ll.src_na["onset_sec"][400])
+
+    def test_shift_is_folded_in_on_read(self, ll):
+        self._add_repeats(ll)
+        t = float(ll.src_na["onset_sec"][200])
+        ll.repeat_tracker.shift_after(t, 2.0)
+        assert ll.repeat_tracker._pending[1] == 2.0
+        early, late = ll.repeat_tracker.values()
+        probe = float(ll.src_na["onset_sec"][320])
+        assert late.lookup(probe) == pytest.approx(probe + 2.0)
+        assert early.lookup(float(ll.src_na["onset_sec"][120])) == pytest.approx(float(ll.src_na["onset_sec"][120]))
+        assert ll.repeat_tracker._pending[1] == 0.0
+
+    def test_shift_inside_a_repeat_splits_it(self, ll):
+        self._add_repeats(ll, ranges=((100, 150),))
+        t = float(ll.src_na["onset_sec"][125])
+        ll.repeat_tracker.shift_after(t, 1.0)
+        (key, repeat), = ll.repeat_tracker.items()
+        assert repeat.lookup(t) == pytest.approx(t + 1.0)
+        assert repeat.lookup(t - 0.01) == pytest.approx(t - 0.01)
+        assert key == repeat.key
+
+    def test_compact_merges_continued_and_repeated_passes(self, ll):
+        ll.time_offset(float(ll.src_na["onset_sec"][120]), 0.5, "drag") #a breakpoint inside the first pass
+        self._add_repeats(ll, ranges=((100, 150), (150, 200), (160, 170), (300, 350)))
+        annot = ll.src_na["onset_sec"][::2]
+        before = np.sort(ll.adjust_annotations(annot)[["tgt_time", "index"]])
+        assert ll.compact_repeats() == 2
+        merged = ll.repeat_tracker[list(ll.repeat_tracker)[0]]
+        assert merged.start == float(ll.src_na["onset_sec"][100]) and merged.end == float(ll.src_na["onset_sec"][200])
+        np.testing.assert_array_equal(np.sort(ll.adjust_annotations(annot)[["tgt_time", "index"]]), before)
+        assert ll.compact_repeats() == 0
+
+    def test_compact_keeps_passes_that_differ(self, ll):
+        self._add_repeats(ll, ranges=((100, 150),))
+        ll.time_offset(float(ll.src_na["onset_sec"][150]), 0.5, "drag")
+        self._add_repeats(ll, ranges=((150, 200),)) #starts where the first ends, but 0.5s later
+        assert ll.compact_repeats() == 0
+        assert len(ll.repeat_tracker) == 2
 
 
 # ===================================================================
@@ -380,11 +627,9 @@ class TestRepeatTrackerOrder:
     def test_keys_all_is_sorted(self, ll):
         """All keys should be sorted by their tuple values."""
         for start_idx, end_idx in [(100, 150), (300, 350)]:
-            idx1 = np.fabs(ll.time_from - float(ll.src_na["onset_sec"][start_idx])).argmin()
-            idx2 = np.fabs(ll.time_from - float(ll.src_na["onset_sec"][end_idx])).argmin()
-            tt = ll.time_to[idx1:idx2 + 1].copy()
-            tf = ll.time_from[idx1:idx2 + 1].copy()
-            ll.repeat_tracker[(float(tt[-1]), float(tt[0]))] = (tt, tf)
+            repeat = ll.time_map.slice(float(ll.src_na["onset_sec"][start_idx]),
+                                       float(ll.src_na["onset_sec"][end_idx]))
+            ll.repeat_tracker[repeat.key] = repeat
 
         _, keys_all = ll._repeat_tracker_order(float(ll.src_na["onset_sec"][120]))
         assert keys_all == sorted(keys_all)
@@ -421,6 +666,19 @@ class TestGetNotesBetween:
         notes["pitch"][0] = 999
         assert ll.src_na["pitch"][50] != 999
 
+    def test_view_is_read_only(self, ll):
+        t1 = float(ll.src_na["onset_sec"][50])
+        t2 = float(ll.src_na["onset_sec"][55])
+        notes = ll.get_notes_between(t1, t2, copy=False)
+        assert np.shares_memory(notes, ll.src_na)
+        with pytest.raises(ValueError):
+            notes["pitch"][0] = 999
+
+    def test_empty_range(self, ll):
+        notes = ll.get_notes_between(-10.0, -5.0)
+        assert len(notes) == 0
+        assert notes.dtype == ll.src_na.dtype
+
 
 # ===================================================================
 # 10. get_notes
@@ -464,15 +722,61 @@ class TestGetNotes:
         _, notes = ll.get_notes(src_time=float(onsets[after_chord]), num_events_back=1)
         assert len(notes) >= 3
 
+    def test_zero_events_back_is_the_whole_chord(self, ll):
+        onsets = ll.src_na["onset_sec"]
+        chord_idx = int(np.flatnonzero(onsets[1:] == onsets[:-1])[0])
+        _, notes = ll.get_notes(src_time=float(onsets[chord_idx]), num_events_back=0)
+        assert np.sum(onsets == onsets[chord_idx]) <= len(notes)
+        assert np.all(np.diff(notes["onset_sec"]) <= 0.030 + 1e-6)
+
+
+# ===================================================================
+# 10b. EventIndex
+# ===================================================================
+
+class TestEventIndex:
+    def test_event_ids_follow_onsets(self, ll):
+        events = ll.events
+        assert events.event_id[0] == 0
+        assert np.all(np.diff(events.event_id) >= 0)
+        assert len(events) == events.event_id[-1] + 1
+
+    def test_same_onset_same_event(self, ll):
+        onsets = ll.src_na["onset_sec"]
+        same = np.flatnonzero(onsets[1:] == onsets[:-1])
+        assert np.all(ll.events.event_id[same] == ll.events.event_id[same + 1])
+
+    def test_next_and_previous_event(self, ll):
+        events = ll.events
+        e = int(events.event_id[100])
+        start, end = events.start[e], events.end[e]
+        assert events.next_event(float(ll.src_na["onset_sec"][end - 1])) == (end, events.end[e + 1])
+        assert events.previous_event(float(ll.src_na["onset_sec"][start])) == (events.start[e - 1], start)
+
+    def test_no_previous_event_at_start(self, ll):
+        assert ll.events.previous_event(float(ll.src_na["onset_sec"][0])) is None
+
 
 # ===================================================================
 # 11. _label_note
 # ===================================================================
 
 class TestLabelNote:
-    def test_creates_two_label_entries(self, ll):
+    def test_creates_one_label_row(self, ll):
+        ll._label_note(5.0, 5.5, "pitch_insert", "mistouch")
+        assert len(ll.label_na) == 1
+
+    def test_label_row_holds_codes(self, ll):
+        ll._label_note(5.0, 5.5, "pitch_insert", "mistouch")
+        row = ll.label_na[0]
+        assert ll.label_vocab.names[row["midlvl_label"]] == "mistouch"
+        assert ll.label_vocab.names[row["lowlvl_label"]] == "pitch_insert"
+
+    def test_expanded_to_mid_and_low_notes(self, ll):
         ll._label_note(5.0, 5.5, "pitch_insert", "mistouch")
-        assert len(ll.label_na) == 2
+        notes = ll._expand_labels(ll.label_na)
+        assert len(notes) == 2
+        assert set(notes["pitch"]) == {MID_MISTOUCH, LOW_INSERT}
 
     def test_label_onset_and_duration(self, ll):
         ll._label_note(5.0, 5.5, "pitch_insert", "mistouch")
@@ -481,7 +785,8 @@ class TestLabelNote:
 
     def test_unknown_midlvl_gets_default_pitch(self, ll):
         ll._label_note(5.0, 5.5, "pitch_insert", "unknown_xyz")
-        assert any(ll.label_na["pitch"] == DEFAULT_MID)
+        assert any(ll._expand_labels(ll.label_na)["pitch"] == DEFAULT_MID)
+        assert "unknown_xyz" in ll.label_vocab.names
 
     def test_labels_remain_sorted_after_multiple(self, ll):
         ll._label_note(10.0, 10.5, "pitch_insert", "mistouch")
@@ -490,6 +795,15 @@ class TestLabelNote:
         onsets = ll.label_na["onset_sec"]
         assert np.all(onsets[:-1] <= onsets[1:])
 
+    def test_buffer_grows_and_sorts_on_read(self, ll):
+        for t in np.linspace(100.0, 1.0, 50):
+            ll._label_note(t, t + 0.1, "pitch_insert", "mistouch")
+        assert not ll.labels.sorted
+        onsets = ll.label_na["onset_sec"]
+        assert len(onsets) == 50
+        assert np.all(onsets[:-1] <= onsets[1:])
+        assert ll.labels.sorted
+
 
 # ===================================================================
 # 12. _shift_labels
@@ -518,6 +832,16 @@ class TestShiftLabels:
         ll._shift_labels(src_time=onset2 - 0.1, offset=1.0)
         assert ll.label_na["onset_sec"][0] == pytest.approx(earliest_before, abs=0.01)
 
+    def test_shift_on_unsorted_buffer(self, ll):
+        onset1, _, _ = _pick_note(ll, index=50)
+        onset2, _, _ = _pick_note(ll, index=200)
+        ll._label_note(onset2, onset2 + 0.5, "pitch_insert", "mistouch")
+        ll._label_note(onset1, onset1 + 0.5, "pitch_insert", "mistouch")
+        ll._shift_labels(src_time=onset2 - 0.1, offset=-(onset2 - onset1) - 1.0)
+        onsets = ll.label_na["onset_sec"]
+        assert np.all(onsets[:-1] <= onsets[1:])
+        assert onsets[0] == pytest.approx(onset1 - 1.0, abs=0.01)
+
 
 # ===================================================================
 # 13. _find_note_in_tgt
@@ -580,6 +904,257 @@ class TestOffsetThenInsert:
         assert np.all(onsets[:-1] <= onsets[1:])
 
 
+# ===================================================================
+# 15b. apply_ops (bulk low level ops)
+# ===================================================================
+
+def _mixed_ops(src):
+    """An op list with insert runs, repeats and the other ops in between."""
+    t = lambda i: float(src["onset_sec"][i])
+    ops = [("pitch_insert", dict(src_time=t(i), pitch=100 + i % 5, duration=0.2,
+                                 velocity=60, midlvl_label="mistouch")) for i in (40, 41, 45)]
+    ops += [("time_offset", dict(src_time=t(60), offset_time=0.3, midlvl_label="drag")),
+            ("pitch_delete", dict(src_time=t(80), pitch=int(src["pitch"][80]), midlvl_label="wrong_pred")),
+            ("go_back", dict(src_time_to=t(100), src_time_from=t(130), midlvl_label="rollback"))]
+    ops += [("pitch_insert", dict(src_time=t(i), pitch=90, duration=0.1, velocity=50,
+                                  midlvl_label="fwdbackwd", repeat_index=1)) for i in (105, 110, 300)]
+    ops += [("change_note_offset", dict(src_time=t(140), pitch=int(src["pitch"][140]),
+                                        offset_shift=0.1, midlvl_label="drag")),
+            ("pitch_insert", dict(src_time=t(150), pitch=101, duration=0.3, velocity=70,
+                                  midlvl_label="new_label"))]
+    return ops
+
+
+class TestApplyOps:
+    def test_matches_sequential_calls(self, src_na):
+        one_by_one = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        bulk = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        ops = _mixed_ops(src_na)
+        for name, kwargs in ops:
+            getattr(one_by_one, name)(**kwargs)
+        bulk.apply_ops(ops)
+        assert np.array_equal(one_by_one.tgt_na, bulk.tgt_na)
+        assert np.array_equal(one_by_one.label_na, bulk.label_na)
+        assert one_by_one.label_vocab.names == bulk.label_vocab.names
+        assert np.array_equal(one_by_one.time_from, bulk.time_from)
+        assert np.array_equal(one_by_one.time_to, bulk.time_to)
+
+    def test_insert_run_is_one_block(self, ll):
+        ll.apply_ops(_mixed_ops(ll.src_na)[:3])
+        assert len(ll.tgt_notes.pending) == 1
+        assert len(ll.label_na) == 3
+
+
+# ===================================================================
+# 15c. fork
+# ===================================================================
+
+class TestFork:
+    def test_fork_shares_source_and_target(self, ll):
+        twin = ll.fork()
+        assert twin.src_na is ll.src_na
+        assert twin.events is ll.events
+        assert twin.tgt_notes.base is ll.tgt_notes.base
+
+    def test_forks_do_not_see_each_others_edits(self, src_na):
+        parent = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        ops = _mixed_ops(src_na)
+        parent.apply_ops(ops[:4])
+        before = parent.tgt_na.copy()
+        labels_before = parent.label_na.copy()
+        twin = parent.fork()
+        twin.apply_ops(ops[4:])
+        assert np.array_equal(parent.tgt_na, before)
+        assert np.array_equal(parent.label_na, labels_before)
+
+        fresh = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        fresh.apply_ops(ops[:4])
+        fresh.apply_ops(ops[4:])
+        assert np.array_equal(twin.tgt_na, fresh.tgt_na)
+        assert np.array_equal(twin.label_na, fresh.label_na)
+        assert np.array_equal(twin.time_to, fresh.time_to)
+
+    def test_parent_edit_after_fork(self, ll):
+        twin = ll.fork()
+        onset, pitch, dur = _pick_note(ll, index=100)
+        ll.change_note_offset(onset, pitch, 0.2, "drag")
+        idx = np.flatnonzero((twin.tgt_na["onset_sec"] == onset) & (twin.tgt_na["pitch"] == pitch))
+        assert twin.tgt_na["duration_sec"][idx[0]] == pytest.approx(dur)
+        assert twin.tgt_na is not ll.tgt_na
+
+
+# ===================================================================
+# 15d. begin / commit / rollback
+# ===================================================================
+
+class TestTransactions:
+    def _state(self, ll_inst):
+        return (ll_inst.tgt_na.copy(), ll_inst.label_na.copy(), ll_inst.time_to.copy(), ll_inst.get_repeats())
+
+    def _assert_state(self, ll_inst, state):
+        tgt, labels, time_to, repeats = state
+        assert np.array_equal(ll_inst.tgt_na, tgt)
+        assert np.array_equal(ll_inst.label_na, labels)
+        assert np.array_equal(ll_inst.time_to, time_to)
+        assert ll_inst.get_repeats().keys() == repeats.keys()
+        for key, (rep_to, rep_from) in repeats.items():
+            assert np.array_equal(ll_inst.get_repeats()[key][0], rep_to)
+            assert np.array_equal(ll_inst.get_repeats()[key][1], rep_from)
+
+    def test_rollback_restores_state(self, ll):
+        ops = _mixed_ops(ll.src_na)
+        ll.apply_ops(ops[:2])
+        state = self._state(ll)
+        ll.begin()
+        ll.apply_ops(ops[2:])
+        assert len(ll.get_repeats()) == 1
+        ll.rollback()
+        self._assert_state(ll, state)
+        ll.apply_ops(ops[2:]) #still usable after a rollback
+        assert len(ll.get_repeats()) == 1
+
+    def test_commit_keeps_edits(self, ll):
+        ll.begin()
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        state = self._state(ll)
+        ll.commit()
+        self._assert_state(ll, state)
+
+    def test_nested(self, ll):
+        ops = _mixed_ops(ll.src_na)
+        state = self._state(ll)
+        ll.begin()
+        ll.apply_ops(ops[:4])
+        inner = self._state(ll)
+        ll.begin()
+        ll.apply_ops(ops[4:])
+        ll.rollback()
+        self._assert_state(ll, inner)
+        ll.rollback()
+        self._assert_state(ll, state)
+
+    def test_rollback_without_begin(self, ll):
+        with pytest.raises(RuntimeError):
+            ll.rollback()
+
+    def test_rollback_after_reads_and_merges(self, ll, src_na):
+        #reads merge the target and sort the labels inside the transaction, a negative shift merges and shifts in
+        #place, and enough shifts fold the lazy ones into the base.
+        src = ll.src_na
+        t = lambda i: float(src["onset_sec"][i])
+        ops = _mixed_ops(src)
+        ll.apply_ops(ops[:4])
+        state = self._state(ll)
+        vocab = list(ll.label_vocab.names)
+        ll.begin()
+        for k, (name, kwargs) in enumerate(ops[4:]):
+            getattr(ll, name)(**kwargs)
+            if k % 2:
+                ll.tgt_na, ll.label_na
+        for i in range(400, 528, 2):
+            ll.time_offset(t(i), 0.01, "drag")
+        ll.change_note_offset(t(380), int(src["pitch"][380]), 0.2, "drag")
+        ll.time_offset(t(390), -0.05, "drag")
+        ll.pitch_delete(t(395), int(src["pitch"][395]), "new_name")
+        ll.rollback()
+        self._assert_state(ll, state)
+        assert ll.label_vocab.names == vocab
+
+        fresh = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        fresh.apply_ops(ops[:4])
+        ll.apply_ops(ops[4:])
+        fresh.apply_ops(ops[4:])
+        assert np.array_equal(ll.tgt_na, fresh.tgt_na)
+        assert np.array_equal(ll.label_na, fresh.label_na)
+
+    def test_commit_then_outer_rollback(self, ll):
+        ops = _mixed_ops(ll.src_na)
+        state = self._state(ll)
+        ll.begin()
+        ll.apply_ops(ops[:4])
+        ll.begin()
+        ll.apply_ops(ops[4:])
+        ll.commit()
+        ll.rollback()
+        self._assert_state(ll, state)
+
+    def test_edits_do_not_copy_the_state(self, ll):
+        #begin copies nothing, and an edit records its inverse instead of copying the target or label buffer
+        base, buffer = ll.tgt_notes.base, ll.labels.buffer
+        onset, pitch, dur = _pick_note(ll, index=100)
+        ll.begin()
+        ll.change_note_offset(onset, pitch, 0.2, "drag")
+        ll.pitch_delete(*_pick_note(ll, index=120)[:2], "mistouch")
+        ll.time_offset(onset, 0.1, "drag")
+        assert ll.tgt_notes.base is base and ll.labels.buffer is buffer
+        ll.rollback()
+        assert ll.tgt_notes.base is base and ll.tgt_notes.alive is None
+        assert ll.tgt_notes.base["duration_sec"][100] == pytest.approx(dur)
+        assert len(ll.labels) == 0
+
+    def test_rollback_segmented_practice(self, ll_seg):
+        state = self._state(ll_seg)
+        ll_seg.begin()
+        ll_seg._create_segmented_practice([(5.0, 10.0), (8.0, 12.0), (20.0, 25.0)])
+        assert len(ll_seg.tgt_na) > 0
+        ll_seg.rollback()
+        self._assert_state(ll_seg, state)
+
+    def test_fork_inside_transaction(self, ll):
+        ll.begin()
+        with pytest.raises(RuntimeError):
+            ll.fork()
+
+
+# ===================================================================
+# 15e. flush (streaming)
+# ===================================================================
+
+class TestFlush:
+    def test_streamed_chunks_match_whole_run(self, src_na):
+        t = lambda i: float(src_na["onset_sec"][i])
+        ops = _mixed_ops(src_na)
+        whole = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        whole.apply_ops(ops)
+
+        streamed = lowlvl(copy.deepcopy(src_na), mode="runthrough")
+        streamed.apply_ops(ops[:5])
+        chunks = [streamed.flush(t(70))] #the rollback that follows returns to t(100)
+        streamed.apply_ops(ops[5:9])
+        chunks.append(streamed.flush(t(135)))
+        streamed.apply_ops(ops[9:])
+        chunks.append(streamed.flush())
+        assert len(chunks[0][0]) and len(chunks[1][0]) and len(chunks[1][3]) == 1
+
+        assert np.array_equal(np.concatenate([c[0] for c in chunks]), whole.tgt_na)
+        assert np.array_equal(np.concatenate([c[1] for c in chunks]), whole.label_na)
+
+        repeats = {}
+        for c in chunks:
+            repeats.update(c[3])
+        assert repeats.keys() == whole.get_repeats().keys()
+
+        for c, following in zip(chunks, chunks[1:]):
+            assert c[2][0][-1] == following[2][0][0]
+        for c in chunks:
+            time_from, time_to = c[2]
+            assert np.allclose(whole.time_map.lookup(time_from[::2]), time_to[::2])
+
+    def test_flush_all_empties_tracker(self, ll):
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        n_notes, n_labels = len(ll.tgt_na), len(ll.label_na)
+        notes, labels, _, repeats = ll.flush()
+        assert (len(notes), len(labels), len(repeats)) == (n_notes, n_labels, 1)
+        assert len(ll.tgt_na) == 0 and len(ll.label_na) == 0 and len(ll.repeat_tracker) == 0
+
+    def test_flush_needs_runthrough_and_no_transaction(self, ll, ll_seg):
+        with pytest.raises(RuntimeError):
+            ll_seg.flush()
+        ll.begin()
+        with pytest.raises(RuntimeError):
+            ll.flush()
+
+
 # ===================================================================
 # 16. get_adjusted_gt
 # ===================================================================
@@ -593,6 +1168,71 @@ class TestGetAdjustedGt:
         result = ll.get_adjusted_gt()
         np.testing.assert_allclose(result, ts, atol=0.5)
 
+    def test_repeat_is_tagged_with_its_pass(self, ll):
+        t_to = float(ll.src_na["onset_sec"][100])
+        t_from = float(ll.src_na["onset_sec"][150])
+        ll.go_back(src_time_to=t_to, src_time_from=t_from, midlvl_label="rollback")
+        beats = np.array([t_to - 1.0, (t_to + t_from) / 2, t_from + 1.0])
+        adjusted = ll.adjust_annotations(beats)
+        assert list(adjusted["index"][adjusted["pass"] == 1]) == [1]
+        assert np.sum(adjusted["index"] == 1) == 2
+        first, second = np.sort(adjusted["tgt_time"][adjusted["index"] == 1])
+        assert first == pytest.approx(beats[1])
+        assert second > t_from
+
+    def test_several_arrays(self, ll):
+        beats = ll.src_na["onset_sec"][::20]
+        downbeats = ll.src_na["onset_sec"][::80]
+        adjusted = ll.adjust_annotations(beats, downbeats)
+        assert np.all(np.diff(adjusted["tgt_time"]) >= 0)
+        assert np.sum(adjusted["annot"] == 0) == len(beats)
+        assert np.sum(adjusted["annot"] == 1) == len(downbeats)
+        for annot, times in enumerate((beats, downbeats)):
+            rows = adjusted[adjusted["annot"] == annot]
+            np.testing.assert_allclose(rows["tgt_time"], times[rows["index"]])
+
+
+# ===================================================================
+# 16b. InverseTimeMap (tgt -> src, pass)
+# ===================================================================
+
+class TestInverseTimeMap:
+    def test_inverts_main_path(self, ll):
+        ll.time_offset(float(ll.src_na["onset_sec"][100]), 0.5, "drag")
+        src = ll.src_na["onset_sec"][::10].astype(np.float64)
+        back, passes = ll.get_inverse_timemap().lookup(ll.time_map.lookup(src))
+        np.testing.assert_allclose(back, src, atol=1e-6)
+        assert np.all(passes == 0)
+
+    def test_silence_maps_to_shift_point(self, ll):
+        t = float(ll.src_na["onset_sec"][100])
+        ll.time_offset(t, 0.5, "drag")
+        tgt = ll.time_map.lookup(t)
+        assert ll.get_inverse_timemap().lookup(tgt - 0.25) == (pytest.approx(t), 0)
+
+    def test_repeat_pass(self, ll):
+        t_to = float(ll.src_na["onset_sec"][100])
+        t_from = float(ll.src_na["onset_sec"][150])
+        ll.go_back(src_time_to=t_to, src_time_from=t_from, midlvl_label="rollback")
+        mid = (t_to + t_from) / 2
+        inverse = ll.get_inverse_timemap()
+        old_tgt = ll.repeat_tracker.map_at(0).lookup(mid)
+        assert inverse.lookup(old_tgt) == (pytest.approx(mid), 1)
+        assert inverse.lookup(ll.time_map.lookup(mid)) == (pytest.approx(mid), 0)
+
+    def test_from_timemap_csv(self, ll, tmp_path):
+        from piano_synmist.utils import timemap_to_csv, csv_to_timemap
+        ll.go_back(src_time_to=float(ll.src_na["onset_sec"][100]),
+                   src_time_from=float(ll.src_na["onset_sec"][150]), midlvl_label="rollback")
+        path = str(tmp_path / "timemap.csv")
+        timemap_to_csv(ll.get_timemap(), ll.get_repeats(), path)
+        time_map, repeats = csv_to_timemap(path)
+        assert len(repeats) == 1
+        from_csv = InverseTimeMap(*zip(*time_map), list(repeats.values()))
+        tgt = np.linspace(0, float(ll.time_to.max()), 200)
+        for got, expected in zip(from_csv.lookup(tgt), ll.get_inverse_timemap().lookup(tgt)):
+            np.testing.assert_allclose(got, expected)
+
 
 # ===================================================================
 # 17. _create_segmented_practice
@@ -627,5 +1267,75 @@ class TestAccessors:
         assert len(ll.get_repeats()) == 1
 
 
+
+# ===================================================================
+# 19. MIDI export (write_midi)
+# ===================================================================
+
+def _pretty_midi_bytes(notes, path):
+    """What PrettyMIDI wrote for a single piano track of these notes."""
+    import pretty_midi
+    midiobj = pretty_midi.PrettyMIDI()
+    inst = pretty_midi.Instrument(program=0)
+    for n in notes:
+        inst.notes.append(pretty_midi.Note(velocity=n["velocity"], pitch=n["pitch"], start=n["onset_sec"],
+                                           end=n["onset_sec"] + n["duration_sec"]))
+    midiobj.instruments.append(inst)
+    midiobj.write(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class TestWriteMidi:
+    def test_target_matches_pretty_midi(self, ll, tmp_path):
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        ll.get_target_miditrack(str(tmp_path / "tgt.mid"))
+        with open(tmp_path / "tgt.mid", "rb") as f:
+            assert f.read() == _pretty_midi_bytes(ll.tgt_na, str(tmp_path / "ref.mid"))
+
+    def test_labels_match_pretty_midi(self, ll, tmp_path):
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        ll.get_label_miditrack(str(tmp_path / "labels.mid"))
+        with open(tmp_path / "labels.mid", "rb") as f:
+            expected = _pretty_midi_bytes(ll._expand_labels(ll.label_na), str(tmp_path / "ref.mid"))
+            assert f.read() == expected
+
+    def test_empty_track(self, ll, tmp_path):
+        write_midi(str(tmp_path / "empty.mid"), [(None, ll.src_na[:0])])
+        with open(tmp_path / "empty.mid", "rb") as f:
+            assert f.read() == _pretty_midi_bytes(ll.src_na[:0], str(tmp_path / "ref.mid"))
+
+    def test_export_one_file(self, ll, tmp_path):
+        import pretty_midi
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        ll.export(str(tmp_path / "piece.mid"))
+        midiobj = pretty_midi.PrettyMIDI(str(tmp_path / "piece.mid"))
+        names = [inst.name for inst in midiobj.instruments]
+        assert names[:2] == ["target", "labels"]
+        assert sorted(names[2:]) == sorted(set(ll.label_vocab.decode(ll.label_na["midlvl_label"])))
+        assert len(midiobj.instruments[0].notes) == len(ll.tgt_na)
+        assert len(midiobj.instruments[1].notes) == 2 * len(ll.label_na)
+        assert sum(len(inst.notes) for inst in midiobj.instruments[2:]) == 2 * len(ll.label_na)
+
+    def test_export_separate_matches_single_exports(self, ll, tmp_path):
+        ll.apply_ops(_mixed_ops(ll.src_na))
+        ll.export(str(tmp_path / "out"), separate=True)
+        ll.get_target_miditrack(str(tmp_path / "tgt.mid"))
+        ll.get_label_miditrack(str(tmp_path / "labels.mid"))
+        ll.get_midlevel_label_miditracks(str(tmp_path / "labels_by_type"))
+        expected = ["tgt.mid", "labels.mid"] + [os.path.join("labels_by_type", name)
+                                                for name in os.listdir(tmp_path / "labels_by_type")]
+        assert sorted(os.listdir(tmp_path / "out" / "labels_by_type")) == sorted(os.listdir(tmp_path / "labels_by_type"))
+        for name in expected:
+            with open(tmp_path / "out" / name, "rb") as a, open(tmp_path / name, "rb") as b:
+                assert a.read() == b.read()
+
+    def test_out_of_range_velocity(self, ll, tmp_path):
+        notes = ll.src_na[:3].copy()
+        notes["velocity"][1] = 200
+        with pytest.raises(ValueError):
+            write_midi(str(tmp_path / "bad.mid"), [(None, notes)])
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -19,7 +19,8 @@ import pytest
 import partitura as pt
 import os
 
-from piano_synmist.lowlvl import lowlvl, regular_na_fields, label_na_fields
+from piano_synmist.lowlvl import lowlvl, RepeatTable, regular_na_fields, label_na_fields
+from piano_synmist.utils import timemap_to_csv
 
 MIDI_PATH = os.path.join(os.path.dirname(__file__), "kv279_1.mid")
 
@@ -72,8 +73,7 @@ def _pick_note_in_seg(ll, seg_idx_start, offset=5):
 
 def _time_to_at_src(ll, src_time):
     """Look up time_to for a given src_time via the main warping path."""
-    idx = np.fabs(ll.time_from - src_time).argmin()
-    return float(ll.time_to[idx])
+    return ll.time_map.lookup(src_time)
 
 
 def _tgt_notes_near(ll, tgt_time, window=0.1):
@@ -163,8 +163,7 @@ class TestCreateSegmentedPractice:
         """time_to should remain -1 for src regions not covered by any segment."""
         # Pick a src_time between seg A end and seg B start
         between_time = (segments[0][1] + segments[1][0]) / 2
-        idx = np.fabs(seg_ll.time_from - between_time).argmin()
-        assert seg_ll.time_to[idx] == -1
+        assert _time_to_at_src(seg_ll, between_time) == -1
 
     def test_tgt_sorted(self, seg_ll):
         onsets = seg_ll.tgt_na["onset_sec"]
@@ -178,9 +177,7 @@ class TestCreateSegmentedPractice:
     def test_time_to_increases_within_segment(self, seg_ll, segments):
         """time_to should increase monotonically within each segment."""
         for seg_start, seg_end in segments:
-            idx_s = np.fabs(seg_ll.time_from - seg_start).argmin()
-            idx_e = np.fabs(seg_ll.time_from - seg_end).argmin()
-            tt_slice = seg_ll.time_to[idx_s:idx_e]
+            tt_slice = seg_ll.time_map.lookup(np.linspace(seg_start, seg_end, 200, endpoint=False))
             valid = tt_slice[tt_slice != -1]
             if len(valid) > 1:
                 assert np.all(valid[:-1] <= valid[1:])
@@ -199,6 +196,39 @@ class TestCreateSegmentedPractice:
         # tt_b should be after tt_a_end + gap (approximately)
         assert tt_b > tt_a_end + TIME_GAP * 0.5
 
+    def test_many_segments_back_to_back(self, src_na):
+        """Each segment starts time_gap after the end of the last note of the one before."""
+        starts = np.arange(0, 1000, 7)
+        segs = [(float(src_na["onset_sec"][i]), float(src_na["onset_sec"][i + 20])) for i in starts]
+        ll = lowlvl(copy.deepcopy(src_na), mode="segmented")
+        ll._create_segmented_practice(segs, time_gap=TIME_GAP)
+
+        assert len(ll.tgt_na) == 21 * len(segs)
+        tgt_starts = ll.time_map.lookup(np.array([s for s, _ in segs]))
+        assert tgt_starts[0] == 0.0
+        for k in range(1, len(segs)):
+            prev = ll.tgt_na[21 * (k - 1):21 * k] #the notes of segment k-1
+            last = prev[prev["onset_sec"] == prev["onset_sec"].max()]
+            expected = float(last["onset_sec"][0]) + float(last["duration_sec"].max()) + TIME_GAP
+            assert tgt_starts[k] == pytest.approx(expected, abs=1e-4)
+        #every segment but the last is played again (partly) by the next one
+        assert len(ll.repeat_tracker) > 0
+
+    def test_repeats_are_written_as_painted(self, src_na, segments, monkeypatch, tmp_path):
+        """Placing the segments does not compact the repeats: the timemap export has one block per pass."""
+        monkeypatch.setattr(RepeatTable, "compact", lambda self: pytest.fail("compacted while placing segments"))
+        ll = lowlvl(copy.deepcopy(src_na), mode="segmented")
+        ll._create_segmented_practice(segments + [segments[0]], time_gap=TIME_GAP) #segment A practised twice
+        path = str(tmp_path / "timemap.csv")
+        timemap_to_csv(ll.get_timemap(), ll.get_repeats(), path)
+        with open(path) as f:
+            rows = [row.strip() for row in f]
+        assert rows.count("Repeat 1:") == 1 and "Repeat 2:" not in rows
+        repeat = [tuple(map(float, row.split(","))) for row in rows[rows.index("Repeat 1:") + 1:]]
+        assert len(repeat) == 4
+        assert repeat[0] == pytest.approx((segments[0][0], 0.0))
+        assert repeat[-1][0] == pytest.approx(float(src_na["onset_sec"][SEG_A[1]] + src_na["duration_sec"][SEG_A[1]]))
+
 
 # ===================================================================
 # 3. pitch_insert on segments (repeat_index=0)
@@ -233,7 +263,7 @@ class TestSegmentedPitchInsert:
         src_time, _, _ = _pick_note_in_seg(seg_ll, SEG_C[0], offset=5)
         seg_ll.pitch_insert(src_time=src_time, pitch=103, duration=0.2,
                             velocity=80, midlvl_label="mistouch", repeat_index=0)
-        assert any(seg_ll.label_na["lowlvl_label"] == "pitch_insert")
+        assert any(seg_ll.label_vocab.decode(seg_ll.label_na["lowlvl_label"]) == "pitch_insert")
 
     def test_tgt_remains_sorted(self, seg_ll):
         src_time, _, _ = _pick_note_in_seg(seg_ll, SEG_B[0], offset=8)
@@ -267,7 +297,7 @@ class TestSegmentedPitchDelete:
         src_time, pitch, _ = _pick_note_in_seg(seg_ll, SEG_A[0], offset=10)
         seg_ll.pitch_delete(src_time=src_time, pitch=pitch,
                             midlvl_label="mistouch", repeat_index=0)
-        assert any(seg_ll.label_na["lowlvl_label"] == "pitch_delete")
+        assert any(seg_ll.label_vocab.decode(seg_ll.label_na["lowlvl_label"]) == "pitch_delete")
 
 
 # ===================================================================
@@ -304,7 +334,7 @@ class TestSegmentedTimeOffset:
         src_time, _, _ = _pick_note_in_seg(seg_ll, SEG_B[0], offset=5)
         seg_ll.time_offset(src_time=src_time, offset_time=0.3,
                            midlvl_label="drag", repeat_index=0)
-        assert any(seg_ll.label_na["lowlvl_label"] == "time_shift")
+        assert any(seg_ll.label_vocab.decode(seg_ll.label_na["lowlvl_label"]) == "time_shift")
 
 
 # ===================================================================
@@ -335,7 +365,7 @@ class TestSegmentedChangeNoteOffset:
         seg_ll.change_note_offset(src_time=src_time, pitch=pitch,
                                   offset_shift=0.1, midlvl_label="drag",
                                   repeat_index=0)
-        assert any(seg_ll.label_na["lowlvl_label"] == "change_offset")
+        assert any(seg_ll.label_vocab.decode(seg_ll.label_na["lowlvl_label"]) == "change_offset")
 
 
 # ===================================================================
@@ -370,10 +400,9 @@ class TestSegmentedGoBack:
         """The repeat_tracker entry should cover the segment's src time range."""
         self._do_goback_in_seg(seg_ll, SEG_A[0], SEG_A[1])
         val = list(seg_ll.repeat_tracker.values())[0]
-        rt_time_to, rt_time_from = val
-        # rt_time_from should span the segment's src time range
-        assert float(rt_time_from[0]) == pytest.approx(segments[0][0], abs=0.5)
-        assert float(rt_time_from[-1]) == pytest.approx(segments[0][1], abs=0.5)
+        # the stored map should span the segment's src time range
+        assert val.start == pytest.approx(segments[0][0], abs=0.5)
+        assert val.end == pytest.approx(segments[0][1], abs=0.5)
 
     def test_goback_shifts_time_to_forward(self, seg_ll, segments):
         """After go_back, time_to for later points should increase."""
@@ -390,7 +419,7 @@ class TestSegmentedGoBack:
 
     def test_goback_creates_time_shift_label(self, seg_ll):
         self._do_goback_in_seg(seg_ll, SEG_A[0], SEG_A[1])
-        assert any(seg_ll.label_na["lowlvl_label"] == "time_shift")
+        assert any(seg_ll.label_vocab.decode(seg_ll.label_na["lowlvl_label"]) == "time_shift")
 
 
 # ===================================================================
@@ -429,9 +458,7 @@ class TestOperationsOnRepeat:
 
         # Get expected tgt time from repeat_tracker directly
         rt_val = list(ll.repeat_tracker.values())[0]
-        rt_time_to, rt_time_from = rt_val
-        rt_idx = np.fabs(rt_time_from - src_time).argmin()
-        expected_tgt = float(rt_time_to[rt_idx])
+        expected_tgt = rt_val.lookup(src_time)
 
         ll.pitch_insert(src_time=src_time, pitch=111, duration=0.2,
                         velocity=80, midlvl_label="mistouch", repeat_index=1)
@@ -453,18 +480,15 @@ class TestOperationsOnRepeat:
 
         # Record old pass time_to for a later point
         rt_val = list(ll.repeat_tracker.values())[0]
-        rt_time_to, rt_time_from = rt_val
         later_src, _, _ = _pick_note_in_seg(ll, SEG_A[0], offset=30)
-        rt_idx_later = np.fabs(rt_time_from - later_src).argmin()
-        old_rt_tgt = float(rt_time_to[rt_idx_later])
+        old_rt_tgt = rt_val.lookup(later_src)
 
         ll.time_offset(src_time=src_time, offset_time=0.5,
                        midlvl_label="drag", repeat_index=1)
 
         # The repeat_tracker values should have shifted
         rt_val_after = list(ll.repeat_tracker.values())[0]
-        rt_time_to_after = rt_val_after[0]
-        new_rt_tgt = float(rt_time_to_after[rt_idx_later])
+        new_rt_tgt = rt_val_after.lookup(later_src)
         assert new_rt_tgt == pytest.approx(old_rt_tgt + 0.5, abs=0.15)
 
     def test_change_offset_on_old_pass(self, src_na, segments):
@@ -625,10 +649,10 @@ class TestSegmentedMixed:
                               repeat_index=0)
 
         # Verify labels accumulated
-        assert any(ll.label_na["lowlvl_label"] == "pitch_insert")
-        assert any(ll.label_na["lowlvl_label"] == "time_shift")
-        assert any(ll.label_na["lowlvl_label"] == "pitch_delete")
-        assert any(ll.label_na["lowlvl_label"] == "change_offset")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_insert")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "time_shift")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_delete")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "change_offset")
 
         # tgt_na still sorted
         onsets = ll.tgt_na["onset_sec"]
@@ -720,8 +744,7 @@ class TestSegmentedEdgeCases:
 
     def test_time_to_is_negative_one_between_segments(self, seg_ll, segments):
         between = (segments[0][1] + segments[1][0]) / 2
-        idx = np.fabs(seg_ll.time_from - between).argmin()
-        assert seg_ll.time_to[idx] == -1
+        assert _time_to_at_src(seg_ll, between) == -1
 
     def test_goback_notes_param_is_overwritten(self, src_na, segments):
         """go_back always re-fetches notes from src_na regardless of the
@@ -757,16 +780,14 @@ class TestGlobalOffsetBehavior:
 
         src_time = float(ll.src_na["onset_sec"][SEG_A[0] + 20])
         rt_val = list(ll.repeat_tracker.values())[0]
-        rt_tt, rt_tf = rt_val
-        rt_idx = np.fabs(rt_tf - src_time).argmin()
-        old_rt_tgt = float(rt_tt[rt_idx])
+        old_rt_tgt = rt_val.lookup(src_time)
 
         # Offset on current pass (repeat_index=0)
         ll.time_offset(src_time=src_time, offset_time=1.0,
                        midlvl_label="drag", repeat_index=0)
 
         rt_val_after = list(ll.repeat_tracker.values())[0]
-        new_rt_tgt = float(rt_val_after[0][rt_idx])
+        new_rt_tgt = rt_val_after.lookup(src_time)
         # Old pass also shifted (global offset)
         assert new_rt_tgt == pytest.approx(old_rt_tgt + 1.0, abs=0.15)
 
@@ -778,15 +799,35 @@ class TestGlobalOffsetBehavior:
                    midlvl_label="rollback")
 
         src_time = float(ll.src_na["onset_sec"][SEG_A[0] + 20])
-        idx_main = np.fabs(ll.time_from - src_time).argmin()
-        old_main_tgt = float(ll.time_to[idx_main])
+        old_main_tgt = _time_to_at_src(ll, src_time)
 
         # Offset on old pass (repeat_index=1)
         ll.time_offset(src_time=src_time, offset_time=0.8,
                        midlvl_label="drag", repeat_index=1)
 
         # Current pass also shifted
-        assert ll.time_to[idx_main] == pytest.approx(old_main_tgt + 0.8, abs=0.15)
+        assert _time_to_at_src(ll, src_time) == pytest.approx(old_main_tgt + 0.8, abs=0.15)
+
+
+
+# ===================================================================
+# 13. adjust_annotations in segmented mode
+# ===================================================================
+
+class TestSegmentedAdjustAnnotations:
+    def test_unplayed_times_are_left_out(self, seg_ll):
+        beats = seg_ll.src_na["onset_sec"][SEG_A[0]:SEG_C[1]:5]
+        adjusted = seg_ll.adjust_annotations(beats)
+        assert np.all(adjusted["tgt_time"] >= 0)
+        played = seg_ll.time_map.lookup(beats) != -1
+        assert set(adjusted["index"][adjusted["pass"] == 0]) == set(np.flatnonzero(played))
+        assert not played.all()
+
+    def test_get_adjusted_gt_has_no_unmapped(self, src_na, segments):
+        beats = src_na["onset_sec"][::25].astype(float)
+        ll = lowlvl(copy.deepcopy(src_na), mode="segmented", ts_annot=beats)
+        ll._create_segmented_practice(segments, time_gap=3)
+        assert np.all(ll.get_adjusted_gt() >= 0)
 
 
 if __name__ == "__main__":
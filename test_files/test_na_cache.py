@@ -0,0 +1,188 @@
+"""
+Tests for na_cache.py (on-disk cache of parsed notes and region labels) using kv279_1.mid.
+
+Covers: keys (pedal threshold, DETECTION_PARAMS), read-only memmap hits, LRU eviction,
+        atomic replace, the Mistaker and RegionClassifier cache paths.
+
+Usage:
+    pytest test_na_cache.py -v
+"""
+
+import numpy as np
+import os
+import pytest
+import partitura as pt
+
+from piano_synmist import na_cache
+from piano_synmist.na_cache import NoteArrayCache
+from piano_synmist.region_classifier import RegionClassifier, region_note_array
+from piano_synmist.simulate_mistakes import Mistaker
+
+MIDI_PATH = os.path.join(os.path.dirname(__file__), "kv279_1.mid")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return NoteArrayCache(str(tmp_path / "cache"))
+
+
+@pytest.fixture(scope="module")
+def region_na():
+    return region_note_array(pt.load_performance(MIDI_PATH, pedal_threshold=64))
+
+
+def _entries(cache):
+    return sorted(name for name in os.listdir(cache.cache_dir))
+
+
+class _Counter:
+    """compute() for NoteArrayCache.get that counts its calls."""
+    def __init__(self, na):
+        self.na = na
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.na
+
+
+class _RacingOs:
+    """os for na_cache, as seen while another process evicts: every entry under cache_dir vanishes right after
+    it is stat-ed, and the listing has one that is already gone."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def listdir(self, folder):
+        return os.listdir(folder) + ["gone.npy"]
+
+    def stat(self, path):
+        result = os.stat(path)
+        if os.path.dirname(path) == self.cache_dir:
+            os.unlink(path)
+        return result
+
+
+# ===================================================================
+# 1. keys
+# ===================================================================
+
+class TestKeys:
+    def test_pedal_threshold_changes_key(self, cache):
+        assert cache.key(MIDI_PATH, "notes", pedal_threshold=127) == cache.key(MIDI_PATH, "notes", pedal_threshold=127)
+        assert cache.key(MIDI_PATH, "notes", pedal_threshold=127) != cache.key(MIDI_PATH, "notes", pedal_threshold=64)
+
+    def test_content_not_path(self, cache, tmp_path):
+        copied = tmp_path / "copy.mid"
+        copied.write_bytes(open(MIDI_PATH, "rb").read())
+        assert cache.key(str(copied), "notes") == cache.key(MIDI_PATH, "notes")
+        assert cache.key(np.zeros(3), "notes") != cache.key(np.ones(3), "notes")
+
+    def test_detection_params_miss(self, cache, region_na):
+        first = RegionClassifier(region_na, save=False, cache=cache).na
+        assert len(_entries(cache)) == 1
+        again = RegionClassifier(region_na, save=False, cache=cache).na
+        assert len(_entries(cache)) == 1
+        assert isinstance(again, np.memmap) and np.array_equal(again, first)
+
+        changed = RegionClassifier(region_na, save=False, cache=cache, params={"threshold": 0.1}).na
+        assert len(_entries(cache)) == 2
+        assert not isinstance(changed, np.memmap)
+        assert np.array_equal(changed, RegionClassifier(region_na, save=False, params={"threshold": 0.1}).na)
+
+
+# ===================================================================
+# 2. load / save
+# ===================================================================
+
+class TestLoadSave:
+    def test_hit_is_read_only_memmap(self, cache):
+        na = np.zeros(10, dtype=[("onset_sec", "<f4")])
+        na["onset_sec"] = np.arange(10)
+        compute = _Counter(na)
+        key = cache.key(na, "test")
+        assert cache.get(key, compute) is na
+        hit = cache.get(key, compute)
+        assert compute.calls == 1
+        assert isinstance(hit, np.memmap) and not hit.flags.writeable
+        assert np.array_equal(hit, na)
+        with pytest.raises(ValueError):
+            hit["onset_sec"][0] = 1
+
+    def test_missing_or_corrupt_entry_is_a_miss(self, cache):
+        assert cache.load("nothing") is None
+        with open(cache._path("broken"), "wb") as f:
+            f.write(b"not an npy file")
+        assert cache.load("broken") is None
+
+    def test_replace_is_atomic(self, cache, monkeypatch):
+        cache.save("k", np.zeros(100))
+        old = cache.load("k")
+        cache.save("k", np.ones(100))
+        assert np.all(old == 0) #a reader of the old entry keeps it
+        assert np.all(cache.load("k") == 1)
+
+        def fail(*args, **kwargs):
+            raise OSError("disk full")
+        monkeypatch.setattr(na_cache.np, "save", fail)
+        with pytest.raises(OSError):
+            cache.save("k", np.full(100, 2.0))
+        assert np.all(cache.load("k") == 1)
+        assert _entries(cache) == ["k.npy"]
+
+
+# ===================================================================
+# 3. eviction
+# ===================================================================
+
+class TestEviction:
+    def test_least_recently_used_goes_first(self, cache):
+        for key in "abc":
+            cache.save(key, np.zeros(1000))
+        size = os.path.getsize(cache._path("a"))
+        for mtime, key in enumerate("abc"):
+            os.utime(cache._path(key), (1000 + mtime, 1000 + mtime))
+        cache.load("a") #a hit makes a the most recently used
+        cache.max_bytes = 3 * size
+        cache.save("d", np.zeros(1000))
+        assert _entries(cache) == ["a.npy", "c.npy", "d.npy"]
+
+    def test_fresh_entry_over_max_bytes_is_kept(self, cache, capsys):
+        cache.save("old", np.zeros(10))
+        cache.max_bytes = 1
+        cache.save("new", np.zeros(10))
+        assert _entries(cache) == ["new.npy"]
+        assert np.array_equal(cache.load("new"), np.zeros(10))
+        assert "over max_bytes" in capsys.readouterr().out
+
+    def test_entries_removed_by_another_process(self, cache, monkeypatch):
+        #another worker sharing the directory evicts entries while this one scans it
+        for key in "ab":
+            cache.save(key, np.zeros(1000))
+        tmp = cache._path("c") + ".123.tmp"
+        open(tmp, "wb").close()
+        monkeypatch.setattr(na_cache, "os", _RacingOs(cache.cache_dir))
+        cache.max_bytes = 1
+        cache.evict()
+        monkeypatch.undo()
+        assert _entries(cache) == [os.path.basename(tmp)]
+
+    def test_clear(self, cache):
+        cache.save("a", np.zeros(10))
+        cache.clear()
+        assert _entries(cache) == []
+
+
+# ===================================================================
+# 4. Mistaker
+# ===================================================================
+
+class TestMistakerCache:
+    def test_hit_skips_parsing(self, cache):
+        first = Mistaker(MIDI_PATH, use_region_classifier=False, cache=cache)
+        assert first._performance is not None
+        second = Mistaker(MIDI_PATH, use_region_classifier=False, cache=cache.cache_dir)
+        assert second._performance is None
+        assert np.array_equal(second.change_tracker.src_na, first.change_tracker.src_na)
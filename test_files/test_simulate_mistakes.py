@@ -0,0 +1,269 @@
+"""
+Tests for the Mistaker in simulate_mistakes.py using kv279_1.mid (Mozart K.279 mvt 1).
+
+Covers: apply_payload streaming, fork, mistake_scheduler sampling, process_file / run_batch outputs,
+        seeding.
+
+Usage:
+    pytest test_simulate_mistakes.py -v
+"""
+
+import numpy as np
+import io
+import contextlib
+import pytest
+import os
+import shutil
+
+from piano_synmist import simulate_mistakes
+from piano_synmist.simulate_mistakes import Mistaker, process_file, run_batch
+from piano_synmist.utils import load_filenames, SynmistPerformance
+
+MIDI_PATH = os.path.join(os.path.dirname(__file__), "kv279_1.mid")
+SAMPLING_PROB_PATH = os.path.join(os.path.dirname(__file__), "..", "sampling_prob.csv")
+
+
+@pytest.fixture(scope="module")
+def mistaker():
+    """Mistaker with its regions classified, forked by the tests."""
+    m = Mistaker(MIDI_PATH, sampling_prob_path=SAMPLING_PROB_PATH, seed=0)
+    m.na
+    return m
+
+
+ANNOTATIONS = "1.0\t1.0\tdb,3/4,2\n2.0\t2.0\tb\n3.0\t3.0\tb\n30.0\t30.0\tdb\n"
+OUTPUTS = ['src_perf', 'tgt_perf', 'mistake_timemap', 'mistakelabel_csv', 'mistakelabel_midi']
+
+TEXTURES = ['is_block_chords_note', 'is_scale_note', 'is_double_note', 'others']
+
+
+def _with_textures(m, **flags):
+    """Fork of m whose notes have the given texture columns overwritten."""
+    twin = m.fork()
+    twin._na = np.array(m.na, copy=True)
+    for texture, value in flags.items():
+        twin._na[texture] = value
+    twin._schedule_cache = None
+    return twin
+
+
+@pytest.fixture(scope="module")
+def batch_input(tmp_path_factory):
+    """Input folder for run_batch: x.mid with ASAP annotations, sub/y.mid without."""
+    folder = tmp_path_factory.mktemp("in")
+    os.makedirs(folder / "sub")
+    shutil.copy(MIDI_PATH, folder / "x.mid")
+    shutil.copy(MIDI_PATH, folder / "sub" / "y.mid")
+    (folder / "x_annotations.txt").write_text(ANNOTATIONS)
+    return str(folder)
+
+
+def _quiet(fn, *args, **kwargs):
+    """Call fn without the per-mistake prints."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+# ===================================================================
+# 1. apply_payload (ops, streaming)
+# ===================================================================
+
+class TestApplyPayload:
+    @pytest.mark.parametrize("seed", [0, 3])
+    def test_matches_ops_one_by_one(self, mistaker, seed):
+        bulk, one_by_one = mistaker.fork(), mistaker.fork()
+        bulk.rng, one_by_one.rng = np.random.default_rng(seed), np.random.default_rng(seed)
+        payload = _quiet(bulk.mistake_scheduler, 80)
+        _quiet(one_by_one.mistake_scheduler, 80)
+
+        _quiet(bulk.apply_payload, payload)
+        assert not bulk.failed
+        for p in payload:
+            ops = _quiet(getattr(one_by_one, p[1]), **p[2])
+            for name, kwargs in ops:
+                _quiet(getattr(one_by_one.change_tracker, name), **kwargs)
+        assert np.array_equal(bulk.change_tracker.tgt_na, one_by_one.change_tracker.tgt_na)
+        assert np.array_equal(bulk.change_tracker.label_na, one_by_one.change_tracker.label_na)
+
+
+class TestStreaming:
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_streamed_matches_unstreamed(self, mistaker, seed):
+        whole, streamed = mistaker.fork(), mistaker.fork()
+        whole.rng, streamed.rng = np.random.default_rng(seed), np.random.default_rng(seed)
+        payload = _quiet(whole.mistake_scheduler, 80)
+        assert [p[:2] for p in _quiet(streamed.mistake_scheduler, 80)] == [p[:2] for p in payload]
+
+        _quiet(whole.apply_payload, payload)
+        chunks = []
+        _quiet(streamed.apply_payload, payload, sink=lambda *chunk: chunks.append(chunk), window=10)
+        assert len(chunks) > 2
+        assert np.array_equal(np.concatenate([c[0] for c in chunks]), whole.change_tracker.tgt_na)
+        assert np.array_equal(np.concatenate([c[1] for c in chunks]), whole.change_tracker.label_na)
+
+    def test_streaming_needs_runthrough(self):
+        segmented = Mistaker(MIDI_PATH, mode="segmented", segments=[(5.0, 10.0)], use_region_classifier=False)
+        with pytest.raises(ValueError):
+            segmented.apply_payload([], sink=lambda *chunk: None)
+
+
+# ===================================================================
+# 2. fork
+# ===================================================================
+
+class TestFork:
+    def test_forks_share_regions(self):
+        m = Mistaker(MIDI_PATH, sampling_prob_path=SAMPLING_PROB_PATH, seed=0)
+        assert m._na is None
+        twins = [m.fork() for _ in range(3)]
+        assert all(twin.na is m.na for twin in twins)
+        assert all(twin.fork().na is m.na for twin in twins)
+
+    def test_forks_share_source_notes(self, mistaker):
+        twin = mistaker.fork()
+        assert twin.notes is mistaker.notes
+        assert twin.change_tracker.src_na is mistaker.change_tracker.src_na
+        assert twin.change_tracker is not mistaker.change_tracker
+
+
+# ===================================================================
+# 3. mistake_scheduler sampling
+# ===================================================================
+
+class TestSampling:
+    def test_tables_match_per_note_lookup(self, mistaker):
+        rows, cumulative, mistake_types = mistaker._schedule_tables()
+        assert mistake_types == list(mistaker.sampling_prob.columns)
+        for i in range(0, len(mistaker.na), 7):
+            texture = mistaker.get_texture_group(mistaker.na[i])
+            assert mistaker.sampling_prob.index[rows[i]] == texture
+            probability = mistaker.get_mistake_probability(texture).to_numpy(dtype=np.float64)
+            assert np.allclose(cumulative[rows[i]], np.cumsum(probability / probability.sum()))
+
+    def test_texture_precedence(self, mistaker):
+        #every note flagged with all of the textures from the first on, the first one wins
+        for first, texture in enumerate(TEXTURES):
+            twin = _with_textures(mistaker, **{t: int(k >= first) for k, t in enumerate(TEXTURES)})
+            rows, _, _ = twin._schedule_tables()
+            assert set(twin.sampling_prob.index[rows]) == {texture}
+            assert twin.get_texture_group(twin.na[0]) == texture
+
+    @pytest.mark.parametrize("texture", TEXTURES)
+    def test_draw_follows_sampling_prob(self, mistaker, monkeypatch, texture):
+        monkeypatch.setattr(simulate_mistakes, 'rollback_association_prob', {'mistouch': 0, 'pitch_change': 0, 'drag': 0})
+        twin = _with_textures(mistaker, **{t: int(t == texture) for t in TEXTURES})
+        twin.rng = np.random.default_rng(0)
+        n = 20000
+        payload = twin.mistake_scheduler(n)
+        assert len(payload) == n
+        drawn = [p[1] for p in payload]
+        expected = twin.sampling_prob.loc[texture]
+        expected = expected / expected.sum()
+        for mistake_type, probability in expected.items():
+            assert abs(drawn.count(mistake_type) / n - probability) < 0.02
+
+    def test_note_without_texture_raises(self, mistaker):
+        twin = _with_textures(mistaker, **{t: 0 for t in TEXTURES})
+        with pytest.raises(ValueError):
+            twin.mistake_scheduler(10)
+
+
+# ===================================================================
+# 4. process_file / run_batch outputs
+# ===================================================================
+
+class TestBatch:
+    def test_outputs_load_as_synmist_performance(self, batch_input, tmp_path):
+        notes, applied, failed = process_file(os.path.join(batch_input, "x.mid"), str(tmp_path / "x"), 0,
+                                              n_mistakes=20, sampling_prob_path=SAMPLING_PROB_PATH)
+        assert notes > 0 and failed == 0
+        files = load_filenames("x", str(tmp_path))
+        assert all(os.path.exists(files[k]) for k in OUTPUTS)
+        performance = SynmistPerformance(**files)
+        assert len(performance.tgt_mistakelabel_time) == applied
+        assert set(performance.tgt_mistakelabel_label) <= {'forward_backward_insertion', 'mistouch', 'pitch_change', 'drag', 'rollback'}
+
+    def test_annotations_keep_asap_columns(self, batch_input, tmp_path):
+        process_file(os.path.join(batch_input, "x.mid"), str(tmp_path / "x"), 0,
+                     n_mistakes=20, sampling_prob_path=SAMPLING_PROB_PATH)
+        rows = [line.rstrip("\n").split("\t") for line in open(tmp_path / "x-tgt_annotations.txt")]
+        source = [line.split("\t")[2] for line in ANNOTATIONS.splitlines()]
+        assert all(len(row) == 3 and row[0] == row[1] for row in rows)
+        times = [float(row[0]) for row in rows]
+        assert times == sorted(times)
+        assert set(row[2] for row in rows) == set(source) #every label carried over, rollbacks may repeat some
+        assert len(rows) >= len(source)
+
+    def test_failed_items_are_counted(self, batch_input, tmp_path, monkeypatch, capsys):
+        def fail(self, note):
+            raise RuntimeError("mistouch broke")
+        monkeypatch.setattr(Mistaker, "mistouch", fail)
+        notes, applied, failed = process_file(os.path.join(batch_input, "x.mid"), str(tmp_path / "x"), 1,
+                                              n_mistakes=40, sampling_prob_path=SAMPLING_PROB_PATH)
+        labels = [row.split(",")[1] for row in open(tmp_path / "x-label.csv") if row.startswith("[")]
+        assert failed == labels.count("mistouch") > 0
+        assert applied == len(labels) - failed
+        assert "mistouch broke" in capsys.readouterr().out
+
+    def test_run_batch_keeps_folder_structure(self, batch_input, tmp_path):
+        bad = os.path.join(batch_input, "sub", "broken.mid")
+        with open(bad, "w") as f:
+            f.write("not a midi file")
+        try:
+            failed = _quiet(run_batch, batch_input, "out", str(tmp_path / "run"), workers=2, seed=0,
+                            n_mistakes=10, sampling_prob_path=SAMPLING_PROB_PATH)
+        finally:
+            os.remove(bad)
+        assert list(failed) == [bad]
+        out = tmp_path / "run" / "out"
+        assert all(os.path.exists(load_filenames("x", str(out))[k]) for k in OUTPUTS)
+        assert all(os.path.exists(load_filenames("y", str(out / "sub"))[k]) for k in OUTPUTS)
+        assert os.path.exists(out / "x-tgt_annotations.txt")
+        assert not os.path.exists(out / "sub" / "y-tgt_annotations.txt")
+
+
+# ===================================================================
+# 5. seeding
+# ===================================================================
+
+def _run(m, n_mistakes=40):
+    payload = _quiet(m.mistake_scheduler, n_mistakes)
+    _quiet(m.apply_payload, payload)
+    return payload, m.change_tracker.tgt_na
+
+
+def _tree(folder):
+    files = {}
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            files[os.path.relpath(path, folder)] = open(path, "rb").read()
+    return files
+
+
+class TestSeeding:
+    def test_same_seed_same_output(self):
+        runs = [_run(Mistaker(MIDI_PATH, sampling_prob_path=SAMPLING_PROB_PATH, seed=7)) for _ in range(2)]
+        (payload_a, tgt_a), (payload_b, tgt_b) = runs
+        assert [(p[0], p[1], p[2]['note']['id']) for p in payload_a] == [(p[0], p[1], p[2]['note']['id']) for p in payload_b]
+        assert np.array_equal(tgt_a, tgt_b)
+
+    def test_forks_get_distinct_streams(self, mistaker):
+        twins = [mistaker.fork() for _ in range(2)]
+        assert not np.array_equal(twins[0].rng.random(8), twins[1].rng.random(8))
+        payloads = [_quiet(twin.mistake_scheduler, 40) for twin in twins]
+        assert [p[2]['note']['id'] for p in payloads[0]] != [p[2]['note']['id'] for p in payloads[1]]
+
+    def test_forks_follow_the_parent_seed(self):
+        parents = [Mistaker(MIDI_PATH, sampling_prob_path=SAMPLING_PROB_PATH, seed=3) for _ in range(2)]
+        streams = [[parent.fork().rng.random(4) for _ in range(2)] for parent in parents]
+        assert np.array_equal(streams[0], streams[1])
+
+    def test_run_batch_same_output_for_any_workers(self, batch_input, tmp_path):
+        for workers in (1, 3):
+            failed = _quiet(run_batch, batch_input, "out", str(tmp_path / str(workers)), workers=workers, seed=11,
+                            n_mistakes=20, sampling_prob_path=SAMPLING_PROB_PATH)
+            assert failed == {}
+        single, parallel = _tree(tmp_path / "1"), _tree(tmp_path / "3")
+        assert len(single) == 2 * len(OUTPUTS) + 1
+        assert single == parallel
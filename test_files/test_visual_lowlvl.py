@@ -138,8 +138,7 @@ class TestScenarioTimeOffset:
 
         assert len(figs) == 3
         # Warping path should now diverge from identity
-        idx = np.fabs(ll.time_from - t1 - 1).argmin()
-        assert ll.time_to[idx] > ll.time_from[idx]
+        assert ll.time_map.lookup(t1 + 1) > t1 + 1
 
 
 # ===================================================================
@@ -268,10 +267,10 @@ class TestScenarioMixed:
         # Assertions on final state
         assert len(ll.repeat_tracker) == 1
         assert 100 in ll.tgt_na["pitch"]
-        assert any(ll.label_na["lowlvl_label"] == "pitch_insert")
-        assert any(ll.label_na["lowlvl_label"] == "time_shift")
-        assert any(ll.label_na["lowlvl_label"] == "pitch_delete")
-        assert any(ll.label_na["lowlvl_label"] == "change_offset")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_insert")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "time_shift")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_delete")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "change_offset")
 
         plt.close('all')
 
@@ -363,10 +363,10 @@ class TestScenarioSegmentedMixed:
         assert len(ll.repeat_tracker) == 2
         assert 100 in ll.tgt_na["pitch"]
         assert 113 in ll.tgt_na["pitch"]
-        assert any(ll.label_na["lowlvl_label"] == "pitch_insert")
-        assert any(ll.label_na["lowlvl_label"] == "time_shift")
-        assert any(ll.label_na["lowlvl_label"] == "pitch_delete")
-        assert any(ll.label_na["lowlvl_label"] == "change_offset")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_insert")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "time_shift")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "pitch_delete")
+        assert any(ll.label_vocab.decode(ll.label_na["lowlvl_label"]) == "change_offset")
 
         onsets = ll.tgt_na["onset_sec"]
         assert np.all(onsets[:-1] <= onsets[1:])
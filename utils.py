@@ -6,6 +6,7 @@ import csv
 import ast
 import numpy as np
 from math import ceil, floor
+from lowlvl import InverseTimeMap
 #display utils should be separated from other core utils so that synmist is not dependent on matplotlib (since it can cause clashes etc..)
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
@@ -141,12 +142,15 @@ def parse_mistake_labels_file(file_path):
     return entries
     
 def payload_to_csv(payload, fileout):
+    #times and notes are written as 1 element arrays, the way parse_mistake_labels_file reads them back
     fields = ['time', 'label', 'params']
     with open(fileout, 'w') as csv_out:
         writer = csv.writer(csv_out)
         writer.writerow(fields)
-        for row in payload:
-            writer.writerow(row)
+        for time, label, params in payload:
+            if 'note' in params:
+                params = dict(params, note=np.atleast_1d(params['note']))
+            writer.writerow([np.atleast_1d(time), label, params])
     return
 
 def timemap_to_csv(time_map, repeats, fileout):
@@ -167,12 +171,20 @@ def timemap_to_csv(time_map, repeats, fileout):
             repeat_number += 1
 
 def csv_to_timemap(filein):
+    #main map as a list of (timefrom, timeto), repeats as {key: (timefrom list, timeto list)} in file order.
+    #timemap_to_csv writes 'Repeat n:' headers, in which case the key is the tgt interval of the repeat (as in lowlvl).
     time_map = []
     repeat_tracker = {}
     current_repeat = None
     current_from_times = []
     current_to_times = []
 
+    def repeat_key(header, to_times):
+        if '(' in header:
+            repeat_times = header.replace("Repeat (", "").replace(")", "").split(", ")
+            return (float(repeat_times[0]), float(repeat_times[1]))
+        return (to_times[0], to_times[-1])
+
     with open(filein, 'r') as csv_in:
         reader = csv.reader(csv_in)
         
@@ -187,10 +199,9 @@ def csv_to_timemap(filein):
             if row[0].startswith("Repeat"):
                 # If we're already in a repeat section, save the previous one
                 if current_repeat:
-                    repeat_tracker[current_repeat] = (current_from_times, current_to_times)
+                    repeat_tracker[repeat_key(current_repeat, current_to_times)] = (current_from_times, current_to_times)
                 # Start a new repeat section
-                repeat_times = row[0].replace("Repeat (", "").replace(")", "").split(", ")
-                current_repeat = (float(repeat_times[0]), float(repeat_times[1]))
+                current_repeat = row[0]
                 current_from_times = []
                 current_to_times = []
             elif current_repeat:
@@ -203,7 +214,7 @@ def csv_to_timemap(filein):
         
         # After finishing the loop, make sure to save the last repeat section
         if current_repeat:
-            repeat_tracker[current_repeat] = (current_from_times, current_to_times)
+            repeat_tracker[repeat_key(current_repeat, current_to_times)] = (current_from_times, current_to_times)
     
     return time_map, repeat_tracker
 
@@ -242,6 +253,9 @@ class SynmistPerformance:
         self.tgt_performance = pretty_midi.PrettyMIDI(tgt_perf)
         self.src_perf = pretty_midi.PrettyMIDI(src_perf)
         self.mistake_timemap_main, self.mistake_timemap_repeats = csv_to_timemap(mistake_timemap)
+        #tgt -> (src, pass) index, built once for all the get_src_equivalent queries
+        main_from, main_to = zip(*self.mistake_timemap_main)
+        self.inverse_timemap = InverseTimeMap(main_from, main_to, list(self.mistake_timemap_repeats.values()))
         #to add later the src_gt and tgt_gt labels
         return
     
@@ -264,47 +278,10 @@ class SynmistPerformance:
         return mistake_windows, mistake_centers
     
     #tgt_times should be an array of the time window we want to obtain a src equivalent for.
-    #we should check entry by entry in the array, and get the nearest point before it if it's > 0+the threshold.
-    #and return till the first entry which is within timeto+search_resolution_ms. 
-    def get_src_equivalent(self, tgt_times, search_resolution_ms):
-        #i think for now i'll just ignore the search_resolution_ms..
-        timeto = [timeto for (timefrom, timeto) in self.mistake_timemap[0]]
-        timefrom = [timefrom for (timefrom, timeto) in self.mistake_timemap[0]]
-
-        tgt_time_out = [] 
-        src_time_out = []
-
-        for t in tgt_times:
-            #check the main map and each of the repeats for the nearest index
-            #each tgt time can lead to just one score time, but not vice versa. 
-            closest_value = -1 #since we cannot have negative time
-            closest_value_idx = None
-            repeat = 0 #this is to keep track of which repeat id (or none) had the closest value.
-
-            nearest_tgt_idx = np.fabs(t - timeto).argmin() #should be the one greater but for now whatev.
-            closest_value = timeto[nearest_tgt_idx]
-            closest_value_src = timefrom[nearest_tgt_idx]
-
-            repeats = {} #holds the nearest_tgt_idx per each repeatmap
-
-            for repeatid, repeat_map in self.mistake_timemap[1].items():
-                timeto_repeat = [timeto for (timefrom, timeto) in repeat_map]
-                timefrom_repeat = [timefrom for (timefrom, timeto) in repeat_map]
-                repeats[repeatid] = np.fabs(t - timeto).argmin()
-                if abs(t - timeto[repeats[repeatid]]) < abs(t-closest_value): 
-                    closest_value = timeto_repeat[repeats[repeatid]]
-                    closest_value_src = timefrom_repeat[repeats[repeatid]]
-                    repeat = repeatid
-
-            tgt_time_out.append(closest_value)
-            src_time_out.append(closest_value_src)
-
-            #at the end of this,
-            #repeat would tell whether this is from a repeated part or not. 0 if not, yes if greater
-            #and repeats[repeatid] tells which is the closest index to t we are trying to find.
-            #this code can definitely be more efficient, but i'm sticking to this mediocrity for now.
-
-        return tgt_time_out, src_time_out
+    #returns the src time of each tgt time, and the pass that played it: 0 for the main path,
+    #k for the k-th repeat (see lowlvl.InverseTimeMap). search_resolution_ms is not used, the map is exact.
+    def get_src_equivalent(self, tgt_times, search_resolution_ms=None):
+        return self.inverse_timemap.lookup(tgt_times)
     
     def get_src_data(self, src_times):
         return